@@ -17,12 +17,13 @@
 
 import argparse
 import logging
-import os
 import sys
 
 import src.analysis.main as analysis
 import src.scraper.main as scraper
-from src import station_extractor, train_extractor
+import src.scraper.reparse as reparse
+import src.scraper.standin as standin
+from src import benchmark, station_extractor, synthetic, train_extractor
 
 parser = argparse.ArgumentParser(
     prog="train-scraper",
@@ -30,9 +31,25 @@ parser = argparse.ArgumentParser(
 subparsers = parser.add_subparsers(dest="subcommand", required=True)
 parser.add_argument("-d", "--debug", action="store_true", help="activate debug logs")
 
-scraper_p = subparsers.add_parser(
-    "scraper",
-    help="station and train data scraper",
+scraper.register_args(
+    subparsers.add_parser(
+        "scraper",
+        help="station and train data scraper",
+    )
+)
+
+reparse.register_args(
+    subparsers.add_parser(
+        "reparse",
+        help="rebuild scraped train data from archived raw responses",
+    )
+)
+
+standin.register_args(
+    subparsers.add_parser(
+        "standin",
+        help="local stand-in of the ViaggiaTreno and Trenord APIs, with fault injection",
+    )
 )
 
 train_extractor.register_args(
@@ -53,6 +70,18 @@ analysis.register_args(
         help="data analyzer and visualizer",
     )
 )
+synthetic.register_args(
+    subparsers.add_parser(
+        "synthetic",
+        help="generate synthetic train and station datasets",
+    )
+)
+benchmark.register_args(
+    subparsers.add_parser(
+        "benchmark",
+        help="scraper and analysis benchmarks, compared with a baseline",
+    )
+)
 
 
 def main():
@@ -63,14 +92,6 @@ def main():
     )
     print()
 
-    hashseed: str | None = os.getenv("PYTHONHASHSEED")
-    if not hashseed or hashseed != "0":
-        logging.critical(
-            "Hash seed randomization is not disabled. "
-            "Please disable it by setting the PYTHONHASHSEED=0 environment variable."
-        )
-        sys.exit(1)
-
     args: argparse.Namespace = parser.parse_args()
 
     logging.basicConfig(
@@ -80,7 +101,13 @@ def main():
     )
 
     if args.subcommand == "scraper":
-        scraper.main()
+        scraper.main(args)
+
+    if args.subcommand == "reparse":
+        reparse.main(args)
+
+    if args.subcommand == "standin":
+        standin.main(args)
 
     if args.subcommand == "train-extractor":
         train_extractor.main(args)
@@ -91,6 +118,12 @@ def main():
     if args.subcommand == "analyze":
         analysis.main(args)
 
+    if args.subcommand == "synthetic":
+        synthetic.main(args)
+
+    if args.subcommand == "benchmark":
+        benchmark.main(args)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,142 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import contextlib
+import io
+import logging
+import pathlib
+import tempfile
+import typing as t
+from datetime import datetime, timedelta
+
+import matplotlib.pyplot as plt
+import pandas as pd
+
+from src import station_extractor, synthetic, train_extractor
+from src.analysis import groupby, stat
+from src.analysis.filter import (
+    date_filter,
+    railway_company_filter,
+    railway_lines_filter,
+)
+from src.analysis.load_data import read_station_csv, read_train_csv, tag_lines
+from src.benchmark import Result, measure, peak_memory
+
+# Railway companies kept by the filter stage
+FILTER_COMPANIES: str = "trenitalia_reg,trenitalia_av,trenitalia_ic,trenord,tper"
+
+
+def _extract(data_dir: pathlib.Path, paths: t.Sequence[pathlib.Path]) -> None:
+    """Convert the datasets to CSV, as station-extractor and train-extractor do."""
+    station_extractor.to_csv(
+        station_extractor.load_file(data_dir / "stations.pickle"),
+        data_dir / "stations.csv",
+    )
+    for path in paths:
+        train_extractor.to_csv(
+            train_extractor.load_file(path), path.with_suffix(".csv")
+        )
+
+
+def _load(
+    data_dir: pathlib.Path, paths: t.Sequence[pathlib.Path]
+) -> t.Tuple[pd.DataFrame, pd.DataFrame]:
+    """Load the CSVs, as the analyze command does (in a single process)."""
+    df: pd.DataFrame = pd.concat(
+        [read_train_csv(path.with_suffix(".csv")) for path in paths], axis=0
+    )
+    df.reset_index(drop=True, inplace=True)
+    return df, read_station_csv(data_dir / "stations.csv")
+
+
+def _stat(df: pd.DataFrame) -> None:
+    """Compute the stats which don't open a browser, without showing the figures."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        stat.describe(df)
+    stat.delay_boxplot(groupby.client_code(df))
+    plt.close("all")
+    stat.day_train_count(df)
+    plt.close("all")
+
+
+def pipeline(days: int, trains: int, repeat: int = 1, seed: int = 0) -> list[Result]:
+    """Time and memory-profile the stages of the analysis of synthetic days
+    (see synthetic.generate): extract (pickles to CSV), load, tag (lines),
+    filter and stat.
+
+    Each stage is run once with tracemalloc, then timed without it.
+
+    Args:
+        days (int): the number of days
+        trains (int): the approximate number of trains of each day
+        repeat (int, optional): the runs of each stage (the best one is kept)
+        seed (int, optional): the seed of the synthetic days
+
+    Returns:
+        list[Result]: the time and the peak of allocated memory of each stage,
+            per stop (row of the train CSVs)
+    """
+    plt.switch_backend("agg")
+
+    with tempfile.TemporaryDirectory() as directory:
+        data_dir = pathlib.Path(directory)
+        paths: list[pathlib.Path] = synthetic.generate(
+            data_dir, synthetic.DEFAULT_START_DATE, days, trains, seed=seed
+        )
+
+        # Keep all the days but the first one, and half of the lines
+        start_date: datetime = datetime.combine(
+            synthetic.DEFAULT_START_DATE + timedelta(days=1), datetime.min.time()
+        )
+        lines: str | None = None
+
+        def _filter(df: pd.DataFrame) -> pd.DataFrame:
+            df = date_filter(df, start_date if days > 1 else None, None)
+            df = railway_company_filter(df, FILTER_COMPANIES)
+            return railway_lines_filter(df, lines)
+
+        stages: list[t.Tuple[str, t.Callable[[t.Any], t.Any]]] = [
+            ("extract", lambda _: _extract(data_dir, paths)),
+            ("load", lambda _: _load(data_dir, paths)),
+            ("tag", lambda loaded: tag_lines(*loaded)),
+            ("filter", _filter),
+            ("stat", _stat),
+        ]
+
+        measured: list[t.Tuple[str, float, int]] = list()
+        rows: int = 0
+        value: t.Any = None
+        for name, stage in stages:
+            stage_input: t.Any = value
+            value, memory = peak_memory(lambda: stage(stage_input))
+            elapsed: float = measure(lambda: stage(stage_input), repeat=repeat)
+            measured.append((name, elapsed, memory))
+            logging.info(
+                f"Pipeline stage {name}: {elapsed:.3f} s, "
+                f"{memory / 2**20:.1f} MiB allocated at most"
+            )
+
+            if name == "load":
+                rows = len(value[0])
+            elif name == "tag":
+                lines = ",".join(value.line.unique()[::2])
+
+    results: list[Result] = list()
+    for name, elapsed, memory in measured:
+        results.append(Result(f"pipeline.{name}.time", elapsed / rows * 1e6, "us/row"))
+        results.append(Result(f"pipeline.{name}.memory", memory / rows, "bytes/row"))
+    return results
@@ -15,12 +15,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from datetime import datetime
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 
+import src.localtime as localtime
 from src.const import RailwayCompany
 
 
@@ -36,14 +36,9 @@ def read_train_csv(file: Path) -> pd.DataFrame:
 
     df: pd.DataFrame = pd.read_csv(file)
 
-    @np.vectorize
-    def _parse_dt(_string: str | None) -> datetime | None:
-        try:
-            if not isinstance(_string, str):
-                return None
-            return datetime.fromisoformat(_string)
-        except ValueError:
-            return None
+    # CSVs extracted before the integer train keys have MD5 hex strings
+    if df.train_hash.dtype == object:
+        df.train_hash = df.train_hash.map(lambda h: int(h[:15], 16))
 
     # Parse datetimes
     for dt_field in [
@@ -52,12 +47,7 @@ def read_train_csv(file: Path) -> pd.DataFrame:
         "departure_expected",
         "departure_actual",
     ]:
-        df[dt_field] = (
-            df[dt_field]
-            .apply(_parse_dt)
-            .astype("object")
-            .where(df[dt_field].notnull(), None)
-        )
+        df[dt_field] = localtime.parse_isoformat(df[dt_field])
 
     df.day = pd.to_datetime(df.day)
 
@@ -90,7 +90,7 @@ def delay_boxplot(df: pd.DataFrame | DataFrameGroupBy) -> None:
                 ],
                 value_name="value",
             )
-            group_melt = pd.concat([group_melt, melt])
+            group_melt = pd.concat([group_melt, melt], ignore_index=True)
 
         ax = sns.boxplot(
             group_melt[[grouped_by, "variable", "value"]],
@@ -0,0 +1,334 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import gc
+import json
+import logging
+import os
+import pathlib
+import platform
+import sys
+import time
+import tracemalloc
+import typing as t
+from datetime import datetime
+
+from src.const import TIMEZONE
+
+BENCHMARKS_DIR = pathlib.Path("data/benchmarks/")
+BASELINE_PATH = BENCHMARKS_DIR / "baseline.json"
+
+# Relative change of a result considered a regression
+DEFAULT_TOLERANCE: float = 0.1
+
+SUITES: list[str] = ["micro", "scraper", "pipeline"]
+
+
+class Result(t.NamedTuple):
+    """A benchmark result.
+
+    Attributes:
+        name (str): the benchmark name, e.g. 'micro.train_stop.from_raw_data'
+        value (float): the measured value
+        unit (str): the unit of the value, e.g. 'us/stop'
+        higher_is_better (bool): True for throughputs, False for times and sizes
+    """
+
+    name: str
+    value: float
+    unit: str
+    higher_is_better: bool = False
+
+
+class Change(t.NamedTuple):
+    """A result compared to its baseline.
+
+    Attributes:
+        result (Result): the result
+        baseline (float): the baseline value
+        change (float): the relative change (e.g. 0.1 for +10%)
+        regression (bool): True if the result is worse than the baseline
+            by more than the tolerance
+    """
+
+    result: Result
+    baseline: float
+    change: float
+    regression: bool
+
+
+def measure(
+    func: t.Callable[[], t.Any],
+    setup: t.Callable[[], t.Any] | None = None,
+    repeat: int = 5,
+) -> float:
+    """Return the best time of some runs of a function.
+    As timeit does, the garbage collector is disabled while timing.
+
+    Args:
+        func (t.Callable[[], t.Any]): the function to time
+        setup (t.Callable[[], t.Any] | None, optional): called (not timed)
+            before each run, e.g. to rebuild the data func changes
+        repeat (int, optional): the number of runs
+
+    Returns:
+        float: the best time, in seconds
+    """
+    best: float = float("inf")
+    gc_enabled: bool = gc.isenabled()
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        gc.disable()
+        try:
+            started: float = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - started)
+        finally:
+            if gc_enabled:
+                gc.enable()
+    return best
+
+
+def peak_memory(func: t.Callable[[], t.Any]) -> t.Tuple[t.Any, int]:
+    """Run a function, tracing the memory it allocates (see tracemalloc).
+    Tracing slows the function down, so it should not be timed meanwhile.
+
+    Args:
+        func (t.Callable[[], t.Any]): the function to run
+
+    Returns:
+        t.Tuple[t.Any, int]: the function result, and the peak of the memory
+            allocated while running it, in bytes
+    """
+    tracemalloc.start()
+    try:
+        result: t.Any = func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def save_results(path: pathlib.Path, results: t.Sequence[Result]) -> None:
+    """Save benchmark results as JSON, with details about the environment.
+
+    Args:
+        path (pathlib.Path): the file to write
+        results (t.Sequence[Result]): the results
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "created": datetime.now(tz=TIMEZONE).isoformat(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+                "results": {
+                    result.name: {
+                        "value": result.value,
+                        "unit": result.unit,
+                        "higher_is_better": result.higher_is_better,
+                    }
+                    for result in results
+                },
+            },
+            f,
+            indent=2,
+        )
+
+
+def load_results(path: pathlib.Path) -> list[Result]:
+    """Load benchmark results saved with save_results.
+
+    Args:
+        path (pathlib.Path): the file to read
+
+    Returns:
+        list[Result]: the results
+    """
+    with open(path) as f:
+        raw: dict[str, t.Any] = json.load(f)
+    return [Result(name, **result) for name, result in raw["results"].items()]
+
+
+def compare(
+    results: t.Iterable[Result],
+    baseline: t.Iterable[Result],
+    tolerance: float = DEFAULT_TOLERANCE,
+) -> list[Change]:
+    """Compare results to a baseline. Results missing in the baseline are skipped.
+
+    Args:
+        results (t.Iterable[Result]): the results
+        baseline (t.Iterable[Result]): the baseline results
+        tolerance (float, optional): the relative change considered a regression
+
+    Returns:
+        list[Change]: the compared results
+    """
+    baseline_values: dict[str, float] = {b.name: b.value for b in baseline}
+    changes: list[Change] = list()
+    for result in results:
+        base: float | None = baseline_values.get(result.name)
+        if base is None:
+            continue
+
+        change: float = result.value / base - 1 if base else 0.0
+        worse: float = -change if result.higher_is_better else change
+        changes.append(Change(result, base, change, worse > tolerance))
+    return changes
+
+
+def report(results: t.Sequence[Result], changes: t.Sequence[Change] = ()) -> str:
+    """Format results (and their changes) as a text table.
+
+    Args:
+        results (t.Sequence[Result]): the results
+        changes (t.Sequence[Change], optional): the results compared to a baseline
+
+    Returns:
+        str: the table
+    """
+    by_name: dict[str, Change] = {change.result.name: change for change in changes}
+    width: int = max((len(result.name) for result in results), default=0)
+    lines: list[str] = list()
+    for result in results:
+        line: str = f"{result.name:<{width}}  {result.value:>12.4g} {result.unit:<10}"
+        if (change := by_name.get(result.name)) is not None:
+            line += f"  {change.change:+7.1%}"
+            if change.regression:
+                line += "  REGRESSION"
+        lines.append(line.rstrip())
+    return "\n".join(lines)
+
+
+def register_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "suites",
+        nargs="*",
+        choices=SUITES,
+        default=SUITES,
+        metavar="SUITE",
+        help=f"benchmark suites to run ({', '.join(SUITES)}). Defaults to all",
+    )
+    parser.add_argument(
+        "--scale",
+        type=int,
+        default=2000,
+        metavar="TRAINS",
+        help=(
+            "number of trains of the micro-benchmark data, and of each day "
+            "of the pipeline suite. Defaults to 2000"
+        ),
+    )
+    parser.add_argument(
+        "--trains",
+        type=int,
+        default=500,
+        metavar="N",
+        help="number of trains of the stand-in day of the scraper suite. Defaults to 500",
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=3,
+        metavar="N",
+        help="number of synthetic days analyzed by the pipeline suite. Defaults to 3",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        metavar="N",
+        help=(
+            "runs of each micro-benchmark and pipeline stage (the best one is kept). "
+            "Defaults to 5"
+        ),
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=pathlib.Path,
+        help=f"file to save the results in. Defaults to {BENCHMARKS_DIR}/<time>.json",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=pathlib.Path,
+        default=BASELINE_PATH,
+        help=f"results to compare with. Defaults to {BASELINE_PATH}",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help=(
+            "relative change of a result considered a regression. "
+            f"Defaults to {DEFAULT_TOLERANCE}"
+        ),
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="save the results as the new baseline",
+    )
+
+
+def main(args: argparse.Namespace) -> None:
+    import src.analysis.benchmark as analysis_benchmark
+    import src.scraper.benchmark as scraper_benchmark
+
+    results: list[Result] = list()
+    if "micro" in args.suites:
+        logging.info(f"Running the micro-benchmarks on {args.scale} trains")
+        results += scraper_benchmark.micro(args.scale, repeat=args.repeat)
+    if "scraper" in args.suites:
+        logging.info(f"Running the scraper on a stand-in day of {args.trains} trains")
+        results += scraper_benchmark.end_to_end(args.trains)
+    if "pipeline" in args.suites:
+        logging.info(
+            f"Running the analysis pipeline on {args.days} synthetic days "
+            f"of {args.scale} trains"
+        )
+        results += analysis_benchmark.pipeline(
+            args.days, args.scale, repeat=args.repeat
+        )
+
+    output: pathlib.Path = args.output or (
+        BENCHMARKS_DIR / f"{datetime.now(tz=TIMEZONE):%Y-%m-%dT%H-%M-%S}.json"
+    )
+    save_results(output, results)
+    logging.info(f"Results saved in {output}")
+
+    changes: list[Change] = list()
+    if args.baseline.exists() and not args.update_baseline:
+        changes = compare(results, load_results(args.baseline), args.tolerance)
+    print(report(results, changes))
+
+    if args.update_baseline:
+        save_results(args.baseline, results)
+        logging.info(f"Baseline updated: {args.baseline}")
+
+    regressions: list[Change] = [change for change in changes if change.regression]
+    if regressions:
+        logging.error(
+            f"{len(regressions)} results are worse than the baseline "
+            f"({args.baseline}) by more than {args.tolerance:.0%}"
+        )
+        sys.exit(1)
@@ -0,0 +1,359 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import bisect
+import calendar
+import functools
+import typing as t
+from datetime import datetime, timedelta, timezone, tzinfo
+
+import numpy as np
+
+from src.const import TIMEZONE
+
+# Years covered by the precomputed transition table.
+# Outside of them, offsets are resolved by the timezone itself.
+TABLE_START_YEAR: int = 1900
+TABLE_END_YEAR: int = 2100
+
+# Step of the offset probes used to build the table, in seconds.
+# Transitions are assumed to be more than a step apart.
+PROBE_STEP: int = 7 * 86400
+
+_UNIX_EPOCH: datetime = datetime(1970, 1, 1)
+
+
+class TransitionTable:
+    """UTC offsets of a timezone, precomputed between two years.
+
+    Offsets are looked up with a binary search instead of going through
+    the timezone rules, and datetimes are built with fixed-offset
+    timezones (datetime.timezone), which the standard library handles in C.
+
+    Attributes:
+        tz (tzinfo): the timezone
+        transitions (list[int]): UTC timestamps at which the offsets start
+        offsets (list[int]): the UTC offsets, in seconds
+    """
+
+    def __init__(
+        self,
+        tz: tzinfo,
+        start_year: int = TABLE_START_YEAR,
+        end_year: int = TABLE_END_YEAR,
+    ) -> None:
+        """Initialize a new transition table.
+
+        Args:
+            tz (tzinfo): the timezone
+            start_year (int, optional): the first year of the table
+            end_year (int, optional): the year the table ends at (excluded)
+        """
+        self.tz: tzinfo = tz
+        self._lower: int = calendar.timegm((start_year, 1, 1, 0, 0, 0))
+        self._upper: int = calendar.timegm((end_year, 1, 1, 0, 0, 0))
+
+        self.transitions: list[int] = [self._lower]
+        self.offsets: list[int] = [self._probe(self._lower)]
+        for probe in range(self._lower + PROBE_STEP, self._upper, PROBE_STEP):
+            offset: int = self._probe(probe)
+            if offset == self.offsets[-1]:
+                continue
+
+            # Find the first second with the new offset
+            low, high = probe - PROBE_STEP, probe
+            while high - low > 1:
+                middle: int = (low + high) // 2
+                if self._probe(middle) == offset:
+                    high = middle
+                else:
+                    low = middle
+            self.transitions.append(high)
+            self.offsets.append(offset)
+
+        # Local times at which the offsets start. As dateutil does for
+        # ambiguous or missing local times, the previous offset is used
+        self._wall_transitions: list[int] = [self._lower + self.offsets[0]] + [
+            transition + offset
+            for transition, offset in zip(self.transitions[1:], self.offsets)
+        ]
+        self._wall_lower: int = self._wall_transitions[0]
+        self._wall_upper: int = self._upper + self.offsets[-1]
+
+        self._transitions_array: np.ndarray = np.array(self.transitions, dtype="int64")
+        self._offsets_array: np.ndarray = np.array(self.offsets, dtype="int64")
+
+    def _probe(self, timestamp: int) -> int:
+        """Resolve the UTC offset of a timestamp with the timezone rules."""
+        offset: timedelta | None = datetime.fromtimestamp(
+            timestamp, self.tz
+        ).utcoffset()
+        assert offset is not None
+        return int(offset.total_seconds())
+
+    def utcoffset(self, timestamp: int | float) -> int:
+        """Return the UTC offset of a timestamp.
+
+        Args:
+            timestamp (int | float): the UNIX timestamp, in seconds
+
+        Returns:
+            int: the offset, in seconds
+        """
+        if not self._lower <= timestamp < self._upper:
+            return self._probe(int(timestamp // 1))
+        return self.offsets[bisect.bisect_right(self.transitions, timestamp) - 1]
+
+    def wall_to_timestamp(self, wall: int) -> int:
+        """Convert a local time to a UNIX timestamp.
+
+        Args:
+            wall (int): the local time, in seconds since 1970-01-01 00:00 (local)
+
+        Returns:
+            int: the UNIX timestamp, in seconds
+        """
+        if not self._wall_lower <= wall < self._wall_upper:
+            naive: datetime = _UNIX_EPOCH + timedelta(seconds=wall)
+            return int(naive.replace(tzinfo=self.tz).timestamp())
+        return (
+            wall - self.offsets[bisect.bisect_right(self._wall_transitions, wall) - 1]
+        )
+
+    def to_datetime(self, timestamp: int | float) -> datetime:
+        """Convert a UNIX timestamp to a local datetime.
+
+        Args:
+            timestamp (int | float): the UNIX timestamp, in seconds
+
+        Returns:
+            datetime: the datetime, with a fixed-offset timezone
+        """
+        return datetime.fromtimestamp(timestamp, _zone(self.utcoffset(timestamp)))
+
+    def to_timestamp(self, dt: datetime) -> int:
+        """Convert a datetime to a UNIX timestamp.
+        Naive datetimes and datetimes in the table timezone are
+        considered local times.
+
+        Args:
+            dt (datetime): the datetime to convert
+
+        Returns:
+            int: the UNIX timestamp, in seconds
+        """
+        if dt.tzinfo is None or dt.tzinfo is self.tz:
+            return self.wall_to_timestamp(
+                (dt.replace(tzinfo=None) - _UNIX_EPOCH) // timedelta(seconds=1)
+            )
+        return int(dt.timestamp())
+
+    def utcoffsets(self, timestamps: np.ndarray) -> np.ndarray:
+        """Return the UTC offsets of an array of timestamps.
+
+        Args:
+            timestamps (np.ndarray): the UNIX timestamps, in seconds
+
+        Returns:
+            np.ndarray: the offsets, in seconds (int64)
+        """
+        timestamps = np.asarray(timestamps, dtype="int64")
+        index: np.ndarray = (
+            np.searchsorted(self._transitions_array, timestamps, side="right") - 1
+        )
+        offsets: np.ndarray = self._offsets_array[np.maximum(index, 0)]
+
+        outside: np.ndarray = (timestamps < self._lower) | (timestamps >= self._upper)
+        if outside.any():
+            offsets[outside] = [self._probe(int(ts)) for ts in timestamps[outside]]
+        return offsets
+
+
+@functools.cache
+def _zone(offset: int) -> timezone:
+    """Return a (cached) fixed-offset timezone."""
+    return timezone(timedelta(seconds=offset))
+
+
+@functools.cache
+def table() -> TransitionTable:
+    """Return the transition table of the local timezone (TIMEZONE).
+    The table is built on the first call.
+
+    Returns:
+        TransitionTable: the table
+    """
+    return TransitionTable(TIMEZONE)
+
+
+def to_datetime(timestamp: int | float | None) -> datetime | None:
+    """Convert a UNIX timestamp in seconds to a datetime in the local timezone.
+
+    Args:
+        timestamp (int | float | None): the timestamp to convert
+
+    Returns:
+        datetime | None: the datetime, None if None is passed
+    """
+    if timestamp is None:
+        return None
+    return table().to_datetime(timestamp)
+
+
+def to_timestamp(dt: datetime | None) -> int | None:
+    """Convert a datetime to a UNIX timestamp in seconds.
+    Naive datetimes are considered in the local timezone.
+
+    Args:
+        dt (datetime | None): the datetime to convert
+
+    Returns:
+        int | None: the timestamp, None if None is passed
+    """
+    if dt is None:
+        return None
+    return table().to_timestamp(dt)
+
+
+def localize(dt: datetime) -> datetime:
+    """Attach the local timezone to a naive datetime.
+
+    Args:
+        dt (datetime): the naive local datetime
+
+    Returns:
+        datetime: the datetime, with a fixed-offset timezone
+    """
+    return table().to_datetime(table().to_timestamp(dt))
+
+
+def hour(timestamp: int) -> int:
+    """Return the local hour of a UNIX timestamp.
+
+    Args:
+        timestamp (int): the timestamp, in seconds
+
+    Returns:
+        int: the hour (0-23)
+    """
+    return (timestamp + table().utcoffset(timestamp)) // 3600 % 24
+
+
+def add_days(timestamp: int, days: int) -> int:
+    """Move a UNIX timestamp by some days, keeping the local time
+    (as adding a timedelta to an aware datetime does).
+
+    Args:
+        timestamp (int): the timestamp, in seconds
+        days (int): the number of days to add
+
+    Returns:
+        int: the moved timestamp
+    """
+    return table().wall_to_timestamp(
+        timestamp + table().utcoffset(timestamp) + days * 86400
+    )
+
+
+def _offset_suffix(offset: int) -> str:
+    """Format a UTC offset as datetime.isoformat() does (e.g. +02:00)."""
+    return datetime(2000, 1, 1, tzinfo=_zone(offset)).isoformat()[19:]
+
+
+def _timestamps(values: t.Iterable[t.Any]) -> t.Tuple[np.ndarray, np.ndarray]:
+    """Return an array of timestamps (missing ones as zero) and the missing mask."""
+    array: np.ndarray = np.asarray(
+        values if isinstance(values, np.ndarray) else list(values), dtype="float64"
+    )
+    missing: np.ndarray = np.isnan(array)
+    return np.where(missing, 0, array).astype("int64"), missing
+
+
+def isoformat(timestamps: t.Iterable[int | float | None]) -> np.ndarray:
+    """Format UNIX timestamps as ISO 8601 local datetimes, as
+    datetime.isoformat() does (e.g. 2023-05-01T06:00:00+02:00).
+
+    Args:
+        timestamps (t.Iterable[int | float | None]): the timestamps, in seconds;
+            None or NaN for missing values
+
+    Returns:
+        np.ndarray: the strings (object array), None for missing values
+    """
+    seconds, missing = _timestamps(timestamps)
+    if len(seconds) == 0:
+        return np.array([], dtype=object)
+
+    offsets: np.ndarray = table().utcoffsets(seconds)
+    walls: np.ndarray = np.datetime_as_string(
+        (seconds + offsets).astype("datetime64[s]"), unit="s"
+    )
+    unique_offsets, inverse = np.unique(offsets, return_inverse=True)
+    suffixes: np.ndarray = np.array([_offset_suffix(int(o)) for o in unique_offsets])
+
+    formatted: np.ndarray = np.char.add(walls, suffixes[inverse]).astype(object)
+    formatted[missing] = None
+    return formatted
+
+
+def parse_isoformat(strings: t.Iterable[t.Any]) -> np.ndarray:
+    """Parse ISO 8601 datetimes, as written by isoformat().
+    Each distinct string is parsed once.
+
+    Args:
+        strings (t.Iterable[t.Any]): the strings to parse;
+            missing values (not strings) and invalid strings are ignored
+
+    Returns:
+        np.ndarray: the datetimes (object array), None if not parsed
+    """
+    values: list[t.Any] = list(strings)
+    parsed: dict[str, datetime | None] = dict()
+    for value in set(v for v in values if isinstance(v, str)):
+        try:
+            parsed[value] = datetime.fromisoformat(value)
+        except ValueError:
+            parsed[value] = None
+
+    datetimes: np.ndarray = np.empty(len(values), dtype=object)
+    datetimes[:] = [parsed.get(v) if isinstance(v, str) else None for v in values]
+    return datetimes
+
+
+def to_datetimes(timestamps: t.Iterable[int | float | None]) -> np.ndarray:
+    """Convert UNIX timestamps to local datetimes.
+    Each distinct timestamp is converted once.
+
+    Args:
+        timestamps (t.Iterable[int | float | None]): the timestamps, in seconds;
+            None or NaN for missing values
+
+    Returns:
+        np.ndarray: the datetimes (object array), None for missing values
+    """
+    seconds, missing = _timestamps(timestamps)
+    unique, inverse = np.unique(seconds, return_inverse=True)
+    offsets: np.ndarray = table().utcoffsets(unique)
+
+    converted: np.ndarray = np.empty(len(unique), dtype=object)
+    converted[:] = [
+        datetime.fromtimestamp(ts, _zone(offset))
+        for ts, offset in zip(unique.tolist(), offsets.tolist())
+    ]
+    datetimes: np.ndarray = converted[inverse]
+    datetimes[missing] = None
+    return datetimes
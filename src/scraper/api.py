@@ -15,37 +15,228 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import asyncio
+import hashlib
 import json
+import os
+import re
 import typing as t
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 
 import requests
 from requests.adapters import HTTPAdapter, Retry
 
+import src.localtime as localtime
+import src.scraper.metrics as metrics
+import src.scraper.tracing as tracing
 import src.scraper.train as tr
 from src import types
 from src.const import TIMEZONE, TIMEZONE_GMT
-from src.scraper.exceptions import BadRequestException
+from src.scraper.archive import ResponseArchive
+from src.scraper.exceptions import (
+    BadRequestException,
+    CircuitOpenException,
+    ThrottledException,
+)
+from src.scraper.throttle import CircuitBreaker, RateLimiter
+
+# Maximum number of pooled connections per host
+POOL_MAXSIZE: int = 64
+
+# Response statuses returned by the upstream when it is throttling or unavailable
+THROTTLE_STATUSES: list[int] = [403, 500, 502, 503, 504]
+
+# Maximum number of attempts of a throttled request
+MAX_ATTEMPTS: int = 5
+
+# Fields identifying a train in the raw departure and arrival boards
+_BOARD_NUMBER_RE: re.Pattern = re.compile(r'"numeroTreno"\s*:\s*(\d+)')
+_BOARD_ORIGIN_RE: re.Pattern = re.compile(r'"codOrigine"\s*:\s*"([^"]*)"')
+_BOARD_DATE_RE: re.Pattern = re.compile(r'"dataPartenzaTreno"\s*:\s*(\d+)')
+_BOARD_ENTRY_RE: re.Pattern = re.compile(r'"numeroTreno"\s*:')
+
+BoardKey = t.Tuple[int, str, int]
+
+
+def _retry_after(response: requests.Response) -> float | None:
+    """Parse the Retry-After header of a response, if present.
+
+    Args:
+        response (requests.Response): the considered response
+
+    Returns:
+        float | None: the number of seconds to wait
+    """
+    value: str | None = response.headers.get("Retry-After")
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(
+            0.0,
+            (parsedate_to_datetime(value) - datetime.now(tz=TIMEZONE)).total_seconds(),
+        )
+    except (TypeError, ValueError):
+        return None
+
+
+def new_session(*prefixes: str) -> requests.Session:
+    """Return a requests session with auto-retry and exponential backoff
+    on connection errors. The connection pool is sized for concurrent requests
+    (see ViaggiaTrenoAPI._raw_request_async).
+
+    Args:
+        *prefixes (str): the URL prefixes to mount the adapter for
+
+    Returns:
+        requests.Session: the new session
+    """
+    session = requests.Session()
+    for prefix in prefixes:
+        session.mount(
+            prefix,
+            HTTPAdapter(
+                pool_maxsize=POOL_MAXSIZE,
+                max_retries=Retry(
+                    total=10,
+                    read=5,
+                    backoff_factor=0.2,
+                ),
+            ),
+        )
+    return session
+
+
+def _throttled_get(
+    session: requests.Session,
+    limiter: RateLimiter,
+    breaker: CircuitBreaker,
+    api: str,
+    method: str,
+    url: str,
+) -> requests.Response:
+    """Perform a GET request paced by a rate limiter and guarded by a circuit breaker.
+    Throttled responses (see THROTTLE_STATUSES) are retried up to MAX_ATTEMPTS times.
+
+    Args:
+        session (requests.Session): the session to use
+        limiter (RateLimiter): the rate limiter of the API
+        breaker (CircuitBreaker): the circuit breaker of the API method
+        api (str): the API name, used in the metrics
+        method (str): the API method, used in error reporting and in the metrics
+        url (str): the URL to request
+
+    Raises:
+        CircuitOpenException: if the circuit breaker is open
+        ThrottledException: if every attempt was throttled
+
+    Returns:
+        requests.Response: the first response which was not throttled
+    """
+    if not breaker.allow():
+        raise CircuitOpenException(method)
+
+    # Every outcome is recorded, also unexpected exceptions:
+    # a half-open breaker would never let another probe through otherwise
+    succeeded: bool = False
+    try:
+        timer = metrics.REGISTRY.timer("request_seconds", api=api, method=method)
+        with tracing.span("api.request", api=api, method=method) as span, timer:
+            for attempt in range(MAX_ATTEMPTS):
+                if attempt > 0:
+                    metrics.REGISTRY.inc(
+                        "request_retries_total", api=api, method=method
+                    )
+                limiter.acquire()
+                try:
+                    response: requests.Response = session.get(url)
+                except requests.RequestException:
+                    metrics.REGISTRY.inc(
+                        "requests_total", api=api, method=method, status="error"
+                    )
+                    raise
+
+                metrics.REGISTRY.inc(
+                    "requests_total",
+                    api=api,
+                    method=method,
+                    status=response.status_code,
+                )
+                span.set(status=response.status_code, attempts=attempt + 1)
+                if response.status_code not in THROTTLE_STATUSES:
+                    size: int = len(response.content)
+                    metrics.REGISTRY.inc(
+                        "response_bytes_total", size, api=api, method=method
+                    )
+                    span.set(bytes=size)
+                    limiter.on_success()
+                    succeeded = True
+                    return response
+
+                limiter.on_throttle(_retry_after(response))
+
+        raise ThrottledException(method, response.url, response.status_code)
+    finally:
+        if succeeded:
+            breaker.on_success()
+        else:
+            breaker.on_failure()
 
 
 class ViaggiaTrenoAPI:
-    BASE_URL: str = "http://www.viaggiatreno.it/infomobilita/resteasy/viaggiatreno/"
-
-    # Initialize requests session with auto-retry and exponential backoff
-    _session: requests.Session = requests.Session()
-    _session.mount(
-        "http://",
-        HTTPAdapter(
-            max_retries=Retry(
-                total=10,
-                read=5,
-                status=10,
-                status_forcelist=[403, 500, 502, 503, 504],
-                backoff_factor=0.2,
-            )
-        ),
+    # The base URL can be changed (e.g. to a stand-in server, see standin.py)
+    # with the VIAGGIATRENO_BASE_URL environment variable
+    BASE_URL: str = os.getenv(
+        "VIAGGIATRENO_BASE_URL",
+        "http://www.viaggiatreno.it/infomobilita/resteasy/viaggiatreno/",
     )
 
+    # Requests session with auto-retry on connection errors (see new_session),
+    # while throttled responses are handled by the rate limiter
+    # and the per-method circuit breakers (see _throttled_get)
+    _SESSION_PREFIXES: t.Tuple[str, ...] = ("http://",)
+    _session: requests.Session = new_session(*_SESSION_PREFIXES)
+
+    _limiter: RateLimiter = RateLimiter()
+    _breakers: dict[str, CircuitBreaker] = dict()
+
+    # If set, successful responses are archived (see ResponseArchive);
+    # if _replay is set, responses are read from it instead (no requests)
+    _archive: ResponseArchive | None = None
+    _replay: ResponseArchive | None = None
+
+    @classmethod
+    def _breaker(cls, method: str) -> CircuitBreaker:
+        """Return the circuit breaker of an API method."""
+        return cls._breakers.setdefault(method, CircuitBreaker())
+
+    @classmethod
+    def reset_session(cls) -> None:
+        """Replace the requests session, e.g. in a forked process:
+        pooled connections must not be shared with the parent."""
+        cls._session = new_session(*cls._SESSION_PREFIXES)
+
+    @classmethod
+    def throttle_status(cls) -> dict[str, t.Any]:
+        """Return the current rate limit and the state of the circuit breakers.
+
+        Returns:
+            dict[str, t.Any]: the current rate (requests per second)
+            and the breaker state of every API method called so far
+        """
+        return {
+            "rate": round(cls._limiter.rate, 2),
+            "breakers": {
+                method: breaker.state.value for method, breaker in cls._breakers.items()
+            },
+        }
+
     @classmethod
     def _raw_request(cls, method: str, *parameters: t.Any) -> str:
         """Perform a HTTP request to ViaggiaTreno API and return a raw string,
@@ -57,35 +248,122 @@ class ViaggiaTrenoAPI:
 
         Raises:
             BadRequestException: if the response is not ok
+            CircuitOpenException: if the method is failing and the request was not performed,
+                or if the request was still throttled after retrying (ThrottledException)
 
         Returns:
             str: the raw response from the API
         """
-        response: requests.Response = cls._session.get(
+        url: str = (
             f"{ViaggiaTrenoAPI.BASE_URL}{method}/"
             f"{'/'.join(map(lambda p: str(p), parameters))}"
         )
-
-        if response.status_code != 200 or "Error" in response.text:
-            raise BadRequestException(
-                url=response.url,
-                status_code=response.status_code,
-                response=response.text,
+        text: str
+        if cls._replay is not None:
+            text = cls._replay.replay(cls.__name__, method, parameters)
+        else:
+            response: requests.Response = _throttled_get(
+                cls._session,
+                cls._limiter,
+                cls._breaker(method),
+                cls.__name__,
+                method,
+                url,
             )
 
-        return response.text
+            # Unsuccessful answers (e.g. 204 for unknown trains) are archived too
+            if cls._archive is not None:
+                cls._archive.add(
+                    cls.__name__,
+                    method,
+                    parameters,
+                    response.text,
+                    response.status_code,
+                )
+            if response.status_code != 200:
+                raise BadRequestException(
+                    url=response.url,
+                    status_code=response.status_code,
+                    response=response.text,
+                )
+            text = response.text
+
+        if "Error" in text:
+            raise BadRequestException(url=url, status_code=200, response=text)
+        return text
+
+    @classmethod
+    async def _raw_request_async(cls, method: str, *parameters: t.Any) -> str:
+        """Coroutine version of _raw_request.
+
+        The blocking request is performed in a worker thread of the running
+        event loop executor, whose size bounds the number of requests in flight.
+
+        Args:
+            method (str): the method to be called
+            parameters (tuple[str]): a list of parameters
+
+        Raises:
+            BadRequestException: if the response is not ok
+
+        Returns:
+            str: the raw response from the API
+        """
+        return await asyncio.to_thread(cls._raw_request, method, *parameters)
 
     @staticmethod
-    def _decode_json(string: str) -> types.JSONType:
+    def _decode_json(
+        string: str, method: str, api: str = "ViaggiaTrenoAPI"
+    ) -> types.JSONType:
         """Decode a JSON string.
 
         Args:
             string (str): the string to decode
+            method (str): the API method of the response, used in the metrics
+            api (str, optional): the API name of the response, used in the metrics
 
         Returns:
             types.JSONType: the decoded JSON value
         """
-        return json.loads(string)
+        timer = metrics.REGISTRY.timer("decode_seconds", api=api, method=method)
+        with tracing.span("json.decode", bytes=len(string)), timer:
+            return json.loads(string)
+
+    @staticmethod
+    def _fingerprint(string: str) -> bytes:
+        """Return a short digest of a raw response, to detect unchanged responses.
+
+        Args:
+            string (str): the raw response
+
+        Returns:
+            bytes: the digest
+        """
+        return hashlib.blake2b(string.encode(), digest_size=16).digest()
+
+    @staticmethod
+    def _board_keys(string: str) -> t.List[BoardKey] | None:
+        """Extract the trains shown in a raw departure or arrival board,
+        without decoding it.
+
+        Args:
+            string (str): the raw board
+
+        Returns:
+            t.List[BoardKey] | None: the number, origin code and departing
+            midnight timestamp of each train, None if the board can't be pre-scanned
+        """
+        numbers: list[str] = _BOARD_NUMBER_RE.findall(string)
+        origins: list[str] = _BOARD_ORIGIN_RE.findall(string)
+        dates: list[str] = _BOARD_DATE_RE.findall(string)
+        entries: int = len(_BOARD_ENTRY_RE.findall(string))
+        if not len(numbers) == len(origins) == len(dates) == entries:
+            # Missing or unexpected values: decode the board instead
+            return None
+        return [
+            (int(number), origin, int(date))
+            for number, origin, date in zip(numbers, origins, dates)
+        ]
 
     @staticmethod
     def _to_datetime(time: int | None) -> datetime | None:
@@ -101,26 +379,42 @@ class ViaggiaTrenoAPI:
         if not time:
             return None
 
-        return datetime.fromtimestamp(time / 1000, tz=TIMEZONE)
+        return localtime.to_datetime(time / 1000)
+
+    @staticmethod
+    def _board_time(when: datetime | None = None) -> str:
+        """Format the time a departure or arrival board is requested at.
+
+        Args:
+            when (datetime | None, optional): the board time, defaults to now
+
+        Returns:
+            str: the time parameter of the 'partenze' and 'arrivi' API calls
+        """
+        if when is None:
+            when = datetime.now(tz=TIMEZONE_GMT)
+        return when.astimezone(TIMEZONE_GMT).strftime("%a %b %d %Y %H:%M:%S %Z%z")
 
     @staticmethod
     def _station_departures_or_arrivals(
-        kind: str, station_code: str
+        kind: str, station_code: str, when: datetime | None = None
     ) -> t.List["tr.Train"]:
         """Helper function to Station.departures and Station.arrivals methods.
 
         Args:
             kind (str): either 'partenze' (departures) or 'arrivi' (arrivals)
             station_code (str): the code of the considered station
+            when (datetime | None, optional): the board time, defaults to now
 
         Returns:
             t.List[Train]: a list of trains departing o arriving to the station
         """
         assert kind in ["partenze", "arrivi"]
 
-        now: str = datetime.now(tz=TIMEZONE_GMT).strftime("%a %b %d %Y %H:%M:%S %Z%z")
-        raw_trains: str = ViaggiaTrenoAPI._raw_request(kind, station_code, now)
-        trains: types.JSONType = ViaggiaTrenoAPI._decode_json(raw_trains)
+        raw_trains: str = ViaggiaTrenoAPI._raw_request(
+            kind, station_code, ViaggiaTrenoAPI._board_time(when)
+        )
+        trains: types.JSONType = ViaggiaTrenoAPI._decode_json(raw_trains, kind)
         return list(
             map(
                 lambda t: tr.Train._from_station_departures_arrivals(t),
@@ -128,27 +422,118 @@ class ViaggiaTrenoAPI:
             )
         )
 
+    @staticmethod
+    async def _station_board_async(
+        kind: str, station_code: str, when: datetime | None = None
+    ) -> types.JSONType:
+        """Retrieve the raw departure or arrival board of a station.
 
-class TrenordAPI:
-    BASE_URL: str = "https://admin.trenord.it/store-management-api/mia/"
+        Args:
+            kind (str): either 'partenze' (departures) or 'arrivi' (arrivals)
+            station_code (str): the code of the considered station
+            when (datetime | None, optional): the board time, defaults to now
 
-    TRENORD_CLIENT_CODE: int = 63
+        Returns:
+            types.JSONType: the board entries, one for each train
+        """
+        raw_trains: str = await ViaggiaTrenoAPI._station_board_raw_async(
+            kind, station_code, when
+        )
+        return ViaggiaTrenoAPI._decode_json(raw_trains, kind)
+
+    @staticmethod
+    async def _station_board_raw_async(
+        kind: str, station_code: str, when: datetime | None = None
+    ) -> str:
+        """Retrieve the undecoded departure or arrival board of a station.
+
+        Args:
+            kind (str): either 'partenze' (departures) or 'arrivi' (arrivals)
+            station_code (str): the code of the considered station
+            when (datetime | None, optional): the board time, defaults to now
+
+        Returns:
+            str: the raw API response
+        """
+        assert kind in ["partenze", "arrivi"]
+
+        return await ViaggiaTrenoAPI._raw_request_async(
+            kind, station_code, ViaggiaTrenoAPI._board_time(when)
+        )
+
+    @staticmethod
+    async def _station_departures_or_arrivals_async(
+        kind: str, station_code: str, when: datetime | None = None
+    ) -> t.List["tr.Train"]:
+        """Coroutine version of _station_departures_or_arrivals.
+
+        Args:
+            kind (str): either 'partenze' (departures) or 'arrivi' (arrivals)
+            station_code (str): the code of the considered station
+            when (datetime | None, optional): the board time, defaults to now
 
-    # Initialize requests session with auto-retry and exponential backoff
-    _session: requests.Session = requests.Session()
-    _session.mount(
-        "https://",
-        HTTPAdapter(
-            max_retries=Retry(
-                total=10,
-                read=5,
-                status=5,
-                status_forcelist=[403, 500, 502, 503, 504],
-                backoff_factor=0.2,
+        Returns:
+            t.List[Train]: a list of trains departing o arriving to the station
+        """
+        trains: types.JSONType = await ViaggiaTrenoAPI._station_board_async(
+            kind, station_code, when
+        )
+        return list(
+            await asyncio.gather(
+                *map(
+                    lambda t: tr.Train._from_station_departures_arrivals_async(t),
+                    trains,
+                )
             )
-        ),
+        )
+
+
+class TrenordAPI:
+    # See ViaggiaTrenoAPI.BASE_URL (TRENORD_BASE_URL environment variable)
+    BASE_URL: str = os.getenv(
+        "TRENORD_BASE_URL", "https://admin.trenord.it/store-management-api/mia/"
     )
 
+    TRENORD_CLIENT_CODE: int = 63
+
+    # Requests session with auto-retry on connection errors (see new_session).
+    # Plain HTTP is used by stand-in servers (see BASE_URL)
+    _SESSION_PREFIXES: t.Tuple[str, ...] = ("https://", "http://")
+    _session: requests.Session = new_session(*_SESSION_PREFIXES)
+
+    _limiter: RateLimiter = RateLimiter()
+    _breakers: dict[str, CircuitBreaker] = dict()
+
+    # See ViaggiaTrenoAPI._archive and ViaggiaTrenoAPI._replay
+    _archive: ResponseArchive | None = None
+    _replay: ResponseArchive | None = None
+
+    @classmethod
+    def _breaker(cls, method: str) -> CircuitBreaker:
+        """Return the circuit breaker of an API method."""
+        return cls._breakers.setdefault(method, CircuitBreaker())
+
+    @classmethod
+    def reset_session(cls) -> None:
+        """Replace the requests session, e.g. in a forked process:
+        pooled connections must not be shared with the parent."""
+        cls._session = new_session(*cls._SESSION_PREFIXES)
+
+    @classmethod
+    def throttle_status(cls) -> dict[str, t.Any]:
+        """Return the current rate limit and the state of the circuit breakers.
+
+        Returns:
+            dict[str, t.Any]: the current rate (requests per second)
+            and the breaker state of every API method called so far
+        """
+        return {
+            "rate": round(cls._limiter.rate, 2),
+            "breakers": {
+                method: breaker.state.value for method, breaker in cls._breakers.items()
+            },
+        }
+
     @classmethod
     def _raw_request(cls, method: str, *parameters: t.Any) -> str:
         """Perform a HTTP request to Trenord API and return a raw string,
@@ -160,21 +545,62 @@ class TrenordAPI:
 
         Raises:
             BadRequestException: if the response is not ok
+            CircuitOpenException: if the method is failing and the request was not performed,
+                or if the request was still throttled after retrying (ThrottledException)
 
         Returns:
             str: the raw response from the API
         """
-
-        response: requests.Response = cls._session.get(
+        url: str = (
             f"{TrenordAPI.BASE_URL}{method}/"
             f"{'/'.join(map(lambda p: str(p), parameters))}"
         )
-
-        if response.status_code != 200 or "Error" in response.text:
-            raise BadRequestException(
-                url=response.url,
-                status_code=response.status_code,
-                response=response.text,
+        text: str
+        if cls._replay is not None:
+            text = cls._replay.replay(cls.__name__, method, parameters)
+        else:
+            response: requests.Response = _throttled_get(
+                cls._session,
+                cls._limiter,
+                cls._breaker(method),
+                cls.__name__,
+                method,
+                url,
             )
 
-        return response.text
+            # Unsuccessful answers (e.g. 204 for unknown trains) are archived too
+            if cls._archive is not None:
+                cls._archive.add(
+                    cls.__name__,
+                    method,
+                    parameters,
+                    response.text,
+                    response.status_code,
+                )
+            if response.status_code != 200:
+                raise BadRequestException(
+                    url=response.url,
+                    status_code=response.status_code,
+                    response=response.text,
+                )
+            text = response.text
+
+        if "Error" in text:
+            raise BadRequestException(url=url, status_code=200, response=text)
+        return text
+
+    @classmethod
+    async def _raw_request_async(cls, method: str, *parameters: t.Any) -> str:
+        """Coroutine version of _raw_request.
+
+        Args:
+            method (str): the method to be called
+            parameters (tuple[str]): a list of parameters
+
+        Raises:
+            BadRequestException: if the response is not ok
+
+        Returns:
+            str: the raw response from the API
+        """
+        return await asyncio.to_thread(cls._raw_request, method, *parameters)
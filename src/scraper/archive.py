@@ -0,0 +1,227 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import json
+import os
+import pathlib
+import socket
+import threading
+import time
+import typing as t
+import zlib
+
+from src.scraper.exceptions import BadRequestException
+
+# zlib compression level of the archived responses
+COMPRESSION_LEVEL: int = 6
+
+# Name of the archive directory, in the directory of each day
+ARCHIVE_DIRNAME: str = "raw"
+
+
+class ArchiveEntry(t.NamedTuple):
+    """An archived API response.
+
+    Attributes:
+        time (float): the time the response has been received at (UNIX timestamp)
+        api (str): the API name, e.g. 'ViaggiaTrenoAPI'
+        method (str): the API method
+        parameters (t.Tuple[str, ...]): the method parameters
+        digest (str): the content address (blake2b hex digest) of the response
+        pack (str): the name of the pack file containing the response
+        offset (int): the position of the compressed response in the pack file
+        size (int): the size of the compressed response
+        status (int): the response status code
+    """
+
+    time: float
+    api: str
+    method: str
+    parameters: t.Tuple[str, ...]
+    digest: str
+    pack: str
+    offset: int
+    size: int
+    status: int = 200
+
+
+class ResponseArchive:
+    """A content-addressed archive of raw API responses, in a directory.
+
+    Responses are compressed and appended to pack files ('<writer>.pack');
+    each request is recorded in an index file ('<writer>.idx', JSON lines)
+    pointing to its response. Identical responses are stored once.
+    Every process writes its own files, so multiple processes (and hosts)
+    can share the same archive.
+
+    Attributes:
+        directory (pathlib.Path): the archive directory
+        writer (str): the name of the files written by this process
+        entries (list[ArchiveEntry]): the archived requests, in order of time
+    """
+
+    def __init__(self, directory: pathlib.Path, writer: str | None = None) -> None:
+        """Open an archive, loading its index.
+
+        Args:
+            directory (pathlib.Path): the archive directory, created on the first write
+            writer (str | None, optional): the name of the files written
+                by this process. Defaults to the host name and process id
+        """
+        self.directory: pathlib.Path = directory
+        self.writer: str = writer or f"{socket.gethostname()}-{os.getpid()}"
+        self.entries: list[ArchiveEntry] = list()
+
+        self._blobs: dict[str, ArchiveEntry] = dict()
+        self._latest: dict[t.Tuple[str, str, t.Tuple[str, ...]], ArchiveEntry] = dict()
+        self._lock = threading.Lock()
+        self._pack: t.BinaryIO | None = None
+        self._index: t.TextIO | None = None
+
+        for index_path in sorted(directory.glob("*.idx")):
+            with open(index_path, "r") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        # Truncated by a crash
+                        break
+                    raw: dict = json.loads(line)
+                    raw["parameters"] = tuple(raw["parameters"])
+                    self._add_entry(ArchiveEntry(**raw))
+        self.entries.sort(key=lambda entry: entry.time)
+
+    def _add_entry(self, entry: ArchiveEntry) -> None:
+        self.entries.append(entry)
+        self._blobs.setdefault(entry.digest, entry)
+
+        key = (entry.api, entry.method, entry.parameters)
+        latest: ArchiveEntry | None = self._latest.get(key)
+        if latest is None or latest.time <= entry.time:
+            self._latest[key] = entry
+
+    def add(
+        self,
+        api: str,
+        method: str,
+        parameters: t.Sequence[t.Any],
+        response: str,
+        status: int = 200,
+    ) -> None:
+        """Archive a response. Thread-safe.
+
+        Args:
+            api (str): the API name
+            method (str): the API method
+            parameters (t.Sequence[t.Any]): the method parameters
+            response (str): the raw response
+            status (int, optional): the response status code. Defaults to 200
+        """
+        data: bytes = response.encode()
+        digest: str = hashlib.blake2b(data, digest_size=16).hexdigest()
+
+        with self._lock:
+            if self._pack is None or self._index is None:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                self._pack = open(self.directory / f"{self.writer}.pack", "ab")
+                self._index = open(self.directory / f"{self.writer}.idx", "a")
+
+            blob: ArchiveEntry | None = self._blobs.get(digest)
+            if blob is not None:
+                pack, offset, size = blob.pack, blob.offset, blob.size
+            else:
+                compressed: bytes = zlib.compress(data, COMPRESSION_LEVEL)
+                pack, offset, size = self.writer, self._pack.tell(), len(compressed)
+                self._pack.write(compressed)
+                self._pack.flush()
+
+            entry = ArchiveEntry(
+                time=time.time(),
+                api=api,
+                method=method,
+                parameters=tuple(map(str, parameters)),
+                digest=digest,
+                pack=pack,
+                offset=offset,
+                size=size,
+                status=status,
+            )
+            self._index.write(json.dumps(entry._asdict()) + "\n")
+            self._index.flush()
+            self._add_entry(entry)
+
+    def read(self, entry: ArchiveEntry) -> str:
+        """Return an archived response.
+
+        Args:
+            entry (ArchiveEntry): the archived request
+
+        Returns:
+            str: the raw response
+        """
+        with open(self.directory / f"{entry.pack}.pack", "rb") as f:
+            f.seek(entry.offset)
+            return zlib.decompress(f.read(entry.size)).decode()
+
+    def latest(
+        self, api: str, method: str, parameters: t.Sequence[t.Any]
+    ) -> ArchiveEntry | None:
+        """Return the last archived response to a request.
+
+        Args:
+            api (str): the API name
+            method (str): the API method
+            parameters (t.Sequence[t.Any]): the method parameters
+
+        Returns:
+            ArchiveEntry | None: the archived request, None if never archived
+        """
+        return self._latest.get((api, method, tuple(map(str, parameters))))
+
+    def replay(self, api: str, method: str, parameters: t.Sequence[t.Any]) -> str:
+        """Return the last archived response to a request, as the API would.
+
+        Args:
+            api (str): the API name
+            method (str): the API method
+            parameters (t.Sequence[t.Any]): the method parameters
+
+        Raises:
+            BadRequestException: if the request has never been archived,
+                or if the archived response was not successful (e.g. HTTP 204)
+
+        Returns:
+            str: the raw response
+        """
+        entry: ArchiveEntry | None = self.latest(api, method, parameters)
+        if entry is None or entry.status != 200:
+            raise BadRequestException(
+                url=f"archive://{api}/{method}/{'/'.join(map(str, parameters))}",
+                status_code=entry.status if entry is not None else 204,
+                response=self.read(entry) if entry is not None else "",
+            )
+        return self.read(entry)
+
+    def close(self) -> None:
+        """Close the files written by this process."""
+        with self._lock:
+            for f in (self._pack, self._index):
+                if f is not None:
+                    f.close()
+            self._pack = self._index = None
+
+    def __len__(self) -> int:
+        return len(self.entries)
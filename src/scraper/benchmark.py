@@ -0,0 +1,257 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import itertools
+import json
+import os
+import pathlib
+import pickle
+import tempfile
+import time
+import typing as t
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+import src.scraper.main as scraper
+from src.benchmark import Result, measure
+from src.scraper.api import TrenordAPI, ViaggiaTrenoAPI
+from src.scraper.loop import DEFAULT_CONCURRENCY
+from src.scraper.standin import NetworkDay, StandInServer
+from src.scraper.station import Station
+from src.scraper.train import Train
+from src.scraper.train_stop import TrainStop
+from src.synthetic import station_cache
+
+# Recorded ViaggiaTreno and Trenord stops (see test_train_stop.py),
+# repeated to the benchmark scale
+FIXTURES_DIR: pathlib.Path = pathlib.Path(__file__).parent / "tests" / "data"
+
+# Request rate of the end-to-end benchmark, high enough for the run
+# to be bound by the scraper rather than by the rate limiter
+END_TO_END_MAX_RATE: float = 500.0
+
+
+class _Fixtures(t.NamedTuple):
+    stops: list[dict]
+    trenord_stops: list[dict]
+    intraday_stops: list[dict]
+    station_codes: set[str]
+
+
+def _fixtures() -> _Fixtures:
+    """Load the recorded stops: ViaggiaTreno ones, Trenord ones, and
+    the Trenord stops of a train departing before midnight and arriving after it."""
+    stops: list[dict] = list()
+    trenord_stops: list[dict] = list()
+    for path in sorted(FIXTURES_DIR.glob("train-stop_*.json")):
+        with open(path) as f:
+            stop: dict = json.load(f)
+        (trenord_stops if "station" in stop else stops).append(stop)
+    with open(FIXTURES_DIR / "train-stops_2647.json") as f:
+        intraday_stops: list[dict] = json.load(f)
+
+    station_codes: set[str] = {stop["id"] for stop in stops} | {
+        stop["station"].get("station_id")
+        or stop["actual_data"].get("actual_station_mir")
+        for stop in trenord_stops + intraday_stops
+    }
+    return _Fixtures(
+        stops, trenord_stops + intraday_stops, intraday_stops, station_codes
+    )
+
+
+def micro(scale: int, repeat: int = 5, seed: int = 0) -> list[Result]:
+    """Time the parsing and the pickling of trains and stops, on a synthetic
+    network day and on the recorded stops repeated to the same scale.
+
+    Args:
+        scale (int): the approximate number of trains
+        repeat (int, optional): the runs of each benchmark (the best one is kept)
+        seed (int, optional): the seed of the synthetic day
+
+    Returns:
+        list[Result]: the time per train or stop, and the pickled size of a train
+    """
+    network: NetworkDay = NetworkDay.synthetic(scale, seed=seed)
+    day: date = network.day
+    board: list[dict] = list(itertools.chain.from_iterable(network.boards.values()))
+    stops_count: int = sum(
+        len(details["fermate"]) for details in network.trains.values()
+    )
+    fixtures: _Fixtures = _fixtures()
+    raw_stops: list[dict] = list(
+        itertools.islice(itertools.cycle(fixtures.stops), stops_count)
+    )
+    trenord_stops: list[dict] = list(
+        itertools.islice(itertools.cycle(fixtures.trenord_stops), stops_count)
+    )
+
+    results: list[Result] = list()
+    with station_cache(network, fixtures.station_codes):
+        elapsed: float = measure(
+            lambda: [Train._from_station_departures_arrivals(e) for e in board],
+            repeat=repeat,
+        )
+        results.append(
+            Result("micro.train.from_board", elapsed / len(board) * 1e6, "us/train")
+        )
+
+        elapsed = measure(
+            lambda: [TrainStop._from_raw_data(stop) for stop in raw_stops],
+            repeat=repeat,
+        )
+        results.append(
+            Result("micro.train_stop.from_raw", elapsed / stops_count * 1e6, "us/stop")
+        )
+
+        elapsed = measure(
+            lambda: [TrainStop._from_trenord_raw_data(s, day) for s in trenord_stops],
+            repeat=repeat,
+        )
+        results.append(
+            Result(
+                "micro.train_stop.from_trenord",
+                elapsed / stops_count * 1e6,
+                "us/stop",
+            )
+        )
+
+        # Trains departing before midnight, whose stops after it must be moved
+        intraday_stops: list[dict] = fixtures.intraday_stops
+        origin: Station = Station.by_code(intraday_stops[0]["station"]["station_id"])
+        intraday: list[Train] = list()
+        for number in range(scale):
+            train = Train(number, origin, day)
+            train.stops = [
+                TrainStop._from_trenord_raw_data(stop, day) for stop in intraday_stops
+            ]  # type: ignore
+            intraday.append(train)
+        pickled_intraday: bytes = pickle.dumps(intraday)
+
+        def _reset_intraday() -> None:
+            intraday[:] = pickle.loads(pickled_intraday)
+
+        elapsed = measure(
+            lambda: [train._fix_intraday_datetimes() for train in intraday],
+            setup=_reset_intraday,
+            repeat=repeat,
+        )
+        results.append(
+            Result("micro.train.fix_intraday", elapsed / scale * 1e6, "us/train")
+        )
+
+        # Fetched trains, as saved in the datasets
+        trains: list[Train] = list()
+        for entry in board:
+            train = Train._from_station_departures_arrivals(entry)
+            train._update_details(network.trains[(entry["codOrigine"], train.number)])
+            trains.append(train)
+        pickled: bytes = pickle.dumps(trains)
+
+        elapsed = measure(lambda: pickle.dumps(trains), repeat=repeat)
+        results.append(
+            Result("micro.pickle.dumps", elapsed / len(trains) * 1e6, "us/train")
+        )
+        elapsed = measure(lambda: pickle.loads(pickled), repeat=repeat)
+        results.append(
+            Result("micro.pickle.loads", elapsed / len(trains) * 1e6, "us/train")
+        )
+        results.append(
+            Result("micro.pickle.size", len(pickled) / len(trains), "bytes/train")
+        )
+    return results
+
+
+def _scraper_run(directory: pathlib.Path, argv: list[str]) -> dict[str, t.Any]:
+    """Run the scraper in a directory (in a worker process), and return
+    its duration and the summary of the run (see export_metrics)."""
+    os.chdir(directory)
+    scraper.DATA_DIR.mkdir(parents=True, exist_ok=True)
+
+    parser = argparse.ArgumentParser()
+    scraper.register_args(parser)
+    args: argparse.Namespace = parser.parse_args(argv)
+
+    # Start at the maximum rate, instead of ramping up to it
+    for api in (ViaggiaTrenoAPI, TrenordAPI):
+        api._limiter.rate = args.max_rate
+
+    started: float = time.perf_counter()
+    scraper.main(args)
+    duration: float = time.perf_counter() - started
+
+    summary_path: pathlib.Path = next(scraper.RUNS_DIR.glob("*.json"))
+    with open(summary_path) as f:
+        return {"duration": duration, **json.load(f)}
+
+
+def end_to_end(
+    trains: int,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    shards: int = 1,
+    seed: int = 0,
+) -> list[Result]:
+    """Run the scraper (a whole run of the scraper command, in a worker process)
+    against a stand-in server serving a synthetic network day.
+
+    Args:
+        trains (int): the approximate number of trains of the day
+        concurrency (int, optional): the concurrency of the scraper
+        shards (int, optional): the worker processes of the scraper
+        seed (int, optional): the seed of the synthetic day
+
+    Returns:
+        list[Result]: the scraped trains per second and the requests per train
+    """
+    network: NetworkDay = NetworkDay.synthetic(trains, seed=seed)
+    server = StandInServer(network)
+    server.start()
+    try:
+        with tempfile.TemporaryDirectory() as directory, ProcessPoolExecutor(
+            max_workers=1
+        ) as executor:
+            summary: dict[str, t.Any] = executor.submit(
+                _scraper_run,
+                pathlib.Path(directory),
+                [
+                    "--viaggiatreno-url",
+                    server.viaggiatreno_url,
+                    "--trenord-url",
+                    server.trenord_url,
+                    "--concurrency",
+                    str(concurrency),
+                    "--shards",
+                    str(shards),
+                    "--max-rate",
+                    str(END_TO_END_MAX_RATE),
+                ],
+            ).result()
+    finally:
+        server.stop()
+
+    scraped: int = sum(summary["metrics"]["trains"].values())
+    requests: int = sum(summary["metrics"]["requests_total"].values())
+    return [
+        Result(
+            "scraper.trains_per_second",
+            scraped / summary["duration"],
+            "trains/s",
+            higher_is_better=True,
+        ),
+        Result("scraper.requests_per_train", requests / scraped, "req/train"),
+    ]
@@ -0,0 +1,312 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import contextlib
+import logging
+import pathlib
+import random
+import time
+import typing as t
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from src.scraper.dataset import load_dataset, save_dataset
+from src.scraper.lease import LeaseManager
+from src.scraper.loop import DEFAULT_CONCURRENCY, ScrapeLoop
+from src.scraper.schedule import StationStats, merge_station_stats, station_traffic
+from src.scraper.shard import ShardResult, is_newer, train_region
+from src.scraper.station import REGION_CODES, Station
+from src.scraper.store import rekey_trains
+from src.scraper.train import Train
+
+# Nodes started in the same round (e.g. by the same hourly cron schedule)
+# split the regions between them
+DEFAULT_ROUND_LENGTH: float = 3600.0
+
+# Resource name of the lease held while merging node results
+MERGE_RESOURCE: str = "merge"
+
+
+class Cluster:
+    """Coordinated scraping between multiple nodes sharing the daily data directory.
+
+    Work is partitioned by region: in every round, each region is a unit of work
+    claimed by a node with a lease (see LeaseManager). Each node saves
+    the result of a unit in its own file, which is later merged in the daily
+    dataset by the node holding the merge lease. Leases of dead nodes expire,
+    so their units can be claimed by other nodes.
+
+    Attributes:
+        node (str): the identifier of this node
+        today_path (pathlib.Path): the daily data directory
+        stations_path (pathlib.Path): the station cache file
+        stats_path (pathlib.Path | None): the station statistics file, if adaptive
+            polling is enabled
+        station_stats (dict[str, StationStats] | None): the station statistics
+        leases (LeaseManager): the lease manager
+    """
+
+    def __init__(
+        self,
+        node: str,
+        today_path: pathlib.Path,
+        stations_path: pathlib.Path,
+        stats_path: pathlib.Path | None = None,
+        lease_ttl: float = 600.0,
+        round_length: float = DEFAULT_ROUND_LENGTH,
+        clock: t.Callable[[], float] = time.time,
+    ) -> None:
+        """Initialize a new cluster node.
+
+        Args:
+            node (str): the identifier of this node
+            today_path (pathlib.Path): the daily data directory
+            stations_path (pathlib.Path): the station cache file
+            stats_path (pathlib.Path | None, optional): the station statistics file:
+                if given, departure boards are retrieved only when due
+            lease_ttl (float, optional): the lease duration, in seconds
+            round_length (float, optional): the round duration, in seconds
+            clock (t.Callable[[], float], optional): wall clock, used in tests
+        """
+        assert "." not in node and "/" not in node
+
+        self.node: str = node
+        self.today_path: pathlib.Path = today_path
+        self.stations_path: pathlib.Path = stations_path
+        self.stats_path: pathlib.Path | None = stats_path
+        self.station_stats: dict[str, StationStats] | None = None
+        self.round_length: float = round_length
+        self.leases: LeaseManager = LeaseManager(
+            today_path / "leases", node, ttl=lease_ttl, clock=clock
+        )
+        self._clock = clock
+
+        self._results_path: pathlib.Path = today_path / "nodes"
+        self._results_path.mkdir(exist_ok=True)
+
+    def _unit(self, round_id: int, region: int) -> str:
+        return f"{round_id}-region-{region:02d}"
+
+    def _done_path(self, unit: str) -> pathlib.Path:
+        return self.leases.directory / f"{unit}.done"
+
+    def _pending_results(self) -> list[pathlib.Path]:
+        return sorted(
+            self._results_path.glob("*.pickle"), key=lambda p: p.stat().st_mtime
+        )
+
+    def _load_result(self, path: pathlib.Path) -> ShardResult | None:
+        result: t.Any = load_dataset(path)
+        return ShardResult(*result) if result else None
+
+    def _merge(
+        self,
+        results: t.Iterable[ShardResult],
+        fetched_trains: dict[int, Train],
+        unfetched_trains: dict[int, Train],
+    ) -> None:
+        """Merge node results in the given train dicts, in the station cache
+        and in the station statistics."""
+        for result in results:
+            for train_hash, train in result.fetched_trains.items():
+                if is_newer(train, fetched_trains.get(train_hash)):
+                    fetched_trains[train_hash] = train
+                unfetched_trains.pop(train_hash, None)
+            for train_hash, train in result.unfetched_trains.items():
+                if train_hash not in fetched_trains and is_newer(
+                    train, unfetched_trains.get(train_hash)
+                ):
+                    unfetched_trains[train_hash] = train
+            Station._merge_cache(result.station_cache)
+            if self.station_stats is not None:
+                merge_station_stats(self.station_stats, result.station_stats or dict())
+
+    def load(self) -> t.Tuple[dict[int, Train], dict[int, Train]]:
+        """Load the daily dataset and the station statistics,
+        including the node results not merged yet.
+
+        Returns:
+            t.Tuple[dict[int, Train], dict[int, Train]]: fetched and unfetched trains
+        """
+        fetched_trains: dict[int, Train] = rekey_trains(
+            load_dataset(self.today_path / "trains.pickle")
+        )
+        unfetched_trains: dict[int, Train] = rekey_trains(
+            load_dataset(self.today_path / "unfetched.pickle")
+        )
+        if self.stats_path is not None:
+            self.station_stats = load_dataset(self.stats_path)
+        self._merge(
+            filter(None, map(self._load_result, self._pending_results())),
+            fetched_trains,
+            unfetched_trains,
+        )
+        return fetched_trains, unfetched_trains
+
+    def merge(self) -> bool:
+        """Merge the pending node results in the daily dataset,
+        if no other node is merging.
+
+        Returns:
+            bool: True if the results have been merged by this node
+        """
+        if not self.leases.acquire(MERGE_RESOURCE):
+            return False
+
+        try:
+            with self.leases.keep_alive(MERGE_RESOURCE):
+                pending: list[pathlib.Path] = self._pending_results()
+                fetched_trains, unfetched_trains = self.load()
+
+                save_dataset(self.stations_path, Station._cache)
+                if self.stats_path is not None:
+                    save_dataset(self.stats_path, self.station_stats)
+                save_dataset(self.today_path / "trains.pickle", fetched_trains)
+                save_dataset(self.today_path / "unfetched.pickle", unfetched_trains)
+
+                # Merging is idempotent: a crash before this point is harmless
+                for path in pending:
+                    path.unlink()
+        finally:
+            self.leases.release(MERGE_RESOURCE)
+
+        logging.info(
+            f"Merged {len(pending)} node results: {len(fetched_trains)} trains saved today"
+        )
+        return True
+
+    def run(
+        self,
+        stations: t.Iterable[Station],
+        concurrency: int = DEFAULT_CONCURRENCY,
+        deadline: float | None = None,
+        arrival_boards: bool = False,
+        board_slices: t.Sequence[datetime | None] = (None,),
+    ) -> list[int]:
+        """Scrape the regions claimed by this node in the current round,
+        then merge the results.
+
+        Units are claimed in a node-specific order to reduce contention.
+        A second pass takes over the expired units of dead nodes.
+        No unit is claimed after the deadline.
+
+        Args:
+            stations (t.Iterable[Station]): the stations to retrieve departures from
+            concurrency (int, optional): the maximum number of concurrent requests
+            deadline (float | None, optional): no job is started after this time
+                (time.monotonic())
+            arrival_boards (bool, optional): if True, check the arrival boards
+                of the destinations before fetching the unfetched trains
+            board_slices (t.Sequence[datetime | None], optional): the times
+                the departure boards are retrieved at. Defaults to now only
+
+        Returns:
+            list[int]: the regions processed by this node
+        """
+        round_id: int = int(self._clock() // self.round_length)
+        fetched_trains, unfetched_trains = self.load()
+        traffic: Counter[str] = station_traffic(fetched_trains.values())
+
+        region_stations: dict[int, list[Station]] = defaultdict(list)
+        for station in stations:
+            if station.region_code in REGION_CODES:
+                region_stations[station.region_code].append(station)
+            else:
+                region_stations[REGION_CODES[0]].append(station)
+
+        regions: list[int] = list(REGION_CODES)
+        random.Random(self.node).shuffle(regions)
+
+        processed: list[int] = list()
+        for _ in range(2):
+            for region in regions:
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+
+                unit: str = self._unit(round_id, region)
+                if self._done_path(unit).exists() or not self.leases.acquire(unit):
+                    continue
+
+                try:
+                    with self.leases.keep_alive(unit):
+                        self._run_unit(
+                            unit,
+                            region,
+                            region_stations[region],
+                            fetched_trains,
+                            unfetched_trains,
+                            traffic,
+                            concurrency,
+                            deadline,
+                            arrival_boards,
+                            board_slices,
+                        )
+                finally:
+                    self.leases.release(unit)
+                processed.append(region)
+
+        logging.info(f"Node {self.node} processed regions {processed}")
+        self.merge()
+        return processed
+
+    def _run_unit(
+        self,
+        unit: str,
+        region: int,
+        stations: list[Station],
+        fetched_trains: dict[int, Train],
+        unfetched_trains: dict[int, Train],
+        traffic: Counter[str],
+        concurrency: int,
+        deadline: float | None,
+        arrival_boards: bool,
+        board_slices: t.Sequence[datetime | None],
+    ) -> None:
+        """Scrape a region and save the result in a node result file.
+        The traffic counters are updated with the trains fetched in the region."""
+        logging.info(f"Node {self.node} is processing unit {unit}")
+
+        unit_fetched: dict[int, Train] = dict()
+        unit_unfetched: dict[int, Train] = {
+            train_hash: train
+            for train_hash, train in unfetched_trains.items()
+            if train_region(train) == region
+        }
+        loop = ScrapeLoop(
+            unit_fetched,
+            unit_unfetched,
+            concurrency=concurrency,
+            known_trains=fetched_trains.keys() | unfetched_trains.keys(),
+            traffic=traffic,
+            deadline=deadline,
+            arrival_boards=arrival_boards,
+            station_stats=self.station_stats,
+            board_slices=board_slices,
+        )
+        loop.run(stations)
+
+        result = ShardResult(
+            unit_fetched, unit_unfetched, Station._cache, self.station_stats
+        )
+        save_dataset(self._results_path / f"{unit}.{self.node}.pickle", result)
+        if not loop.skipped:
+            # An interrupted unit can be claimed again in this round
+            with contextlib.suppress(FileExistsError):
+                self._done_path(unit).touch(exist_ok=False)
+
+        # Make the results visible to the next units of this node
+        self._merge([result], fetched_trains, unfetched_trains)
@@ -0,0 +1,375 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import functools
+import json
+import logging
+import pathlib
+import signal
+import threading
+import time
+import typing as t
+from collections import Counter
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import src.scraper.main as scraper
+import src.scraper.metrics as metrics
+from src.const import TIMEZONE
+from src.scraper.api import TrenordAPI, ViaggiaTrenoAPI
+from src.scraper.archive import ResponseArchive
+from src.scraper.dataset import load_dataset, save_dataset
+from src.scraper.loop import ScrapeLoop
+from src.scraper.schedule import StationStats, board_slices, deadline, expected_arrival
+from src.scraper.station import Station
+from src.scraper.store import Store, open_store
+from src.scraper.train import Train
+
+# Time between the starts of two rounds, in seconds
+DEFAULT_INTERVAL: float = 900.0
+
+# The status endpoint only listens on the loopback interface
+STATUS_HOST: str = "127.0.0.1"
+DEFAULT_STATUS_PORT: int = 8765
+
+
+def _isoformat(dt: datetime | None) -> str | None:
+    return dt.isoformat() if dt is not None else None
+
+
+class ScraperDaemon:
+    """Long-running scraper.
+
+    The datasets of the current day, the station cache and the HTTP connection
+    pools are kept in memory between rounds; the datasets are saved after
+    every round, and the day datasets are switched at the day change.
+    The state of the network and of the current round is served as JSON
+    by a local HTTP endpoint (see StatusServer).
+
+    Attributes:
+        args (argparse.Namespace): the scraper command line arguments
+        day (date | None): the current scraping day
+        day_path (pathlib.Path | None): the directory of the current day
+        fetched_trains (t.Mapping[int, Train]): trains with no more data to fetch
+        unfetched_trains (dict[int, Train]): trains to fetch again in the next rounds
+        traffic (Counter[str]): the departures of the fetched trains from each station
+        station_stats (dict[str, StationStats] | None): the polling statistics
+        rounds (int): the number of completed rounds
+        last_round (dict[str, t.Any] | None): a summary of the last round
+        next_round (datetime | None): the start time of the next round
+        loop (ScrapeLoop | None): the scraping loop of the running round, if any
+        store (Store): the scraper state
+    """
+
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        now: t.Callable[[], datetime] = functools.partial(datetime.now, tz=TIMEZONE),
+    ) -> None:
+        """Initialize a new daemon.
+
+        Args:
+            args (argparse.Namespace): the scraper command line arguments
+            now (t.Callable[[], datetime], optional): wall clock, used in tests
+        """
+        self.args: argparse.Namespace = args
+        self.day: date | None = None
+        self.day_path: pathlib.Path | None = None
+        self.fetched_trains: t.Mapping[int, Train] = dict()
+        self.unfetched_trains: dict[int, Train] = dict()
+        self.traffic: Counter[str] = Counter()
+        self.station_stats: dict[str, StationStats] | None = (
+            load_dataset(scraper.STATS_PATH) if args.adaptive_polling else None
+        )
+        self.rounds: int = 0
+        self.last_round: dict[str, t.Any] | None = None
+        self.next_round: datetime | None = None
+        self.loop: ScrapeLoop | None = None
+        self.store: Store = open_store(args.storage, scraper.DATA_DIR)
+
+        self._now = now
+        self._archive: ResponseArchive | None = None
+        self._last_started: datetime | None = (
+            load_dataset(scraper.LAST_RUN_PATH) or None if args.time_slices else None
+        )
+        self._stop = threading.Event()
+        self._trains: dict[str, int] = dict()
+        self._publish_trains()
+
+    def run(self) -> None:
+        """Run rounds until stopped (SIGINT or SIGTERM)."""
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, lambda *_: self.stop())
+
+        scraper.load_station_cache(self.store)
+        server: StatusServer | None = None
+        if self.args.status_port:
+            server = StatusServer(self, self.args.status_port)
+            server.start()
+            logging.info(
+                f"Serving the daemon status on http://{STATUS_HOST}:{server.server_port}/status"
+            )
+
+        try:
+            while not self._stop.is_set():
+                started: float = time.monotonic()
+                self.run_round()
+
+                wait: float = max(
+                    0.0, self.args.interval - (time.monotonic() - started)
+                )
+                self.next_round = self._now() + timedelta(seconds=wait)
+                logging.info(f"Next round at {self.next_round}")
+                self._stop.wait(wait)
+        finally:
+            if server is not None:
+                server.stop()
+            if self._archive is not None:
+                self._archive.close()
+            self.store.close()
+
+    def stop(self) -> None:
+        """Stop the daemon after the current round."""
+        logging.info("Stopping the daemon after the current round")
+        self._stop.set()
+
+    def run_round(self) -> None:
+        """Scrape the stations and the unfetched trains, then save the datasets.
+
+        Each round is bounded by the --time-budget, or by the interval.
+        """
+        started: float = time.monotonic()
+        started_at: datetime = self._now()
+        today: date = scraper.scraping_day(started_at)
+        if today != self.day:
+            self._switch_day(today)
+
+        slices: list[datetime | None] = [None]
+        if self.args.time_slices:
+            slices = board_slices(self._last_started, started_at)
+
+        fetched_old_n: int = len(self.fetched_trains)
+        stations: set[Station] = scraper.retrieve_stations(self.args, today)
+        scraper.scrape(
+            self.args,
+            stations,
+            self.fetched_trains,
+            self.unfetched_trains,
+            self.traffic,
+            self.station_stats,
+            slices,
+            deadline(started, self.args.time_budget or self.args.interval),
+            self._archive.directory if self._archive is not None else None,
+            on_loop=self._set_loop,
+        )
+        self._publish_trains()
+        self.loop = None
+        self._last_started = started_at
+        self.save()
+
+        self.rounds += 1
+        duration: float = time.monotonic() - started
+        self.last_round = {
+            "started": started_at.isoformat(),
+            "duration": round(duration, 1),
+            "new_trains": len(self.fetched_trains) - fetched_old_n,
+        }
+        logging.info(f"Round {self.rounds} completed: {self.last_round}")
+        scraper.export_metrics(
+            self.args,
+            started_at,
+            duration,
+            self.fetched_trains,
+            self.unfetched_trains,
+            new_trains=self.last_round["new_trains"],
+            round=self.rounds,
+        )
+
+    def _set_loop(self, loop: ScrapeLoop) -> None:
+        self.loop = loop
+
+    def _switch_day(self, today: date) -> None:
+        """Save the datasets of the previous day, if any, and load the ones of a day."""
+        if self.day is not None:
+            self.save()
+            logging.info(f"Day {self.day} completed: {len(self.fetched_trains)} trains")
+
+        self.day = today
+        self.day_path = scraper.day_path(today)
+        self.fetched_trains, self.unfetched_trains = self.store.load_trains(today)
+        self.traffic = self.store.load_traffic(today)
+        self._publish_trains()
+        logging.info(
+            f"Loaded {len(self.fetched_trains)} already fetched "
+            f"and {len(self.unfetched_trains)} unfetched trains of {today}"
+        )
+
+        if self.args.archive_responses:
+            if self._archive is not None:
+                self._archive.close()
+            self._archive = scraper.open_archive(self.day_path)
+
+    def save(self) -> None:
+        """Save the datasets of the current day and the shared ones."""
+        assert self.day is not None
+
+        self.store.save_stations(Station._cache)
+        if self.station_stats is not None:
+            save_dataset(scraper.STATS_PATH, self.station_stats)
+        if self.args.time_slices and self._last_started is not None:
+            save_dataset(scraper.LAST_RUN_PATH, self._last_started)
+        self.store.save_trains(self.day, self.fetched_trains, self.unfetched_trains)
+        self.store.save_traffic(self.day, self.traffic)
+
+    def status(self) -> dict[str, t.Any]:
+        """Return the state of the daemon and of the running round.
+
+        Returns:
+            dict[str, t.Any]: a JSON serializable summary
+        """
+        # The datasets are changed by the running round: only the snapshots
+        # published by the daemon and by the loop are read here
+        loop: ScrapeLoop | None = self.loop
+        loop_status: dict[str, t.Any] | None = (
+            loop.status() if loop is not None else None
+        )
+        trains: dict[str, int] = self._trains
+        if loop_status is not None:
+            trains = {**trains, **loop_status["trains"]}
+
+        return {
+            "day": _isoformat(self.day),
+            "rounds": self.rounds,
+            "last_round": self.last_round,
+            "next_round": _isoformat(self.next_round) if loop is None else None,
+            "trains": trains,
+            "stations": len(Station._cache),
+            "loop": loop_status,
+            "throttling": {
+                "ViaggiaTreno": ViaggiaTrenoAPI.throttle_status(),
+                "Trenord": TrenordAPI.throttle_status(),
+            },
+        }
+
+    def _publish_trains(self) -> None:
+        """Publish the size of the datasets between rounds, read by status().
+
+        While a round is running, the loop publishes the size of the datasets
+        instead (see ScrapeLoop.status); the running trains are the ones
+        at the end of the last round.
+        """
+        unfetched: list[Train] = list(self.unfetched_trains.values())
+        self._trains = {
+            "fetched": len(self.fetched_trains),
+            "unfetched": len(unfetched),
+            "running": sum(1 for train in unfetched if _running(train)),
+        }
+
+    def running_trains(self) -> list[dict[str, t.Any]]:
+        """Return the trains currently running, with their last detection.
+
+        Returns:
+            list[dict[str, t.Any]]: a JSON serializable list
+        """
+        return [
+            {
+                "number": train.number,
+                "category": train.category,
+                "client_code": train.client_code,
+                "origin": train.origin.code,
+                "destination": train.destination.code if train.destination else None,
+                "delay": train.delay,
+                "last_detection_place": train.last_detection_place,
+                "last_detection_time": _isoformat(train.last_detection_time),
+                "expected_arrival": _isoformat(expected_arrival(train)),
+            }
+            for train in list(self.unfetched_trains.values())
+            if _running(train)
+        ]
+
+
+def _running(train: Train) -> bool:
+    """Return True if a fetched train departed and did not arrive yet."""
+    return bool(train._fetched and train.departed and not train.cancelled)
+
+
+class _StatusHandler(BaseHTTPRequestHandler):
+    server: "StatusServer"
+
+    def do_GET(self) -> None:
+        path: str = self.path.split("?")[0]
+        routes: dict[str, t.Callable[[], t.Any]] = {
+            "/status": self.server.scraper.status,
+            "/trains": self.server.scraper.running_trains,
+        }
+        route: t.Callable[[], t.Any] | None = routes.get(path)
+
+        body: bytes
+        content_type: str = "application/json"
+        if route is not None:
+            body = json.dumps(route()).encode()
+        elif path == "/metrics":
+            body = metrics.REGISTRY.to_prometheus().encode()
+            content_type = "text/plain; version=0.0.4"
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: t.Any) -> None:
+        logging.debug(f"Status endpoint: {format % args}")
+
+
+class StatusServer(ThreadingHTTPServer):
+    """Local HTTP server of the daemon status.
+
+    Endpoints:
+        /status: the daemon state, train counts and the queue of the running round
+        /trains: the running trains, with their delay and last detection
+        /metrics: the scraper metrics, in the Prometheus text format
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self, scraper: ScraperDaemon, port: int, host: str = STATUS_HOST
+    ) -> None:
+        """Initialize a new status server.
+
+        Args:
+            scraper (ScraperDaemon): the daemon
+            port (int): the port to listen on, 0 for any free port
+            host (str, optional): the address to listen on
+        """
+        super().__init__((host, port), _StatusHandler)
+        self.scraper: ScraperDaemon = scraper
+
+    def start(self) -> None:
+        """Serve the requests in a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        """Stop serving and close the socket."""
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,227 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import os
+import pathlib
+import pickle
+import typing as t
+
+# Number of trains kept in memory before being appended to a spill file
+SPILL_CHUNK: int = 256
+
+K = t.TypeVar("K")
+V = t.TypeVar("V")
+
+
+def _load_chunks(f: t.BinaryIO) -> t.Iterator[t.Tuple[int, t.Any]]:
+    """Read the objects pickled one after the other in a file.
+
+    A truncated last object (e.g. being appended by another process) is ignored.
+
+    Args:
+        f (t.BinaryIO): the file, open for reading
+
+    Returns:
+        t.Iterator[t.Tuple[int, t.Any]]: the offset of each object and the object
+    """
+    while True:
+        offset: int = f.tell()
+        try:
+            yield offset, pickle.load(f)
+        except EOFError:
+            return
+        except pickle.UnpicklingError:
+            logging.warning(f"Ignoring a truncated chunk at {offset} of {f.name}")
+            return
+
+
+def load_dataset(file_path: pathlib.Path) -> dict[t.Any, t.Any]:
+    """Load a dataset. Datasets appended in chunks (see SpilledDataset)
+    are merged, the last chunks overriding the first ones.
+
+    Args:
+        file_path (pathlib.Path): the file to read
+
+    Returns:
+        dict[t.Any, t.Any]: the dataset, an empty dict if the file does not exist
+    """
+    try:
+        with open(file_path, "rb") as f:
+            chunks: t.Iterator[t.Tuple[int, t.Any]] = _load_chunks(f)
+            dataset: t.Any = next(chunks, (0, dict()))[1]
+            for _, chunk in chunks:
+                dataset.update(chunk)
+            return dataset
+    except FileNotFoundError:
+        return dict()
+
+
+def iter_dataset(file_path: pathlib.Path) -> t.Iterator[t.Tuple[t.Any, t.Any]]:
+    """Iterate over the items of a dataset, loading one chunk at a time.
+
+    Unlike load_dataset, the items of the chunks are not merged: an item set
+    again (see SpilledDataset) is returned once for each version, oldest first.
+
+    Args:
+        file_path (pathlib.Path): the file to read
+
+    Returns:
+        t.Iterator[t.Tuple[t.Any, t.Any]]: the items, nothing if the file does not exist
+    """
+    try:
+        with open(file_path, "rb") as f:
+            for _, chunk in _load_chunks(f):
+                yield from chunk.items()
+    except FileNotFoundError:
+        return
+
+
+def save_dataset(file_path: pathlib.Path, dataset: t.Any) -> None:
+    """Atomically save a dataset: readers always see either
+    the old or the new version of the file.
+
+    Args:
+        file_path (pathlib.Path): the file to write
+        dataset (t.Any): the data to save
+    """
+    tmp_path: pathlib.Path = file_path.with_name(f".{file_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        pickle.dump(dataset, f)
+    os.replace(tmp_path, file_path)
+
+
+class SpilledDataset(t.Mapping[K, V]):
+    """A dict-like dataset which keeps only its keys in memory.
+
+    New items are appended to the dataset file in chunks of SPILL_CHUNK items
+    (pickled dicts, readable by load_dataset); the position of the chunk
+    holding each key is indexed, so an item is read back by loading its chunk.
+    Items set again are appended again: the last version wins.
+
+    Attributes:
+        path (pathlib.Path): the dataset file
+    """
+
+    def __init__(
+        self, path: pathlib.Path, key: t.Callable[[V], K] | None = None
+    ) -> None:
+        """Open a dataset file, indexing its keys.
+
+        Args:
+            path (pathlib.Path): the dataset file, created on the first flush
+            key (t.Callable[[V], K] | None, optional): the key of each value.
+                If given and some items have a different key (e.g. the file
+                was saved by an older version), the file is rewritten.
+                The keys are checked once: a marker file records it
+        """
+        self.path: pathlib.Path = path
+        self._index: dict[K, int] = dict()
+        self._buffer: dict[K, V] = dict()
+
+        keyed_path: pathlib.Path = path.with_name(f".{path.name}.keyed")
+        check: bool = key is not None and not keyed_path.exists()
+        stale: bool = False
+        try:
+            with open(path, "rb") as f:
+                for offset, chunk in _load_chunks(f):
+                    self._index.update(dict.fromkeys(chunk, offset))
+                    if check and not stale:
+                        assert key is not None
+                        stale = any(key(value) != k for k, value in chunk.items())
+        except FileNotFoundError:
+            return
+
+        if stale:
+            assert key is not None
+            self._rekey(key)
+        if check:
+            keyed_path.touch()
+
+    def _rekey(self, key: t.Callable[[V], K]) -> None:
+        """Atomically rewrite the dataset file, with the keys computed by key."""
+        logging.info(f"Rewriting {self.path} with new keys")
+        tmp_path: pathlib.Path = self.path.with_name(
+            f".{self.path.name}.{os.getpid()}.tmp"
+        )
+        index: dict[K, int] = dict()
+        with open(self.path, "rb") as f, open(tmp_path, "wb") as out:
+            for offset, chunk in _load_chunks(f):
+                rekeyed: dict[K, V] = {
+                    key(value): value
+                    for k, value in chunk.items()
+                    if self._index.get(k) == offset
+                }
+                index.update(dict.fromkeys(rekeyed, out.tell()))
+                pickle.dump(rekeyed, out)
+        os.replace(tmp_path, self.path)
+        self._index = index
+
+    def __setitem__(self, key: K, value: V) -> None:
+        self._buffer[key] = value
+        if len(self._buffer) >= SPILL_CHUNK:
+            self.flush()
+
+    def flush(self) -> None:
+        """Append the items in memory to the dataset file."""
+        if not self._buffer:
+            return
+
+        data: bytes = pickle.dumps(self._buffer)
+        with open(self.path, "ab") as f:
+            offset: int = f.tell()
+            f.write(data)
+        self._index.update(dict.fromkeys(self._buffer, offset))
+        self._buffer.clear()
+
+    def _read_chunk(self, offset: int) -> dict[K, V]:
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return pickle.load(f)
+
+    def __getitem__(self, key: K) -> V:
+        if key in self._buffer:
+            return self._buffer[key]
+        return self._read_chunk(self._index[key])[key]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._buffer or key in self._index
+
+    def __iter__(self) -> t.Iterator[K]:
+        yield from self._index
+        yield from (key for key in self._buffer if key not in self._index)
+
+    def __len__(self) -> int:
+        return len(self._index) + sum(
+            1 for key in self._buffer if key not in self._index
+        )
+
+    def items(self) -> t.Iterator[t.Tuple[K, V]]:  # type: ignore[override]
+        """Iterate over the last version of each item, loading one chunk at a time."""
+        try:
+            with open(self.path, "rb") as f:
+                for offset, chunk in _load_chunks(f):
+                    for key, value in chunk.items():
+                        if key not in self._buffer and self._index.get(key) == offset:
+                            yield key, value
+        except FileNotFoundError:
+            pass
+        yield from list(self._buffer.items())
+
+    def values(self) -> t.Iterator[V]:  # type: ignore[override]
+        """Iterate over the last version of each value, loading one chunk at a time."""
+        return (value for _, value in self.items())
@@ -0,0 +1,229 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import heapq
+import logging
+import pathlib
+import typing as t
+from collections import defaultdict
+from datetime import date, timedelta
+
+from src.scraper.dataset import iter_dataset, load_dataset, save_dataset
+from src.scraper.train import Train
+
+# Days of scraped data the plan is computed from
+DEFAULT_HISTORY_DAYS: int = 7
+
+# A train can be discovered in the departure boards of its origin
+# and of its first stops
+DEFAULT_PREFIX_STOPS: int = 3
+
+# Fraction of the observed trains the planned stations have to cover
+DEFAULT_TARGET_COVERAGE: float = 1.0
+
+# The plan is computed again when older than this
+PLAN_MAX_AGE: timedelta = timedelta(days=7)
+
+
+class DiscoveryPlan(t.NamedTuple):
+    """The stations whose departure boards are retrieved to discover new trains.
+
+    Attributes:
+        stations (frozenset[str]): the planned station codes
+        created (date): the day the plan has been computed
+        candidates (int): the number of stations seen in the history
+        trains (int): the number of trains in the history
+        coverage (float | None): the fraction of the trains of the last day
+            of the history (not used to compute the plan) shown by the planned boards
+    """
+
+    stations: frozenset[str]
+    created: date
+    candidates: int
+    trains: int
+    coverage: float | None
+
+
+def discovery_stations(
+    train: Train, prefix_stops: int = DEFAULT_PREFIX_STOPS
+) -> set[str]:
+    """Return the stations whose departure boards (probably) show a train.
+
+    Args:
+        train (Train): the considered train
+        prefix_stops (int, optional): the number of stops considered after the origin
+
+    Returns:
+        set[str]: the station codes
+    """
+    stations: set[str] = {train.origin.code}
+    if train.stops:
+        departing_stops = [stop for stop in train.stops if stop.departure is not None]
+        stations.update(
+            stop.station.code for stop in departing_stops[: prefix_stops + 1]
+        )
+    return stations
+
+
+def greedy_cover(
+    candidates: t.Mapping[int, t.AbstractSet[str]],
+    target: float = DEFAULT_TARGET_COVERAGE,
+) -> list[str]:
+    """Compute a small set of stations covering the given trains,
+    with the greedy set cover algorithm (lazy evaluation).
+
+    Args:
+        candidates (t.Mapping[int, t.AbstractSet[str]]): the stations
+            showing each train, by train key (see Train.key)
+        target (float, optional): the fraction of trains to cover
+
+    Returns:
+        list[str]: the station codes, in order of selection
+    """
+    station_trains: dict[str, set[int]] = defaultdict(set)
+    for key, stations in candidates.items():
+        for code in stations:
+            station_trains[code].add(key)
+
+    # Max-heap of (stale) gains
+    heap: list[t.Tuple[int, str]] = [
+        (-len(trains), code) for code, trains in station_trains.items()
+    ]
+    heapq.heapify(heap)
+
+    required: float = target * len(candidates)
+    covered: set[int] = set()
+    selected: list[str] = list()
+    while heap and len(covered) < required:
+        _, code = heapq.heappop(heap)
+        gain: int = len(station_trains[code] - covered)
+        if gain == 0:
+            continue
+        if heap and gain < -heap[0][0]:
+            # The gain decreased: check it again later
+            heapq.heappush(heap, (-gain, code))
+            continue
+
+        selected.append(code)
+        covered |= station_trains[code]
+    return selected
+
+
+def coverage(
+    candidates: t.Mapping[int, t.AbstractSet[str]], stations: t.AbstractSet[str]
+) -> float:
+    """Return the fraction of the given trains shown by the boards of some stations.
+
+    Args:
+        candidates (t.Mapping[int, t.AbstractSet[str]]): the stations
+            showing each train
+        stations (t.AbstractSet[str]): the polled station codes
+
+    Returns:
+        float: the covered fraction, 1 if there are no trains
+    """
+    if not candidates:
+        return 1.0
+    return sum(1 for s in candidates.values() if not s.isdisjoint(stations)) / len(
+        candidates
+    )
+
+
+def build_plan(
+    history: t.Sequence[t.Iterable[Train]],
+    today: date,
+    prefix_stops: int = DEFAULT_PREFIX_STOPS,
+    target: float = DEFAULT_TARGET_COVERAGE,
+) -> DiscoveryPlan:
+    """Compute a discovery plan from the trains scraped in the past days.
+
+    The last day is held out: the coverage of the plan is measured on it.
+
+    Only the discovery stations of each train are kept, so the trains of each day
+    can be streamed (e.g. see iter_dataset): the last version of a train wins.
+
+    Args:
+        history (t.Sequence[t.Iterable[Train]]): the trains of each day, oldest first
+        today (date): the current day
+        prefix_stops (int, optional): the number of stops considered after the origin
+        target (float, optional): the fraction of trains to cover
+
+    Returns:
+        DiscoveryPlan: the computed plan
+    """
+    days: list[dict[int, set[str]]] = [
+        {train.key: discovery_stations(train, prefix_stops) for train in trains}
+        for trains in history
+    ]
+
+    held_out: dict[int, set[str]] | None = days.pop() if len(days) > 1 else None
+    candidates: dict[int, set[str]] = dict()
+    for day in days:
+        candidates.update(day)
+
+    stations: frozenset[str] = frozenset(greedy_cover(candidates, target))
+    return DiscoveryPlan(
+        stations=stations,
+        created=today,
+        candidates=len(set().union(*candidates.values())) if candidates else 0,
+        trains=len(candidates),
+        coverage=coverage(held_out, stations) if held_out is not None else None,
+    )
+
+
+def load_plan(
+    data_dir: pathlib.Path,
+    today: date,
+    history_days: int = DEFAULT_HISTORY_DAYS,
+) -> DiscoveryPlan | None:
+    """Load the discovery plan, computing it again if missing or too old.
+
+    Args:
+        data_dir (pathlib.Path): the data directory, with a subdirectory for each day
+        today (date): the current day, excluded from the history
+        history_days (int, optional): the number of past days to use
+
+    Returns:
+        DiscoveryPlan | None: the plan, None if there is no plan nor past data
+    """
+    plan_path: pathlib.Path = data_dir / "discovery_plan.pickle"
+    plan: DiscoveryPlan | dict = load_dataset(plan_path)
+    if isinstance(plan, DiscoveryPlan) and today - plan.created < PLAN_MAX_AGE:
+        return plan
+
+    # The trains of each day are streamed, one chunk at a time
+    history: list[t.Iterator[Train]] = list()
+    for day in range(history_days, 0, -1):
+        day_path: pathlib.Path = (
+            data_dir
+            / (today - timedelta(days=day)).strftime("%Y-%m-%d")
+            / "trains.pickle"
+        )
+        if day_path.exists():
+            history.append(train for _, train in iter_dataset(day_path))
+    if not history:
+        # Keep using the old plan, if any
+        return plan if isinstance(plan, DiscoveryPlan) else None
+
+    plan = build_plan(history, today)
+    logging.info(
+        f"Computed a discovery plan of {len(plan.stations)} out of {plan.candidates} "
+        f"stations, covering {plan.trains} trains "
+        f"(coverage on the last day: {plan.coverage})"
+    )
+    save_dataset(plan_path, plan)
+    return plan
@@ -34,6 +34,44 @@ class BadRequestException(Exception):
         super().__init__(*args)
 
 
+class CircuitOpenException(Exception):
+    """The circuit breaker of an API method is open: the request was not performed."""
+
+    def __init__(self, method: str, *args: object) -> None:
+        """Creates a CircuitOpenException.
+
+        Args:
+            method (str): the API method whose circuit breaker is open
+        """
+        self.method = method
+        super().__init__(f"circuit breaker open for '{method}'", *args)
+
+
+class ThrottledException(CircuitOpenException):
+    """Every attempt of a request was throttled or failed (see api.THROTTLE_STATUSES).
+
+    As for an open circuit breaker, no data was received:
+    the request should be performed again later.
+    """
+
+    def __init__(self, method: str, url: str, status_code: int, *args: object) -> None:
+        """Creates a ThrottledException.
+
+        Args:
+            method (str): the API method
+            url (str): the request URL
+            status_code (int): the status code of the last response
+        """
+        super().__init__(method, *args)
+        self.url = url
+        self.status_code = status_code
+
+    def __str__(self) -> str:
+        return (
+            f"'{self.method}' still throttled (HTTP {self.status_code}) after retrying"
+        )
+
+
 class IncompleteTrenordStopDataException(Exception):
     def __init__(self, *args: object) -> None:
         super().__init__(*args)
@@ -0,0 +1,233 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import contextlib
+import json
+import os
+import pathlib
+import threading
+import time
+import typing as t
+
+
+class Lease(t.NamedTuple):
+    """A lease on a shared resource."""
+
+    resource: str
+    node: str
+    expires: float
+
+    def expired(self, now: float) -> bool:
+        return now >= self.expires
+
+
+class LeaseManager:
+    """Lease-based mutual exclusion between processes (or hosts) sharing a directory.
+
+    A lease is a file created atomically (O_EXCL) in the lease directory,
+    holding the owner node and the expiration time. Expired leases
+    can be broken by other nodes: this is guarded by a short-lived
+    lock file, so only one node can take over an expired lease
+    and a lease is never renewed while being taken over.
+
+    Attributes:
+        directory (pathlib.Path): the shared lease directory
+        node (str): the identifier of this node
+        ttl (float): the lease duration, in seconds
+    """
+
+    # Guard files older than this (in seconds) are left by dead nodes
+    GUARD_TIMEOUT: float = 30.0
+
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        node: str,
+        ttl: float = 600.0,
+        clock: t.Callable[[], float] = time.time,
+    ) -> None:
+        """Initialize a new lease manager.
+
+        Args:
+            directory (pathlib.Path): the shared lease directory
+            node (str): the identifier of this node
+            ttl (float, optional): the lease duration, in seconds
+            clock (t.Callable[[], float], optional): wall clock, used in tests
+        """
+        self.directory: pathlib.Path = directory
+        self.node: str = node
+        self.ttl: float = ttl
+        self._clock = clock
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, resource: str) -> pathlib.Path:
+        return self.directory / f"{resource}.lease"
+
+    def holder(self, resource: str) -> Lease | None:
+        """Return the current lease on a resource, if any.
+
+        Args:
+            resource (str): the resource name
+
+        Returns:
+            Lease | None: the lease, even if expired
+        """
+        try:
+            with open(self._path(resource), "r") as f:
+                data: dict = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # The lease file is being written: consider it fresh
+            return Lease(resource, "?", self._clock() + self.ttl)
+
+        return Lease(resource, data["node"], data["expires"])
+
+    def _write(self, path: pathlib.Path, flags: int) -> None:
+        fd: int = os.open(path, flags, 0o644)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"node": self.node, "expires": self._clock() + self.ttl}, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def acquire(self, resource: str) -> bool:
+        """Try to acquire (or renew) the lease on a resource.
+
+        Args:
+            resource (str): the resource name
+
+        Returns:
+            bool: True if this node now holds the lease
+        """
+        path: pathlib.Path = self._path(resource)
+        try:
+            self._write(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            return True
+        except FileExistsError:
+            pass
+
+        lease: Lease | None = self.holder(resource)
+        if lease is not None and not lease.expired(self._clock()):
+            return lease.node == self.node and self.renew(resource)
+
+        # Free or expired, even if held by this node (e.g. before a restart)
+        return self._take_over(resource)
+
+    @contextlib.contextmanager
+    def _guard(self, resource: str) -> t.Iterator[bool]:
+        """Hold the guard file of a resource, while the context is active:
+        the lease file is only checked and rewritten by its holder.
+
+        Args:
+            resource (str): the resource name
+
+        Returns:
+            t.Iterator[bool]: False if the guard is held by another node
+        """
+        guard: pathlib.Path = self.directory / f"{resource}.guard"
+        try:
+            os.close(os.open(guard, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            with contextlib.suppress(FileNotFoundError):
+                if time.time() - guard.stat().st_mtime > self.GUARD_TIMEOUT:
+                    guard.unlink()
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                guard.unlink()
+
+    def _take_over(self, resource: str) -> bool:
+        """Break an expired (or just released) lease and acquire it."""
+        with self._guard(resource) as guarded:
+            if not guarded:
+                return False
+
+            # Check again: the lease could have been taken over in the meantime
+            lease: Lease | None = self.holder(resource)
+            if lease is not None and not lease.expired(self._clock()):
+                return lease.node == self.node
+
+            with contextlib.suppress(FileNotFoundError):
+                self._path(resource).unlink()
+            try:
+                self._write(self._path(resource), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False
+            return True
+
+    def renew(self, resource: str) -> bool:
+        """Extend the lease on a resource held by this node.
+
+        The lease is checked and rewritten holding the guard, so that a lease
+        expired and taken over in the meantime by another node is not overwritten.
+
+        Args:
+            resource (str): the resource name
+
+        Returns:
+            bool: False if the lease is not held by this node (anymore),
+                or if the guard is busy (the renewal can be tried again)
+        """
+        with self._guard(resource) as guarded:
+            if not guarded:
+                return False
+
+            lease: Lease | None = self.holder(resource)
+            if lease is None or lease.node != self.node or lease.expired(self._clock()):
+                return False
+
+            tmp: pathlib.Path = self.directory / f"{resource}.{self.node}.tmp"
+            self._write(tmp, os.O_CREAT | os.O_TRUNC | os.O_WRONLY)
+            os.replace(tmp, self._path(resource))
+            return True
+
+    def release(self, resource: str) -> None:
+        """Release the lease on a resource, if held by this node.
+
+        Args:
+            resource (str): the resource name
+        """
+        lease: Lease | None = self.holder(resource)
+        if lease is not None and lease.node == self.node:
+            with contextlib.suppress(FileNotFoundError):
+                self._path(resource).unlink()
+
+    @contextlib.contextmanager
+    def keep_alive(self, resource: str) -> t.Iterator[None]:
+        """Periodically renew a held lease in a background thread,
+        while the context is active.
+
+        Args:
+            resource (str): the resource name
+        """
+        stop: threading.Event = threading.Event()
+
+        def _renew() -> None:
+            while not stop.wait(self.ttl / 3):
+                self.renew(resource)
+
+        thread = threading.Thread(target=_renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
@@ -0,0 +1,598 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import functools
+import itertools
+import logging
+import time
+import typing as t
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from tqdm import tqdm
+
+import src.scraper.api as api
+import src.scraper.metrics as metrics
+from src.const import TIMEZONE
+from src.scraper.exceptions import CircuitOpenException
+from src.scraper.schedule import (
+    TIER_NAMES,
+    Priority,
+    StationStats,
+    arrived_on_board,
+    board_eta,
+    enrichment_priority,
+    new_train_priority,
+    refetch_due,
+    refetch_expired,
+    schedule_refetch,
+    station_priority,
+    train_departures,
+    train_priority,
+)
+from src.scraper.station import Station
+from src.scraper.train import Train
+
+DEFAULT_CONCURRENCY: int = 16
+
+Job = t.Callable[[], t.Awaitable[None]]
+
+
+class _Entry(t.NamedTuple):
+    """A queued job. Entries are ordered by priority, then by insertion order."""
+
+    priority: Priority
+    seq: int
+    phase: str
+    job: Job
+    skip: t.Callable[[], None]
+
+
+class ScrapeLoop:
+    """Concurrent scraping loop.
+
+    Previously unfetched trains are fetched again when due, the departures
+    of every station are retrieved and the newly seen trains are fetched.
+    Trains not arrived yet are scheduled to be fetched again when
+    they are expected to arrive (see schedule.schedule_refetch).
+
+    In arrival boards mode, the due trains are first looked up in the arrival
+    board of their destination: a single request tells which ones arrived
+    and have to be fetched, and updates the expected arrival of the others.
+
+    If station statistics are given, the departure boards are retrieved
+    only when due (see schedule.StationStats) and the statistics are updated.
+
+    Trenord data is fetched in a separate stage, after all the other jobs:
+    trains with the same number share a request, and only trains showing
+    progress since the last Trenord fetch are enriched (see Train.trenord_due);
+    the others get their previous Trenord data back.
+
+    Departure boards can be retrieved at multiple times (see schedule.board_slices),
+    to show the trains departed since the last run.
+    Up to `concurrency` jobs (and API requests) run at the same time.
+
+    Jobs are processed by priority (see the schedule module): trains which
+    probably arrived first, then busy stations. If a deadline is set,
+    no job is started after it: skipped new trains are saved as unfetched,
+    so they are fetched in the next run.
+
+    All the shared state (the station cache and the train dicts) is only
+    modified by the event loop thread, between two awaits: a train seen in
+    multiple departure boards is fetched only once.
+
+    Responses with no new data are not decoded: train details identical to the
+    last fetch (see Train.fetch_async), and departure boards identical to one
+    seen in this run or showing known trains only (see _known_board).
+
+    Attributes:
+        fetched_trains (dict[int, Train]): trains with no more data to fetch
+        unfetched_trains (dict[int, Train]): trains to fetch again in the next runs
+        known_trains (t.AbstractSet[int]): hashes of other trains to ignore in departures
+        concurrency (int): the maximum number of concurrent requests
+        traffic (Counter[str]): the number of departures seen at each station,
+            updated with the trains saved as fetched
+        deadline (float | None): no job is started after this time (time.monotonic())
+        skipped (Counter[str]): the number of jobs skipped because of the deadline
+        deferred (int): the number of trains not fetched because not due yet
+        arrival_boards (bool): if True, check the arrival boards before fetching trains
+        board_stats (Counter[str]): arrival board requests and their outcome
+        station_stats (dict[str, StationStats] | None): the polling statistics
+            of the stations, by station code
+        idle_stations (int): the number of stations not polled because not due
+        board_slices (t.Sequence[datetime | None]): the times the departure boards
+            are retrieved at, None meaning now
+        trenord_stats (Counter[str]): Trenord requests and enriched trains
+        unparsed (Counter[str]): responses not decoded, because unchanged
+            or showing known trains only
+    """
+
+    def __init__(
+        self,
+        fetched_trains: dict[int, Train],
+        unfetched_trains: dict[int, Train],
+        concurrency: int = DEFAULT_CONCURRENCY,
+        known_trains: t.AbstractSet[int] = frozenset(),
+        traffic: Counter[str] | None = None,
+        deadline: float | None = None,
+        arrival_boards: bool = False,
+        station_stats: dict[str, StationStats] | None = None,
+        board_slices: t.Sequence[datetime | None] = (None,),
+        clock: t.Callable[[], float] = time.monotonic,
+        now: t.Callable[[], datetime] = functools.partial(datetime.now, tz=TIMEZONE),
+    ) -> None:
+        """Initialize a new scraping loop.
+
+        Args:
+            fetched_trains (dict[int, Train]): trains with no more data to fetch
+            unfetched_trains (dict[int, Train]): trains to fetch again in the next runs
+            concurrency (int, optional): the maximum number of concurrent requests
+            known_trains (t.AbstractSet[int], optional): hashes of other trains
+                (e.g. saved elsewhere) to ignore in departures
+            traffic (Counter[str] | None, optional): the number of departures
+                seen at each station, to retrieve the busiest ones first.
+                Updated with the trains saved as fetched
+            deadline (float | None, optional): no job is started after this time
+            arrival_boards (bool, optional): if True, check the arrival boards
+                of the destinations before fetching the unfetched trains
+            station_stats (dict[str, StationStats] | None, optional): if given,
+                retrieve the departure boards only when due, updating the statistics
+            board_slices (t.Sequence[datetime | None], optional): the times
+                the departure boards are retrieved at. Defaults to now only
+            clock (t.Callable[[], float], optional): monotonic clock, used in tests
+            now (t.Callable[[], datetime], optional): wall clock, used in tests
+        """
+        assert concurrency >= 1
+
+        self.fetched_trains: dict[int, Train] = fetched_trains
+        self.unfetched_trains: dict[int, Train] = unfetched_trains
+        self.known_trains: t.AbstractSet[int] = known_trains
+        self.concurrency: int = concurrency
+        self.traffic: Counter[str] = traffic if traffic is not None else Counter()
+        self.deadline: float | None = deadline
+        self.skipped: Counter[str] = Counter()
+        self.deferred: int = 0
+        self.arrival_boards: bool = arrival_boards
+        self.board_stats: Counter[str] = Counter()
+        self.station_stats: dict[str, StationStats] | None = station_stats
+        self.idle_stations: int = 0
+        self.board_slices: t.Sequence[datetime | None] = board_slices
+        self.trenord_stats: Counter[str] = Counter()
+        self.unparsed: Counter[str] = Counter()
+
+        self._clock = clock
+        self._now = now
+        self._seq = itertools.count()
+        self._in_flight: set[int] = set()
+        self._queued: Counter[int] = Counter()
+        self._trenord: dict[int, Train] = dict()
+        self._board_fingerprints: dict[str, set[bytes]] = defaultdict(set)
+        self._queue: asyncio.PriorityQueue[_Entry] | None = None
+        self._progress: tqdm | None = None
+        self._status: dict[str, t.Any] = dict()
+        self._publish_status()
+
+    def run(self, stations: t.Iterable[Station]) -> None:
+        """Run the scraping loop until all the jobs are completed.
+
+        Args:
+            stations (t.Iterable[Station]): the stations to retrieve departures from
+        """
+        asyncio.run(self._run(stations))
+
+        logging.info(f"Deferred {self.deferred} trains not expected to arrive yet")
+        if self.arrival_boards:
+            logging.info(f"Arrival boards: {dict(self.board_stats)}")
+        if self.station_stats is not None:
+            logging.info(f"Skipped {self.idle_stations} stations not due for polling")
+        logging.info(f"Not decoded (no new data): {dict(self.unparsed)}")
+        if self.trenord_stats:
+            logging.info(f"Trenord enrichment: {dict(self.trenord_stats)}")
+
+        if self.skipped:
+            logging.warning(
+                "Time budget exhausted, skipped: "
+                + ", ".join(f"{n} {kind}" for kind, n in self.skipped.items())
+            )
+
+    async def _run(self, stations: t.Iterable[Station]) -> None:
+        # The executor size bounds the number of blocking requests in flight
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=self.concurrency)
+        )
+
+        self._queue = asyncio.PriorityQueue()
+        self._progress = tqdm(total=0)
+
+        now: datetime = self._now()
+        pending: dict[str, dict[int, Train]] = defaultdict(dict)
+        for train_hash, train in list(self.unfetched_trains.items()):
+            if not refetch_due(train, now):
+                self.deferred += 1
+                continue
+
+            if (
+                self.arrival_boards
+                and train.destination is not None
+                and not refetch_expired(train, now)
+            ):
+                pending[train.destination.code][train_hash] = train
+                continue
+
+            self._enqueue_refetch(train_hash, train, now)
+
+        for station_code, trains in pending.items():
+            self._enqueue(
+                "arrival_boards",
+                min(train_priority(train, now) for train in trains.values()),
+                functools.partial(self._poll_arrivals, station_code, trains),
+                functools.partial(self.skipped.update, ["arrival boards"]),
+            )
+        for station in stations:
+            if (
+                self.station_stats is not None
+                and station.code in self.station_stats
+                and not self.station_stats[station.code].due(now)
+            ):
+                self.idle_stations += 1
+                continue
+
+            for when in self.board_slices:
+                self._enqueue(
+                    "stations",
+                    station_priority(station, self.traffic),
+                    functools.partial(self._process_station, station, when),
+                    functools.partial(self.skipped.update, ["stations"]),
+                )
+
+        workers: list[asyncio.Task] = [
+            asyncio.create_task(self._worker()) for _ in range(self.concurrency)
+        ]
+        await self._queue.join()
+
+        # Trenord stage
+        self._enqueue_trenord()
+        await self._queue.join()
+
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._progress.close()
+
+    def status(self) -> dict[str, t.Any]:
+        """Return the progress of the loop, e.g. to monitor a running loop.
+        Safe to call from other threads (see _publish_status).
+
+        Returns:
+            dict[str, t.Any]: the queued jobs by tier, the trains being fetched,
+            the completed jobs, the skipped ones and the size of the datasets
+        """
+        return self._status
+
+    def _publish_status(self) -> None:
+        """Publish a snapshot of the progress, read by status().
+
+        The counters are only read and changed in the event loop thread:
+        other threads get the last published snapshot, which is never changed.
+        """
+        self._status = {
+            "queued": {TIER_NAMES[tier]: n for tier, n in self._queued.items() if n},
+            "in_flight": len(self._in_flight),
+            "completed": self._progress.n if self._progress is not None else 0,
+            "deferred": self.deferred,
+            "skipped": dict(self.skipped),
+            "trains": {
+                "fetched": len(self.fetched_trains),
+                "unfetched": len(self.unfetched_trains),
+            },
+        }
+
+    def _enqueue(
+        self, phase: str, priority: Priority, job: Job, skip: t.Callable[[], None]
+    ) -> None:
+        assert self._queue is not None and self._progress is not None
+
+        self._queue.put_nowait(_Entry(priority, next(self._seq), phase, job, skip))
+        self._queued[priority[0]] += 1
+        self._progress.total += 1
+        self._progress.refresh()
+        self._publish_status()
+
+    async def _worker(self) -> None:
+        assert self._queue is not None and self._progress is not None
+
+        while True:
+            entry: _Entry = await self._queue.get()
+            self._queued[entry.priority[0]] -= 1
+            started: float = time.perf_counter()
+            outcome: str = "done"
+            try:
+                if self.deadline is not None and self._clock() >= self.deadline:
+                    outcome = "skipped"
+                    entry.skip()
+                    continue
+                await entry.job()
+            except CircuitOpenException as e:
+                # The job will be retried in the next run
+                outcome = "deferred"
+                logging.debug(e)
+            except Exception as e:
+                outcome = "failed"
+                logging.exception(e, exc_info=True)
+            finally:
+                metrics.REGISTRY.inc("jobs_total", phase=entry.phase, outcome=outcome)
+                if outcome != "skipped":
+                    metrics.REGISTRY.observe(
+                        "job_seconds", time.perf_counter() - started, phase=entry.phase
+                    )
+                self._queue.task_done()
+                self._progress.update()
+                self._publish_status()
+
+    def _enqueue_refetch(self, train_hash: int, train: Train, now: datetime) -> None:
+        self._enqueue(
+            "unfetched_trains",
+            train_priority(train, now),
+            functools.partial(self._refetch_train, train_hash, train),
+            functools.partial(self.skipped.update, ["unfetched trains"]),
+        )
+
+    async def _poll_arrivals(self, station_code: str, trains: dict[int, Train]) -> None:
+        """Retrieve the arrival board of a station and enqueue the fetch
+        of the given trains (arriving to it) which arrived."""
+        board: list[dict] = await api.ViaggiaTrenoAPI._station_board_async(
+            "arrivi", station_code
+        )
+        self.board_stats["boards"] += 1
+
+        by_key: dict[tuple, int] = {
+            (train.number, train.origin.code, train.departing_date): train_hash
+            for train_hash, train in trains.items()
+        }
+        now: datetime = self._now()
+        running: set[int] = set()
+        for train_data in board:
+            train_hash: int | None = by_key.get(
+                (
+                    train_data["numeroTreno"],
+                    train_data["codOrigine"],
+                    Train._board_departing_date(train_data),
+                )
+            )
+            if train_hash is None or arrived_on_board(train_data, now):
+                continue
+
+            # Still running: fetch it when it is expected to arrive
+            trains[train_hash]._next_fetch = board_eta(train_data)
+            running.add(train_hash)
+
+        self.board_stats["running"] += len(running)
+        for train_hash, train in trains.items():
+            if train_hash not in running:
+                # Arrived, or not shown in the board anymore
+                self.board_stats["fetched"] += 1
+                self._enqueue_refetch(train_hash, train, now)
+
+    def _enqueue_trenord(self) -> None:
+        """Enqueue the Trenord requests of the trains fetched in this run,
+        one for each train number."""
+        by_number: dict[int, dict[int, Train]] = defaultdict(dict)
+        for train_hash, train in self._trenord.items():
+            if train.trenord_due():
+                by_number[train.number][train_hash] = train
+                continue
+
+            if train._restore_trenord():
+                self.trenord_stats["restored"] += 1
+            self._trenord_done(train_hash, train)
+        self._trenord.clear()
+
+        for trains in by_number.values():
+            self._enqueue(
+                "trenord",
+                enrichment_priority(len(trains)),
+                functools.partial(self._enrich_trenord, trains),
+                functools.partial(self._skip_trenord, trains),
+            )
+
+    async def _enrich_trenord(self, trains: dict[int, Train]) -> None:
+        """Fetch the Trenord data of trains with the same number."""
+        await Train.fetch_trenord_batch_async(list(trains.values()))
+        self.trenord_stats["requests"] += 1
+        self.trenord_stats["enriched"] += len(trains)
+        for train_hash, train in trains.items():
+            self._trenord_done(train_hash, train)
+
+    def _skip_trenord(self, trains: dict[int, Train]) -> None:
+        """Keep the previous Trenord data of trains, if any."""
+        self.skipped["Trenord trains"] += len(trains)
+        for train_hash, train in trains.items():
+            train._restore_trenord()
+            self._trenord_done(train_hash, train)
+
+    def _trenord_done(self, train_hash: int, train: Train) -> None:
+        if train_hash in self.unfetched_trains and train.arrived():
+            # Trenord data shows the arrival
+            self._save_fetched(train_hash, train)
+            del self.unfetched_trains[train_hash]
+
+        if train_hash in self.fetched_trains:
+            # Not fetched anymore: drop the Trenord data kept for the next runs.
+            # Saved again: it may have been spilled before the Trenord stage
+            train._trenord_journey = None
+            self.fetched_trains[train_hash] = train
+
+    def _collect_trenord(self, train_hash: int, train: Train) -> None:
+        """Collect a fetched Trenord train for the Trenord stage."""
+        if (
+            train.client_code == api.TrenordAPI.TRENORD_CLIENT_CODE
+            and not train._phantom
+        ):
+            self._trenord[train_hash] = train
+
+    async def _refetch_train(self, train_hash: int, train: Train) -> None:
+        """Fetch again a previously unfetched train."""
+        if await train.fetch_async(trenord=False):
+            self._collect_trenord(train_hash, train)
+        else:
+            self.unparsed["trains"] += 1
+
+        now: datetime = self._now()
+        fetched: bool = bool(
+            train._phantom or train.arrived() or refetch_expired(train, now)
+        )
+        _count_train(train, fetched)
+        if fetched:
+            self._save_fetched(train_hash, train)
+            del self.unfetched_trains[train_hash]
+            logging.debug(f"Saved previously unfetched {train.category} {train.number}")
+        else:
+            schedule_refetch(train, now)
+
+    async def _process_station(
+        self, station: Station, when: datetime | None = None
+    ) -> None:
+        """Retrieve the departures of a station (at a given time, defaults to now)
+        and enqueue the unknown trains."""
+        logging.debug(f"Processing {station} at {when or 'now'}")
+
+        raw_board: str = await api.ViaggiaTrenoAPI._station_board_raw_async(
+            "partenze", station.code, when
+        )
+        record: bool = self.station_stats is not None and when is None
+        if not record and self._known_board(station.code, raw_board):
+            self.unparsed["boards"] += 1
+            return
+
+        board: list[dict] = api.ViaggiaTrenoAPI._decode_json(raw_board, "partenze")
+        departing: list[Train] = await asyncio.gather(
+            *(
+                Train._from_station_departures_arrivals_async(train_data)
+                for train_data in board
+                if not self._known(
+                    Train._board_hash(
+                        (
+                            train_data["numeroTreno"],
+                            train_data["codOrigine"],
+                            train_data["dataPartenzaTreno"],
+                        )
+                    )
+                )
+            )
+        )
+        now: datetime = self._now()
+        new_trains: int = 0
+        for train in departing:
+            train_hash: int = hash(train)
+            if self._known(train_hash):
+                continue
+
+            new_trains += 1
+
+            if not refetch_due(train, now):
+                # Not departed yet: fetch it in a next run
+                self.unfetched_trains[train_hash] = train
+                self.deferred += 1
+                continue
+
+            self._in_flight.add(train_hash)
+            self._enqueue(
+                "new_trains",
+                new_train_priority(),
+                functools.partial(self._fetch_train, train_hash, train),
+                functools.partial(self._skip_train, train_hash, train),
+            )
+
+        if record:
+            assert self.station_stats is not None
+            # Not departed trains are due at their departure time
+            horizon: datetime | None = max(
+                filter(None, map(Train._board_next_fetch, board)), default=None
+            )
+            self.station_stats.setdefault(station.code, StationStats()).record(
+                now, new_trains, horizon
+            )
+
+    def _known(self, train_hash: int) -> bool:
+        """Return True if a train has been seen already."""
+        return (
+            train_hash in self.fetched_trains
+            or train_hash in self.known_trains
+            or train_hash in self.unfetched_trains
+            or train_hash in self._in_flight
+        )
+
+    def _known_board(self, station_code: str, raw_board: str) -> bool:
+        """Return True if a raw departure board shows no new trains: it is identical
+        to a board of the same station seen in this run, or all the trains found
+        by a pre-scan are known."""
+        fingerprints: set[bytes] = self._board_fingerprints[station_code]
+        fingerprint: bytes = api.ViaggiaTrenoAPI._fingerprint(raw_board)
+        if fingerprint in fingerprints:
+            return True
+        fingerprints.add(fingerprint)
+
+        keys: list[api.BoardKey] | None = api.ViaggiaTrenoAPI._board_keys(raw_board)
+        return keys is not None and all(
+            self._known(Train._board_hash(key)) for key in keys
+        )
+
+    async def _fetch_train(self, train_hash: int, train: Train) -> None:
+        """Fetch a newly seen train."""
+        try:
+            await train.fetch_async(trenord=False)
+        except CircuitOpenException:
+            # Not fetched: fetch it in the next run
+            self.unfetched_trains[train_hash] = train
+            raise
+        finally:
+            self._in_flight.discard(train_hash)
+        self._collect_trenord(train_hash, train)
+
+        fetched: bool = bool(train._phantom or train.arrived())
+        _count_train(train, fetched)
+        if fetched:
+            self._save_fetched(train_hash, train)
+            logging.debug(f"Saved {train.category} {train.number}")
+        else:
+            schedule_refetch(train, self._now())
+            self.unfetched_trains[train_hash] = train
+
+    def _save_fetched(self, train_hash: int, train: Train) -> None:
+        """Save a train with no more data to fetch, counting its departures."""
+        if train_hash not in self.fetched_trains:
+            self.traffic.update(train_departures(train))
+        self.fetched_trains[train_hash] = train
+
+    def _skip_train(self, train_hash: int, train: Train) -> None:
+        """Save a newly seen train as unfetched, to fetch it in the next run."""
+        self._in_flight.discard(train_hash)
+        self.unfetched_trains[train_hash] = train
+        self.skipped["new trains"] += 1
+
+
+def _count_train(train: Train, fetched: bool) -> None:
+    """Count a train just fetched in the metrics, as phantom,
+    fetched (no more data to fetch) or unfetched."""
+    outcome: str = "unfetched"
+    if train._phantom:
+        outcome = "phantom"
+    elif fetched:
+        outcome = "fetched"
+    metrics.REGISTRY.inc("trains_total", outcome=outcome)
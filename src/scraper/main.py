@@ -15,24 +15,43 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import argparse
 import itertools
 import logging
 import os
 import pathlib
-import pickle
 import subprocess
 import sys
+import time
 import typing as t
+from collections import Counter
 from datetime import date, datetime, timedelta
 
 import sentry_sdk
-from tqdm import tqdm
 
+import src.scraper.daemon as daemon
+import src.scraper.metrics as metrics
+import src.scraper.tracing as tracing
 from src.const import TIMEZONE
-from src.scraper.station import Station
+from src.scraper.api import TrenordAPI, ViaggiaTrenoAPI
+from src.scraper.archive import ARCHIVE_DIRNAME, ResponseArchive
+from src.scraper.cluster import Cluster
+from src.scraper.dataset import load_dataset, save_dataset
+from src.scraper.discovery import load_plan
+from src.scraper.loop import DEFAULT_CONCURRENCY, ScrapeLoop
+from src.scraper.schedule import StationStats, board_slices, deadline
+from src.scraper.shard import run_sharded
+from src.scraper.station import REGION_CODES, Station
+from src.scraper.store import SQLITE_FILENAME, STORAGES, Store, open_store
 from src.scraper.train import Train
 
 DATA_DIR = pathlib.Path("data/")
+STATS_PATH = DATA_DIR / "station_stats.pickle"
+LAST_RUN_PATH = DATA_DIR / "last_run.pickle"
+REGIONS_PATH = DATA_DIR / "station_regions.pickle"
+METRICS_PATH = DATA_DIR / "metrics.prom"
+RUNS_DIR = DATA_DIR / "runs"
+TRACES_PATH = DATA_DIR / "traces.jsonl"
 
 
 def get_git_revision_short_hash() -> str:
@@ -50,109 +69,490 @@ def get_git_revision_short_hash() -> str:
             return "unknown"
 
 
-def load_dataset(file_path: pathlib.Path) -> dict[t.Any, t.Any]:
-    try:
-        with open(file_path, "rb") as f:
-            return pickle.load(f)
-    except FileNotFoundError:
-        return dict()
-
+def register_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        metavar="N",
+        help=f"maximum number of concurrent API requests. Defaults to {DEFAULT_CONCURRENCY}",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        metavar="N",
+        help=(
+            "number of worker processes, each one scraping a group of regions. "
+            "Each worker performs up to --concurrency concurrent requests. Defaults to 1"
+        ),
+    )
+    parser.add_argument(
+        "--node-id",
+        metavar="ID",
+        help=(
+            "identifier of this node, to run multiple scrapers on the same data directory. "
+            "Nodes split the regions using lease files and merge their results"
+        ),
+    )
+    parser.add_argument(
+        "--lease-ttl",
+        type=float,
+        default=600,
+        metavar="SECONDS",
+        help="lease duration of a node; leases of dead nodes expire after it. Defaults to 600",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        metavar="SECONDS",
+        help=(
+            "maximum duration of the run. Most valuable work is done first "
+            "(likely arrived trains, busy stations); the rest is skipped "
+            "and the results are saved before the time runs out"
+        ),
+    )
+    parser.add_argument(
+        "--arrival-boards",
+        action="store_true",
+        help=(
+            "check the arrival boards of the destinations of unfetched trains, "
+            "and fetch only the trains shown as arrived"
+        ),
+    )
+    parser.add_argument(
+        "--adaptive-polling",
+        action="store_true",
+        help=(
+            "retrieve the departures of each station only when new trains are expected, "
+            f"based on statistics kept in {DATA_DIR / 'station_stats.pickle'}"
+        ),
+    )
+    parser.add_argument(
+        "--discovery-plan",
+        action="store_true",
+        help=(
+            "retrieve the departures only of a small set of stations, which showed "
+            "all the trains of the past days. The plan is computed again every week"
+        ),
+    )
+    parser.add_argument(
+        "--time-slices",
+        action="store_true",
+        help=(
+            "also retrieve the past departure boards since the last run, "
+            "so trains departed between two runs are not missed"
+        ),
+    )
+    parser.add_argument(
+        "--archive-responses",
+        action="store_true",
+        help=(
+            f"keep the raw API responses in a compressed archive in {ARCHIVE_DIRNAME}/ "
+            "of the day directory, to rebuild the datasets with the reparse command"
+        ),
+    )
+    parser.add_argument(
+        "--storage",
+        choices=STORAGES,
+        default="pickle",
+        help=(
+            "where the trains and stations are saved: whole-file pickles, or a SQLite "
+            f"database ({DATA_DIR / SQLITE_FILENAME}) where only the changed "
+            "trains are written. Defaults to pickle"
+        ),
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help=(
+            "keep running, scraping every --interval seconds: the datasets and "
+            "the connections are kept in memory and saved after every round"
+        ),
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=daemon.DEFAULT_INTERVAL,
+        metavar="SECONDS",
+        help=f"time between two daemon rounds. Defaults to {daemon.DEFAULT_INTERVAL:.0f}",
+    )
+    parser.add_argument(
+        "--status-port",
+        type=int,
+        default=daemon.DEFAULT_STATUS_PORT,
+        metavar="PORT",
+        help=(
+            "local port of the daemon JSON status endpoint (0 to disable). "
+            f"Defaults to {daemon.DEFAULT_STATUS_PORT}"
+        ),
+    )
+    parser.add_argument(
+        "--max-rate",
+        type=float,
+        default=ViaggiaTrenoAPI._limiter.max_rate,
+        metavar="REQ/S",
+        help=(
+            "maximum number of requests per second to each API. "
+            "The actual rate adapts to upstream throttling. "
+            f"Defaults to {ViaggiaTrenoAPI._limiter.max_rate}"
+        ),
+    )
+    parser.add_argument(
+        "--viaggiatreno-url",
+        metavar="URL",
+        help=(
+            "base URL of the ViaggiaTreno API, e.g. of a stand-in server "
+            f"(see the standin command). Defaults to {ViaggiaTrenoAPI.BASE_URL}"
+        ),
+    )
+    parser.add_argument(
+        "--trenord-url",
+        metavar="URL",
+        help=f"base URL of the Trenord API. Defaults to {TrenordAPI.BASE_URL}",
+    )
+    parser.add_argument(
+        "--trace-sample-rate",
+        type=float,
+        default=0.0,
+        metavar="RATE",
+        help=(
+            "fraction of train fetches to trace (0-1): the timings of their requests, "
+            f"JSON decoding and stop parsing are appended to {TRACES_PATH}. Defaults to 0"
+        ),
+    )
+    parser.add_argument(
+        "--trace-sentry",
+        action="store_true",
+        help="also send the sampled traces to Sentry (requires SENTRY_DSN)",
+    )
 
-def save_dataset(file_path: pathlib.Path, dataset: dict[t.Any, t.Any]) -> None:
-    with open(file_path, "wb") as f:
-        pickle.dump(dataset, f)
 
+def setup(args: argparse.Namespace) -> None:
+    """Check the environment and configure error reporting and the APIs.
 
-def main() -> None:
-    hashseed = os.getenv("PYTHONHASHSEED")
-    if not hashseed or hashseed != "0":
-        logging.critical(
-            "Hash seed randomization is not disabled. "
-            "Please disable it by setting PYTHONHASHSEED=0 environment variable"
-        )
-        sys.exit(1)
-
+    Args:
+        args (argparse.Namespace): the command line arguments
+    """
     sentry_dsn = os.getenv("SENTRY_DSN")
     if sentry_dsn is not None:
         sentry_sdk.init(
             dsn=sentry_dsn,
             release=get_git_revision_short_hash(),
-            traces_sample_rate=1.0,
+            traces_sample_rate=0.0,
         )
         logging.info("Activated sentry error reporting")
 
+    if args.trace_sample_rate > 0:
+        exporters: list[tracing.Exporter] = [tracing.JSONLExporter(TRACES_PATH)]
+        if args.trace_sentry and sentry_dsn is not None:
+            exporters.append(tracing.SentryExporter())
+        tracing.TRACER.configure(args.trace_sample_rate, exporters)
+        logging.info(f"Tracing {args.trace_sample_rate:.1%} of the train fetches")
+
+    for api in (ViaggiaTrenoAPI, TrenordAPI):
+        api._limiter.max_rate = args.max_rate
+        api._limiter.rate = min(api._limiter.rate, args.max_rate)
+    if args.viaggiatreno_url:
+        ViaggiaTrenoAPI.BASE_URL = args.viaggiatreno_url
+    if args.trenord_url:
+        TrenordAPI.BASE_URL = args.trenord_url
+
+
+def scraping_day(now: datetime) -> date:
+    """Return the day the trains scraped at a given time are saved in.
+
+    Args:
+        now (datetime): the current time
+
+    Returns:
+        date: the day, changing at ~3 AM
+    """
     # Today + ~3 hours
-    today: date = (datetime.now(tz=TIMEZONE) - timedelta(hours=3)).date()
+    return (now - timedelta(hours=3)).date()
+
+
+def day_path(today: date) -> pathlib.Path:
+    """Return the directory of the datasets of a day, creating it if needed.
+
+    Args:
+        today (date): the considered day
+
+    Returns:
+        pathlib.Path: the day directory
+    """
     today_path: pathlib.Path = DATA_DIR / today.strftime("%Y-%m-%d")
     try:
         os.mkdir(today_path.absolute())
     except FileExistsError:
         pass
+    return today_path
 
-    station_cache: dict[str, Station] = load_dataset(DATA_DIR / "stations.pickle")
-    fetched_trains: dict[int, Train] = load_dataset(today_path / "trains.pickle")
-    unfetched_trains: dict[int, Train] = load_dataset(today_path / "unfetched.pickle")
 
-    fetched_old_n = len(fetched_trains)
-    unfetched_old_n = len(unfetched_trains)
+def open_archive(today_path: pathlib.Path) -> ResponseArchive:
+    """Archive the raw API responses in the archive of a day.
+
+    Args:
+        today_path (pathlib.Path): the day directory
+
+    Returns:
+        ResponseArchive: the opened archive
+    """
+    archive = ResponseArchive(today_path / ARCHIVE_DIRNAME)
+    ViaggiaTrenoAPI._archive = TrenordAPI._archive = archive
     logging.info(
-        f"Loaded {fetched_old_n} already fetched and {unfetched_old_n} unfetched trains"
+        f"Archiving raw responses in {archive.directory} ({len(archive)} so far)"
     )
+    return archive
 
-    # Initialize Station cache
+
+def load_station_cache(store: Store) -> None:
+    """Initialize the station cache and the region station lists.
+
+    Args:
+        store (Store): the scraper state
+    """
+    station_cache: dict[str, Station] = store.load_stations()
     if len(station_cache) != 0:
         Station._cache = station_cache
-    logging.info(f"Initialized station cache with {len(station_cache)} elements")
+    Station._regions = load_dataset(REGIONS_PATH)
+    logging.info(
+        f"Initialized station cache with {len(station_cache)} elements "
+        f"and {len(Station._regions)} region lists"
+    )
+
 
-    # Fetch stations
+def retrieve_stations(args: argparse.Namespace, today: date) -> set[Station]:
+    """Return the stations to retrieve departures from.
+
+    Args:
+        args (argparse.Namespace): the command line arguments
+        today (date): the current day
+
+    Returns:
+        set[Station]: all the stations, or the ones of the discovery plan
+    """
+    # Fetch stations (cached region lists are downloaded again weekly)
     stations: set[Station] = set(
-        itertools.chain.from_iterable([Station.by_region(r) for r in range(1, 23)])
+        itertools.chain.from_iterable([Station.by_region(r) for r in REGION_CODES])
     )
     logging.info(f"Retrieved {len(stations)} stations")
+    save_dataset(REGIONS_PATH, Station._regions)
+
+    if args.discovery_plan and (plan := load_plan(DATA_DIR, today)) is not None:
+        stations = {station for station in stations if station.code in plan.stations}
+        logging.info(
+            f"Discovery plan of {plan.created}: retrieving departures from "
+            f"{len(stations)} stations, which showed {plan.coverage or 0:.1%} "
+            "of the trains of the last day"
+        )
+    return stations
+
+
+def export_metrics(
+    args: argparse.Namespace,
+    started_at: datetime,
+    duration: float,
+    fetched_trains: t.Sized | None = None,
+    unfetched_trains: t.Sized | None = None,
+    **info: t.Any,
+) -> None:
+    """Write the metrics to a Prometheus text file (METRICS_PATH)
+    and a JSON summary of the run (in RUNS_DIR).
+
+    Args:
+        args (argparse.Namespace): the command line arguments
+        started_at (datetime): the start time of the run
+        duration (float): the duration of the run, in seconds
+        fetched_trains (t.Sized | None, optional): the fetched trains of the day
+        unfetched_trains (t.Sized | None, optional): the unfetched trains of the day
+        info (t.Any): other information to add to the summary
+    """
+    registry: metrics.Registry = metrics.REGISTRY
+    if fetched_trains is not None and unfetched_trains is not None:
+        registry.set("trains", len(fetched_trains), state="fetched")
+        registry.set("trains", len(unfetched_trains), state="unfetched")
+    registry.set("stations", len(Station._cache))
+    registry.set("run_seconds", duration)
+    registry.set("last_run_timestamp_seconds", time.time())
+
+    metrics.write_textfile(METRICS_PATH)
+    summary_path: pathlib.Path = RUNS_DIR / f"{started_at:%Y-%m-%dT%H-%M-%S}.json"
+    metrics.write_summary(
+        summary_path,
+        {
+            "started": started_at.isoformat(),
+            "duration": round(duration, 1),
+            "node_id": args.node_id,
+            "concurrency": args.concurrency,
+            "shards": args.shards,
+            "storage": args.storage,
+            **info,
+            "throttling": {
+                "ViaggiaTreno": ViaggiaTrenoAPI.throttle_status(),
+                "Trenord": TrenordAPI.throttle_status(),
+            },
+        },
+    )
+    logging.info(f"Metrics written to {METRICS_PATH} and {summary_path}")
+
+
+def scrape(
+    args: argparse.Namespace,
+    stations: t.Iterable[Station],
+    fetched_trains: dict[int, Train],
+    unfetched_trains: dict[int, Train],
+    traffic: Counter[str],
+    station_stats: dict[str, StationStats] | None,
+    slices: t.Sequence[datetime | None],
+    run_deadline: float | None,
+    archive_path: pathlib.Path | None,
+    on_loop: t.Callable[[ScrapeLoop], None] | None = None,
+) -> None:
+    """Scrape the given stations and the unfetched trains, in this process
+    or in worker processes (see run_sharded).
 
-    # Try to fetch unfetched trains
+    Args:
+        args (argparse.Namespace): the command line arguments
+        stations (t.Iterable[Station]): the stations to retrieve departures from
+        fetched_trains (dict[int, Train]): trains with no more data to fetch
+        unfetched_trains (dict[int, Train]): trains to fetch again in the next runs
+        traffic (Counter[str]): the departures of the fetched trains from each
+            station (see station_traffic), updated with the new ones
+        station_stats (dict[str, StationStats] | None): the polling statistics,
+            if adaptive polling is enabled
+        slices (t.Sequence[datetime | None]): the times the departure boards
+            are retrieved at
+        run_deadline (float | None): no job is started after this time
+        archive_path (pathlib.Path | None): the archive of raw responses, if any
+        on_loop (t.Callable[[ScrapeLoop], None] | None, optional): called with
+            the scraping loop before it is run in this process
+    """
     logging.info(
-        f"Starting fetching {len(unfetched_trains)} previously unfetched trains"
+        f"Starting fetching {len(unfetched_trains)} previously unfetched trains "
+        f"and departures from all stations ({args.concurrency} concurrent requests)"
+    )
+    if args.shards > 1:
+        run_sharded(
+            args.shards,
+            stations,
+            fetched_trains,
+            unfetched_trains,
+            concurrency=args.concurrency,
+            traffic=traffic,
+            deadline=run_deadline,
+            arrival_boards=args.arrival_boards,
+            station_stats=station_stats,
+            board_slices=slices,
+            archive_path=archive_path,
+        )
+        return
+
+    loop = ScrapeLoop(
+        fetched_trains,
+        unfetched_trains,
+        concurrency=args.concurrency,
+        traffic=traffic,
+        deadline=run_deadline,
+        arrival_boards=args.arrival_boards,
+        station_stats=station_stats,
+        board_slices=slices,
+    )
+    if on_loop is not None:
+        on_loop(loop)
+    loop.run(stations)
+
+
+def main(args: argparse.Namespace) -> None:
+    started: float = time.monotonic()
+    started_at: datetime = datetime.now(tz=TIMEZONE)
+    run_deadline: float | None = (
+        deadline(started, args.time_budget) if args.time_budget else None
+    )
+
+    setup(args)
+
+    if args.node_id and args.storage != "pickle":
+        logging.critical("The cluster mode (--node-id) only supports pickle storage")
+        sys.exit(1)
+
+    if args.daemon:
+        if args.node_id:
+            logging.critical("The daemon mode does not support --node-id")
+            sys.exit(1)
+        daemon.ScraperDaemon(args).run()
+        return
+
+    today: date = scraping_day(started_at)
+    today_path: pathlib.Path = day_path(today)
+
+    archive: ResponseArchive | None = None
+    if args.archive_responses:
+        archive = open_archive(today_path)
+
+    station_stats: dict[str, StationStats] | None = (
+        load_dataset(STATS_PATH) if args.adaptive_polling else None
+    )
+    store: Store = open_store(args.storage, DATA_DIR)
+    load_station_cache(store)
+    stations: set[Station] = retrieve_stations(args, today)
+
+    slices: list[datetime | None] = [None]
+    if args.time_slices:
+        last_run: datetime | None = load_dataset(LAST_RUN_PATH) or None
+        slices = board_slices(last_run, started_at)
+        logging.info(
+            f"Retrieving departure boards at {len(slices)} times since {last_run}"
+        )
+
+    if args.node_id:
+        # The trains of the day are loaded and saved by the cluster jobs
+        store.close()
+        logging.info(
+            f"Starting fetching previously unfetched trains and departures "
+            f"from all stations ({args.concurrency} concurrent requests)"
+        )
+        cluster = Cluster(
+            args.node_id,
+            today_path,
+            DATA_DIR / "stations.pickle",
+            stats_path=STATS_PATH if args.adaptive_polling else None,
+            lease_ttl=args.lease_ttl,
+        )
+        cluster.run(
+            stations,
+            concurrency=args.concurrency,
+            deadline=run_deadline,
+            arrival_boards=args.arrival_boards,
+            board_slices=slices,
+        )
+        if args.time_slices:
+            save_dataset(LAST_RUN_PATH, started_at)
+        if archive is not None:
+            archive.close()
+        logging.info(f"Station cache size: {len(Station._cache)}")
+        export_metrics(args, started_at, time.monotonic() - started)
+        return
+
+    fetched_trains, unfetched_trains = store.load_trains(today)
+    traffic: Counter[str] = store.load_traffic(today)
+    fetched_old_n = len(fetched_trains)
+    unfetched_old_n = len(unfetched_trains)
+    logging.info(
+        f"Loaded {fetched_old_n} already fetched and {unfetched_old_n} unfetched trains"
+    )
+
+    scrape(
+        args,
+        stations,
+        fetched_trains,
+        unfetched_trains,
+        traffic,
+        station_stats,
+        slices,
+        run_deadline,
+        archive.directory if archive is not None else None,
     )
-    _fetched_trains_delete_later: list[int] = list()
-    for unfetched_train_hash in tqdm(unfetched_trains):
-        train = unfetched_trains[unfetched_train_hash]
-        try:
-            train.fetch()
-        except Exception as e:
-            logging.exception(e, exc_info=True)
-            continue
-
-        if train._phantom or train.arrived():
-            fetched_trains[unfetched_train_hash] = train
-            logging.debug(f"Saved previously unfetched {train.category} {train.number}")
-
-            # It is not possible to delete dict keys in-place
-            _fetched_trains_delete_later.append(unfetched_train_hash)
-
-    for to_delete in _fetched_trains_delete_later:
-        del unfetched_trains[to_delete]
-
-    logging.info("Starting fetching departures from all stations")
-    for station in tqdm(stations):
-        logging.debug(f"Processing {station}")
-
-        departing: list[Train] = station.departures()
-        for train in departing:
-            if hash(train) in fetched_trains or hash(train) in unfetched_trains:
-                continue
-
-            try:
-                train.fetch()
-            except Exception as e:
-                logging.exception(e, exc_info=True)
-                continue
-
-            if train._phantom or train.arrived():
-                fetched_trains[hash(train)] = train
-                logging.debug(f"Saved {train.category} {train.number}")
-            else:
-                unfetched_trains[hash(train)] = train
 
     logging.info(f"Retrieved {len(fetched_trains) - fetched_old_n} new trains")
     logging.info(
@@ -160,9 +560,28 @@ def main() -> None:
         f"({(len(unfetched_trains) - unfetched_old_n):+d})"
     )
 
-    save_dataset(DATA_DIR / "stations.pickle", Station._cache)
-    save_dataset(today_path / "trains.pickle", fetched_trains)
-    save_dataset(today_path / "unfetched.pickle", unfetched_trains)
+    logging.info(f"ViaggiaTreno API throttling: {ViaggiaTrenoAPI.throttle_status()}")
+    logging.info(f"Trenord API throttling: {TrenordAPI.throttle_status()}")
+
+    store.save_stations(Station._cache)
+    if station_stats is not None:
+        save_dataset(STATS_PATH, station_stats)
+    if args.time_slices:
+        save_dataset(LAST_RUN_PATH, started_at)
+    store.save_trains(today, fetched_trains, unfetched_trains)
+    store.save_traffic(today, traffic)
+    store.close()
+    if archive is not None:
+        archive.close()
 
     logging.info(f"Trains saved today: {len(fetched_trains)}")
     logging.info(f"Station cache size: {len(Station._cache)}")
+    logging.info(f"Run completed in {time.monotonic() - started:.0f} s")
+    export_metrics(
+        args,
+        started_at,
+        time.monotonic() - started,
+        fetched_trains,
+        unfetched_trains,
+        new_trains=len(fetched_trains) - fetched_old_n,
+    )
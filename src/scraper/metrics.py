@@ -0,0 +1,400 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import bisect
+import contextlib
+import json
+import os
+import pathlib
+import threading
+import time
+import typing as t
+
+# Prefix of the exported metric names
+PREFIX: str = "railway_scraper_"
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS: t.Tuple[float, ...] = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+# Metric name: (type, description)
+METRICS: dict[str, t.Tuple[str, str]] = {
+    "requests_total": ("counter", "API requests, by response status"),
+    "request_retries_total": ("counter", "API requests retried after throttling"),
+    "response_bytes_total": ("counter", "Bytes of the successful API responses"),
+    "request_seconds": ("histogram", "API request latency, including retries"),
+    "decode_seconds": (
+        "histogram",
+        "JSON decoding time of the API responses, by endpoint",
+    ),
+    "jobs_total": ("counter", "Scraping loop jobs, by phase and outcome"),
+    "job_seconds": ("histogram", "Scraping loop job duration, by phase"),
+    "trains_total": ("counter", "Fetched trains, by outcome"),
+    "station_cache_total": ("counter", "Station cache lookups, by result"),
+    "trains": ("gauge", "Trains in the datasets of the day"),
+    "stations": ("gauge", "Stations in the station cache"),
+    "run_seconds": ("gauge", "Duration of the last run"),
+    "last_run_timestamp_seconds": ("gauge", "End time of the last run"),
+}
+
+Labels = t.Tuple[t.Tuple[str, str], ...]
+
+
+class Histogram:
+    """Observations counted in cumulative buckets (see BUCKETS).
+
+    Attributes:
+        counts (list[int]): the observations in each bucket (not cumulative),
+            the last one is for values over the last bound
+        sum (float): the sum of the observed values
+    """
+
+    __slots__ = ("counts", "sum")
+
+    def __init__(self) -> None:
+        self.counts: list[int] = [0] * (len(BUCKETS) + 1)
+        self.sum: float = 0.0
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+    def merge(self, other: "Histogram") -> None:
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+
+    def quantile(self, q: float) -> float | None:
+        """Estimate a quantile as the upper bound of its bucket.
+
+        Args:
+            q (float): the quantile (0-1)
+
+        Returns:
+            float | None: the estimate, None if there are no observations
+            (or the quantile is over the last bound, as inf)
+        """
+        total: int = self.count
+        if total == 0:
+            return None
+
+        seen: int = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return float("inf")
+
+
+class Registry:
+    """Thread-safe registry of counters, gauges and histograms.
+
+    Every metric is identified by its name (see METRICS) and a set of labels.
+    Values are kept in memory and exported as a Prometheus text file
+    or a JSON summary.
+    """
+
+    def __init__(self) -> None:
+        self._lock: threading.Lock = threading.Lock()
+        self._values: dict[str, dict[Labels, float]] = dict()
+        self._histograms: dict[str, dict[Labels, Histogram]] = dict()
+        self.started: float = time.time()
+
+    @staticmethod
+    def _labels(labels: dict[str, t.Any]) -> Labels:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels: t.Any) -> None:
+        """Increment a counter.
+
+        Args:
+            name (str): the metric name
+            value (float, optional): the increment. Defaults to 1
+            labels (t.Any): the metric labels
+        """
+        assert METRICS[name][0] == "counter"
+        key: Labels = self._labels(labels)
+        with self._lock:
+            values: dict[Labels, float] = self._values.setdefault(name, dict())
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: t.Any) -> None:
+        """Set a gauge.
+
+        Args:
+            name (str): the metric name
+            value (float): the value
+            labels (t.Any): the metric labels
+        """
+        assert METRICS[name][0] == "gauge"
+        with self._lock:
+            self._values.setdefault(name, dict())[self._labels(labels)] = value
+
+    def observe(self, name: str, value: float, **labels: t.Any) -> None:
+        """Add an observation to a histogram.
+
+        Args:
+            name (str): the metric name
+            value (float): the observed value, in seconds
+            labels (t.Any): the metric labels
+        """
+        assert METRICS[name][0] == "histogram"
+        key: Labels = self._labels(labels)
+        with self._lock:
+            histograms: dict[Labels, Histogram] = self._histograms.setdefault(
+                name, dict()
+            )
+            histograms.setdefault(key, Histogram()).observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels: t.Any) -> t.Iterator[None]:
+        """Observe the duration of a block in a histogram.
+
+        Args:
+            name (str): the metric name
+            labels (t.Any): the metric labels
+        """
+        started: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def value(self, name: str, **labels: t.Any) -> float:
+        """Return the value of a counter or a gauge (0 if never set).
+
+        Args:
+            name (str): the metric name
+            labels (t.Any): the metric labels
+
+        Returns:
+            float: the value
+        """
+        with self._lock:
+            return self._values.get(name, dict()).get(self._labels(labels), 0)
+
+    def histogram(self, name: str, **labels: t.Any) -> Histogram:
+        """Return a copy of a histogram (empty if never observed).
+
+        Args:
+            name (str): the metric name
+            labels (t.Any): the metric labels
+
+        Returns:
+            Histogram: the histogram
+        """
+        copy: Histogram = Histogram()
+        with self._lock:
+            histogram: Histogram | None = self._histograms.get(name, dict()).get(
+                self._labels(labels)
+            )
+            if histogram is not None:
+                copy.merge(histogram)
+        return copy
+
+    def snapshot(self) -> dict[str, t.Any]:
+        """Return a copy of the metrics, e.g. to send them to another process.
+
+        Returns:
+            dict[str, t.Any]: the counters and gauges, and the histograms
+        """
+        with self._lock:
+            values = {name: dict(values) for name, values in self._values.items()}
+            histograms: dict[str, dict[Labels, Histogram]] = dict()
+            for name, by_labels in self._histograms.items():
+                histograms[name] = dict()
+                for key, histogram in by_labels.items():
+                    histograms[name][key] = Histogram()
+                    histograms[name][key].merge(histogram)
+        return {"values": values, "histograms": histograms}
+
+    def merge(self, snapshot: dict[str, t.Any]) -> None:
+        """Merge the metrics of another registry (see snapshot).
+        Counters and histograms are summed, gauges are overwritten.
+
+        Args:
+            snapshot (dict[str, t.Any]): the metrics to merge
+        """
+        with self._lock:
+            for name, values in snapshot["values"].items():
+                own: dict[Labels, float] = self._values.setdefault(name, dict())
+                for key, value in values.items():
+                    if METRICS[name][0] == "counter":
+                        value += own.get(key, 0)
+                    own[key] = value
+            for name, histograms in snapshot["histograms"].items():
+                own_histograms: dict[Labels, Histogram] = self._histograms.setdefault(
+                    name, dict()
+                )
+                for key, histogram in histograms.items():
+                    own_histograms.setdefault(key, Histogram()).merge(histogram)
+
+    def reset(self) -> None:
+        """Drop all the metrics."""
+        with self._lock:
+            self._values.clear()
+            self._histograms.clear()
+            self.started = time.time()
+
+    def to_prometheus(self) -> str:
+        """Format the metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: the formatted metrics
+        """
+        snapshot: dict[str, t.Any] = self.snapshot()
+        lines: list[str] = list()
+        for name, (kind, description) in METRICS.items():
+            values: dict[Labels, float] = snapshot["values"].get(name, dict())
+            histograms: dict[Labels, Histogram] = snapshot["histograms"].get(
+                name, dict()
+            )
+            if not values and not histograms:
+                continue
+
+            lines.append(f"# HELP {PREFIX}{name} {description}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+            for key, value in sorted(values.items()):
+                lines.append(f"{PREFIX}{name}{_format_labels(key)} {_number(value)}")
+            for key, histogram in sorted(histograms.items()):
+                cumulative: int = 0
+                for bound, count in zip((*BUCKETS, float("inf")), histogram.counts):
+                    cumulative += count
+                    bucket: Labels = (*key, ("le", _number(bound)))
+                    lines.append(
+                        f"{PREFIX}{name}_bucket{_format_labels(bucket)} {cumulative}"
+                    )
+                labels: str = _format_labels(key)
+                lines.append(f"{PREFIX}{name}_sum{labels} {_number(histogram.sum)}")
+                lines.append(f"{PREFIX}{name}_count{labels} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict[str, t.Any]:
+        """Summarize the metrics in a JSON serializable dict.
+
+        Histograms are summarized by their count, sum, mean
+        and estimated median and 95th percentile.
+
+        Returns:
+            dict[str, t.Any]: the metrics, by name and labels
+        """
+        snapshot: dict[str, t.Any] = self.snapshot()
+        summary: dict[str, t.Any] = dict()
+        for name, values in snapshot["values"].items():
+            summary[name] = {_label_key(key): value for key, value in values.items()}
+        for name, histograms in snapshot["histograms"].items():
+            summary[name] = {
+                _label_key(key): {
+                    "count": histogram.count,
+                    "sum": round(histogram.sum, 3),
+                    "mean": round(histogram.sum / histogram.count, 4)
+                    if histogram.count
+                    else None,
+                    "p50": _json_number(histogram.quantile(0.5)),
+                    "p95": _json_number(histogram.quantile(0.95)),
+                }
+                for key, histogram in histograms.items()
+            }
+        return summary
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _json_number(value: float | None) -> float | str | None:
+    return "+Inf" if value == float("inf") else value
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _label_key(labels: Labels) -> str:
+    """Format labels as a JSON key (e.g. api=ViaggiaTrenoAPI,method=partenze)."""
+    return ",".join(f"{key}={value}" for key, value in labels)
+
+
+def _write_atomic(path: pathlib.Path, content: str) -> None:
+    """Write a file atomically, so readers never see a partial file."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp: pathlib.Path = path.with_name(f".{path.name}.tmp")
+    with open(tmp, "w") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def write_textfile(path: pathlib.Path, registry: "Registry | None" = None) -> None:
+    """Write the metrics to a Prometheus text file
+    (e.g. for the textfile collector of the node exporter).
+
+    Args:
+        path (pathlib.Path): the file to write
+        registry (Registry | None, optional): the registry. Defaults to REGISTRY
+    """
+    _write_atomic(path, (registry or REGISTRY).to_prometheus())
+
+
+def write_summary(
+    path: pathlib.Path, info: dict[str, t.Any], registry: "Registry | None" = None
+) -> None:
+    """Write a JSON summary of a run.
+
+    Args:
+        path (pathlib.Path): the file to write
+        info (dict[str, t.Any]): the run information (e.g. start time and duration)
+        registry (Registry | None, optional): the registry. Defaults to REGISTRY
+    """
+    registry = registry or REGISTRY
+    _write_atomic(
+        path,
+        json.dumps(
+            {
+                **info,
+                "metrics_since": registry.started,
+                "metrics": registry.summary(),
+            },
+            indent=2,
+        ),
+    )
+
+
+# The registry of this process
+REGISTRY: Registry = Registry()
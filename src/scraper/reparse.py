@@ -0,0 +1,223 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import logging
+import os
+import pathlib
+import typing as t
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from src.scraper.api import BoardKey, TrenordAPI, ViaggiaTrenoAPI
+from src.scraper.archive import ARCHIVE_DIRNAME, ArchiveEntry, ResponseArchive
+from src.scraper.dataset import load_dataset, save_dataset
+from src.scraper.station import Station
+from src.scraper.train import Train
+
+DATA_DIR = pathlib.Path("data/")
+
+# Directory of the rebuilt datasets, in the directory of each day
+REPARSED_DIRNAME: str = "reparsed"
+
+
+def register_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "days",
+        type=pathlib.Path,
+        nargs="+",
+        metavar="DAY_DIR",
+        help="day directories (e.g. data/2023-05-01) with an archive of raw responses",
+    )
+    parser.add_argument(
+        "--stations",
+        type=pathlib.Path,
+        default=DATA_DIR / "stations.pickle",
+        help=f"station cache. Defaults to {DATA_DIR / 'stations.pickle'}",
+    )
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument(
+        "-o",
+        "--output-dir",
+        type=pathlib.Path,
+        help=(
+            "directory to save the datasets in, in a subdirectory for each day. "
+            f"Defaults to a '{REPARSED_DIRNAME}' subdirectory of each day directory"
+        ),
+    )
+    output.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="save the datasets in the day directories, overwriting the scraped ones",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        metavar="N",
+        help="number of days processed in parallel. Defaults to the number of CPUs",
+    )
+
+
+def _board_entries(archive: ResponseArchive) -> dict[int, dict]:
+    """Return the last departure board entry of each train in an archive.
+
+    Args:
+        archive (ResponseArchive): the archive
+
+    Returns:
+        dict[int, dict]: the board entries, by train key (see Train.key)
+    """
+    entries: dict[int, dict] = dict()
+    decoded: set[str] = set()
+    for entry in archive.entries:
+        if entry.api != ViaggiaTrenoAPI.__name__ or entry.method != "partenze":
+            continue
+        if entry.status != 200 or entry.digest in decoded:
+            continue
+        decoded.add(entry.digest)
+
+        for train_data in ViaggiaTrenoAPI._decode_json(
+            archive.read(entry), entry.method
+        ):
+            if train_data.get("dataPartenzaTreno") is None:
+                continue
+            key: BoardKey = (
+                train_data["numeroTreno"],
+                train_data["codOrigine"],
+                train_data["dataPartenzaTreno"],
+            )
+            entries[Train._board_hash(key)] = train_data
+    return entries
+
+
+def reparse_day(
+    day_path: pathlib.Path,
+    station_cache: dict[str, Station],
+    output_path: pathlib.Path | None = None,
+) -> t.Tuple[int, int]:
+    """Rebuild the train datasets of a day from its archive of raw responses,
+    with no requests.
+
+    Every train fetched in the day is built again from its last departure
+    board entry and its last details (and Trenord data), as the scraper would.
+    Trains whose details were not found are phantom; trains seen on
+    a departure board but never fetched are unfetched.
+
+    Args:
+        day_path (pathlib.Path): the day directory
+        station_cache (dict[str, Station]): the station cache
+        output_path (pathlib.Path | None, optional): the directory to save
+            the datasets in. Defaults to the 'reparsed' subdirectory of the day
+            directory (see REPARSED_DIRNAME)
+
+    Returns:
+        t.Tuple[int, int]: the number of fetched and unfetched trains
+    """
+    archive = ResponseArchive(day_path / ARCHIVE_DIRNAME)
+    Station._cache = dict(station_cache)
+    ViaggiaTrenoAPI._replay = TrenordAPI._replay = archive
+    try:
+        fetched_trains, unfetched_trains = _rebuild_trains(archive)
+    finally:
+        ViaggiaTrenoAPI._replay = TrenordAPI._replay = None
+
+    output_path = output_path or day_path / REPARSED_DIRNAME
+    output_path.mkdir(parents=True, exist_ok=True)
+    save_dataset(output_path / "trains.pickle", fetched_trains)
+    save_dataset(output_path / "unfetched.pickle", unfetched_trains)
+    return len(fetched_trains), len(unfetched_trains)
+
+
+def _rebuild_trains(
+    archive: ResponseArchive,
+) -> t.Tuple[dict[int, Train], dict[int, Train]]:
+    """Build the trains fetched in an archive, replaying the archived responses.
+    Helper function to reparse_day().
+
+    Args:
+        archive (ResponseArchive): the archive, set as replay of both APIs
+
+    Returns:
+        t.Tuple[dict[int, Train], dict[int, Train]]: the fetched and unfetched trains
+    """
+    board: dict[int, dict] = _board_entries(archive)
+    fetched_trains: dict[int, Train] = dict()
+    unfetched_trains: dict[int, Train] = dict()
+    seen: set[t.Tuple[str, ...]] = set()
+    for entry in archive.entries:
+        if entry.api != ViaggiaTrenoAPI.__name__ or entry.method != "andamentoTreno":
+            continue
+        if entry.parameters in seen:
+            continue
+        seen.add(entry.parameters)
+
+        origin_code, number, midnight = entry.parameters
+        key: int = Train._board_hash((int(number), origin_code, int(midnight)))
+        train: Train
+        if key in board:
+            train = Train._from_station_departures_arrivals(board[key])
+        else:
+            train = Train(
+                int(number),
+                Station.by_code(origin_code),
+                Train._midnight_date(int(midnight)),
+            )
+        train.fetch()
+
+        latest: ArchiveEntry | None = archive.latest(
+            entry.api, entry.method, entry.parameters
+        )
+        assert latest is not None
+        if train._fetched:
+            train._fetched = datetime.fromtimestamp(latest.time)
+
+        if train._phantom or train.arrived():
+            fetched_trains[train.key] = train
+        else:
+            unfetched_trains[train.key] = train
+
+    # Trains seen on a departure board, whose details were never requested
+    # (e.g. not departed yet): the scraper keeps them as unfetched
+    for key, train_data in board.items():
+        if key not in fetched_trains and key not in unfetched_trains:
+            unfetched_trains[key] = Train._from_station_departures_arrivals(train_data)
+    return fetched_trains, unfetched_trains
+
+
+def main(args: argparse.Namespace) -> None:
+    station_cache: dict[str, Station] = load_dataset(args.stations)
+    logging.info(f"Loaded {len(station_cache)} stations")
+
+    days: list[pathlib.Path] = [
+        day for day in args.days if (day / ARCHIVE_DIRNAME).is_dir()
+    ]
+    for day in set(args.days) - set(days):
+        logging.warning(f"No archive of raw responses in {day}, skipping")
+
+    outputs: list[pathlib.Path | None] = [
+        day
+        if args.overwrite
+        else (args.output_dir / day.name if args.output_dir else None)
+        for day in days
+    ]
+    with ProcessPoolExecutor(max_workers=args.processes) as executor:
+        results: t.Iterator[t.Tuple[int, int]] = executor.map(
+            reparse_day, days, [station_cache] * len(days), outputs
+        )
+        for day, (fetched, unfetched) in zip(days, results):
+            logging.info(f"{day}: {fetched} fetched and {unfetched} unfetched trains")
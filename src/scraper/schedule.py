@@ -0,0 +1,422 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import typing as t
+from collections import Counter
+from datetime import datetime, timedelta
+
+import src.scraper.api as api
+import src.scraper.train_stop as tr_st
+from src.const import TIMEZONE
+from src.scraper.station import Station
+from src.scraper.train import Train
+
+# Job priorities: lower values are processed first.
+# A (tier, key) pair is compared lexicographically.
+Priority = t.Tuple[int, float]
+
+# Trains which probably arrived since the last fetch: fetching them saves a train
+TIER_ARRIVED: int = 0
+
+# Departure boards and the trains they reveal
+TIER_DISCOVERY: int = 1
+
+# Trains still running: fetching them only updates partial data
+TIER_RUNNING: int = 2
+
+# Trenord data of the fetched trains, retrieved after the ViaggiaTreno data
+TIER_ENRICHMENT: int = 3
+
+TIER_NAMES: dict[int, str] = {
+    TIER_ARRIVED: "arrived",
+    TIER_DISCOVERY: "discovery",
+    TIER_RUNNING: "running",
+    TIER_ENRICHMENT: "enrichment",
+}
+
+# Fraction of the time budget reserved to save the datasets
+SAVE_RESERVE: float = 0.1
+
+# Upper bound of the reserved time, in seconds
+MAX_SAVE_RESERVE: float = 120.0
+
+# First delay between two fetches of a train which should have arrived;
+# it doubles at every fetch, up to MAX_REFETCH_BACKOFF
+REFETCH_BACKOFF: timedelta = timedelta(minutes=15)
+MAX_REFETCH_BACKOFF: timedelta = timedelta(hours=4)
+
+# Trains not arrived this long after their expected arrival are saved as they are
+MAX_OVERDUE: timedelta = timedelta(hours=12)
+
+# Weight of the last poll in the average rate of new trains of a station board
+POLL_EWMA_ALPHA: float = 0.3
+
+# Time span of the trains shown by a departure board (approximate)
+BOARD_WINDOW: timedelta = timedelta(hours=1)
+
+# Every station board is retrieved at least this often, so no train is missed:
+# trains departing later than BOARD_WINDOW are not shown yet
+MAX_POLL_INTERVAL: timedelta = BOARD_WINDOW
+
+# Boards are retrieved up to this long into a run: a board is due again
+# this long before MAX_POLL_INTERVAL, to be retrieved by the next hourly run
+POLL_TOLERANCE: timedelta = timedelta(minutes=15)
+
+# A board is retrieved again this long before its last train departs
+# (about the interval between two runs)
+POLL_AHEAD: timedelta = timedelta(hours=1)
+
+# Past boards are not retrieved further back than this
+MAX_LOOKBACK: timedelta = timedelta(hours=12)
+
+
+class StationStats:
+    """Polling statistics of the departure board of a station.
+
+    Attributes:
+        polls (int): the number of times the board has been retrieved
+        rate (float): the average number of new trains per hour shown by the board
+        last_poll (datetime | None): the last time the board has been retrieved
+        next_poll (datetime | None): the time the board should be retrieved again at
+    """
+
+    def __init__(self) -> None:
+        """Initialize new statistics of a never polled station."""
+        self.polls: int = 0
+        self.rate: float = 0.0
+        self.last_poll: datetime | None = None
+        self.next_poll: datetime | None = None
+
+    def due(self, now: datetime) -> bool:
+        """Return True if the board should be retrieved.
+
+        Args:
+            now (datetime): the current time
+
+        Returns:
+            bool: True if the board has never been retrieved or it is time to
+        """
+        return self.next_poll is None or self.next_poll <= now
+
+    def record(self, now: datetime, new_trains: int, horizon: datetime | None) -> None:
+        """Update the statistics after the board has been retrieved,
+        and schedule the next poll.
+
+        The board is retrieved again when a new train is expected, based on
+        the average rate of new trains, but before the last train shown on the
+        board departs (trains departing after it are not shown yet),
+        and not later than MAX_POLL_INTERVAL (less POLL_TOLERANCE).
+
+        Args:
+            now (datetime): the current time
+            new_trains (int): the number of new trains shown by the board
+            horizon (datetime | None): the departure time of the last train
+                shown by the board, if any
+        """
+        hours: float = 1.0
+        if self.last_poll is not None:
+            hours = max((now - self.last_poll).total_seconds() / 3600, 1 / 60)
+
+        sample: float = new_trains / hours
+        self.rate = (
+            sample
+            if self.polls == 0
+            else POLL_EWMA_ALPHA * sample + (1 - POLL_EWMA_ALPHA) * self.rate
+        )
+        self.polls += 1
+        self.last_poll = now
+
+        interval: timedelta = MAX_POLL_INTERVAL - POLL_TOLERANCE
+        if self.rate > 0:
+            interval = min(interval, timedelta(hours=1 / self.rate))
+        self.next_poll = now + interval
+        if horizon is not None:
+            self.next_poll = min(self.next_poll, horizon - POLL_AHEAD)
+
+    def __repr__(self) -> str:
+        return (
+            f"StationStats [{self.polls} polls, {self.rate:.2f} new trains/h, "
+            f"next: {self.next_poll}]"
+        )
+
+
+def merge_station_stats(
+    stats: dict[str, StationStats], other: t.Mapping[str, StationStats]
+) -> None:
+    """Merge station statistics, keeping the most recent ones of each station.
+
+    Args:
+        stats (dict[str, StationStats]): the statistics to update
+        other (t.Mapping[str, StationStats]): the statistics to merge
+    """
+    for code, station_stats in other.items():
+        current: StationStats | None = stats.get(code)
+        if (
+            current is None
+            or current.last_poll is None
+            or (
+                station_stats.last_poll is not None
+                and station_stats.last_poll > current.last_poll
+            )
+        ):
+            stats[code] = station_stats
+
+
+def board_slices(
+    since: datetime | None,
+    now: datetime,
+    window: timedelta = BOARD_WINDOW,
+) -> list[datetime | None]:
+    """Return the times the departure boards should be retrieved at,
+    to show all the trains departed since the last run.
+
+    Boards are spaced by their window, starting from the last run
+    (at most MAX_LOOKBACK ago); the last board is the current one (None).
+
+    Args:
+        since (datetime | None): the time of the last run, if any
+        now (datetime): the current time
+        window (timedelta, optional): the time span of a board
+
+    Returns:
+        list[datetime | None]: the board times, None meaning now
+    """
+    slices: list[datetime | None] = list()
+    if since is not None:
+        when: datetime = max(since, now - MAX_LOOKBACK)
+        while when < now:
+            slices.append(when)
+            when += window
+    slices.append(None)
+    return slices
+
+
+def deadline(started: float, budget: float) -> float:
+    """Return the time jobs should stop being started at, leaving room
+    to save the results within the time budget.
+
+    Args:
+        started (float): the run start time (time.monotonic())
+        budget (float): the time budget of the run, in seconds
+
+    Returns:
+        float: the deadline, comparable with time.monotonic()
+    """
+    return started + budget - min(budget * SAVE_RESERVE, MAX_SAVE_RESERVE)
+
+
+def expected_arrival(train: Train) -> datetime | None:
+    """Estimate the arrival time of a fetched train at its destination.
+
+    The scheduled arrival time of the last stop is shifted by the
+    current delay of the train.
+
+    Args:
+        train (Train): the considered train
+
+    Returns:
+        datetime | None: the estimated arrival time, None if unknown
+    """
+    if not train.stops:
+        return None
+
+    last_stop: tr_st.TrainStop | None = next(
+        (stop for stop in reversed(train.stops) if stop.arrival is not None), None
+    )
+    if last_stop is None:
+        return None
+
+    assert isinstance(last_stop.arrival, tr_st.TrainStopTime)
+    expected: datetime = last_stop.arrival.expected
+    if expected.tzinfo is None:
+        expected = expected.replace(tzinfo=TIMEZONE)
+    return expected + timedelta(minutes=train.delay or 0)
+
+
+def train_priority(train: Train, now: datetime) -> Priority:
+    """Return the priority of fetching again a previously unfetched train.
+
+    Trains which should have arrived go first, the most overdue first;
+    then the running trains, the nearest to the arrival first.
+
+    Args:
+        train (Train): the considered train
+        now (datetime): the current time
+
+    Returns:
+        Priority: the job priority
+    """
+    eta: datetime | None = expected_arrival(train)
+    if eta is None:
+        # Never fetched (e.g. skipped by a previous run)
+        return (TIER_DISCOVERY, float("-inf"))
+
+    remaining: float = (eta - now).total_seconds()
+    return (TIER_ARRIVED if remaining <= 0 else TIER_RUNNING, remaining)
+
+
+def station_priority(station: Station, traffic: t.Mapping[str, int]) -> Priority:
+    """Return the priority of retrieving the departures of a station.
+
+    Busier stations go first.
+
+    Args:
+        station (Station): the considered station
+        traffic (t.Mapping[str, int]): the number of departures seen at each station
+
+    Returns:
+        Priority: the job priority
+    """
+    return (TIER_DISCOVERY, -traffic.get(station.code, 0))
+
+
+def new_train_priority() -> Priority:
+    """Return the priority of fetching a train seen in a departure board.
+
+    Newly seen trains are fetched before other boards are retrieved.
+
+    Returns:
+        Priority: the job priority
+    """
+    return (TIER_DISCOVERY, float("-inf"))
+
+
+def enrichment_priority(trains: int) -> Priority:
+    """Return the priority of fetching the Trenord data of trains with the same number.
+
+    Args:
+        trains (int): the number of trains enriched by the request
+
+    Returns:
+        Priority: the job priority
+    """
+    return (TIER_ENRICHMENT, -trains)
+
+
+def train_departures(train: Train) -> list[str]:
+    """Return the stations a train departs from.
+
+    Args:
+        train (Train): the considered train
+
+    Returns:
+        list[str]: the station codes of the stops with a departure,
+            the origin code if the stops are unknown
+    """
+    if not train.stops:
+        return [train.origin.code]
+    return [stop.station.code for stop in train.stops if stop.departure is not None]
+
+
+def station_traffic(trains: t.Iterable[Train]) -> Counter[str]:
+    """Count the departures of the given trains from each station.
+
+    Args:
+        trains (t.Iterable[Train]): the trains, e.g. the ones saved today
+
+    Returns:
+        Counter[str]: the number of departures by station code
+    """
+    traffic: Counter[str] = Counter()
+    for train in trains:
+        traffic.update(train_departures(train))
+    return traffic
+
+
+def refetch_due(train: Train, now: datetime) -> bool:
+    """Return True if fetching a train (again) could give new data.
+
+    Args:
+        train (Train): the considered train
+        now (datetime): the current time
+
+    Returns:
+        bool: False if the train has been scheduled to be fetched later
+    """
+    next_fetch: datetime | None = getattr(train, "_next_fetch", None)
+    return next_fetch is None or next_fetch <= now
+
+
+def refetch_expired(train: Train, now: datetime) -> bool:
+    """Return True if a train should have arrived for too long
+    and should not be fetched anymore.
+
+    Args:
+        train (Train): the considered train
+        now (datetime): the current time
+
+    Returns:
+        bool: True if the train is overdue by more than MAX_OVERDUE
+    """
+    eta: datetime | None = expected_arrival(train)
+    return eta is not None and now - eta > MAX_OVERDUE
+
+
+def schedule_refetch(train: Train, now: datetime) -> None:
+    """Schedule the next fetch of a train which has not arrived yet.
+
+    A running train is fetched again when it is expected to arrive;
+    after that, with an exponential backoff.
+
+    Args:
+        train (Train): the fetched train
+        now (datetime): the current time
+    """
+    eta: datetime | None = expected_arrival(train)
+    if eta is not None and eta > now:
+        train._next_fetch = eta
+        return
+
+    train._refetches = getattr(train, "_refetches", 0) + 1
+    train._next_fetch = now + min(
+        REFETCH_BACKOFF * 2 ** (train._refetches - 1), MAX_REFETCH_BACKOFF
+    )
+
+
+def board_eta(train_data: dict) -> datetime | None:
+    """Estimate the arrival time of a train shown in an arrival board,
+    using the delay reported by the board.
+
+    Args:
+        train_data (dict): the arrival board entry
+
+    Returns:
+        datetime | None: the estimated arrival time, None if unknown
+    """
+    scheduled: datetime | None = api.ViaggiaTrenoAPI._to_datetime(
+        train_data.get("orarioArrivo")
+    )
+    if scheduled is None:
+        return None
+    return scheduled + timedelta(minutes=train_data.get("ritardo") or 0)
+
+
+def arrived_on_board(train_data: dict, now: datetime) -> bool:
+    """Return True if a train shown in an arrival board has probably arrived.
+
+    Args:
+        train_data (dict): the arrival board entry
+        now (datetime): the current time
+
+    Returns:
+        bool: True if the train is in the station or it should have arrived
+    """
+    if train_data.get("inStazione"):
+        return True
+
+    eta: datetime | None = board_eta(train_data)
+    return eta is None or eta <= now
@@ -0,0 +1,281 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import pathlib
+import typing as t
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import src.scraper.metrics as metrics
+import src.scraper.tracing as tracing
+from src.scraper.api import TrenordAPI, ViaggiaTrenoAPI
+from src.scraper.archive import ResponseArchive
+from src.scraper.loop import DEFAULT_CONCURRENCY, ScrapeLoop
+from src.scraper.schedule import StationStats, merge_station_stats, train_departures
+from src.scraper.station import REGION_CODES, Station
+from src.scraper.train import Train
+
+
+class ShardResult(t.NamedTuple):
+    """The trains, stations and metrics collected by a shard worker."""
+
+    fetched_trains: dict[int, Train]
+    unfetched_trains: dict[int, Train]
+    station_cache: dict[str, Station]
+    station_stats: dict[str, StationStats] | None = None
+    metrics: dict[str, t.Any] | None = None
+
+
+def train_region(train: Train) -> int:
+    """Return the region a train is assigned to: the one of its origin.
+
+    Trains whose origin has no known region are spread over all regions.
+
+    Args:
+        train (Train): the considered train
+
+    Returns:
+        int: the region code
+    """
+    if train.origin.region_code in REGION_CODES:
+        return train.origin.region_code
+    return REGION_CODES[hash(train) % len(REGION_CODES)]
+
+
+def is_newer(train: Train, other: Train | None) -> bool:
+    """Return True if a train has been fetched more recently than another copy of it.
+
+    Args:
+        train (Train): the considered train
+        other (Train | None): the other copy, if any
+
+    Returns:
+        bool: True if `train` should replace `other`
+    """
+    if other is None:
+        return True
+    return (train._fetched or datetime.min) > (other._fetched or datetime.min)
+
+
+def partition_regions(shards: int, weights: t.Mapping[int, int]) -> list[list[int]]:
+    """Split the regions in balanced groups.
+
+    Regions are assigned, heaviest first, to the lightest group so far.
+
+    Args:
+        shards (int): the number of groups
+        weights (t.Mapping[int, int]): the weight (e.g. the station count) of each region
+
+    Returns:
+        list[list[int]]: the region codes of each group
+    """
+    assert shards >= 1
+
+    groups: list[list[int]] = [list() for _ in range(shards)]
+    loads: list[int] = [0] * shards
+    for region in sorted(REGION_CODES, key=lambda r: -weights.get(r, 0)):
+        lightest: int = loads.index(min(loads))
+        groups[lightest].append(region)
+        loads[lightest] += weights.get(region, 0) or 1
+    return groups
+
+
+def merge_results(
+    results: t.Iterable[ShardResult],
+    fetched_trains: dict[int, Train],
+    unfetched_trains: dict[int, Train],
+    traffic: Counter[str] | None = None,
+) -> None:
+    """Merge the shard results in the given train dicts, deduplicating by train hash.
+
+    A train seen by multiple shards is saved once: fetched trains win over
+    unfetched ones, then the most recently fetched data is kept.
+
+    Args:
+        results (t.Iterable[ShardResult]): the results to merge
+        fetched_trains (dict[int, Train]): trains with no more data to fetch
+        unfetched_trains (dict[int, Train]): trains to fetch again in the next runs
+        traffic (Counter[str] | None, optional): if given, updated with
+            the departures of the new fetched trains
+    """
+
+    merged_unfetched: dict[int, Train] = dict()
+    for result in results:
+        for train_hash, train in result.fetched_trains.items():
+            if traffic is not None and train_hash not in fetched_trains:
+                traffic.update(train_departures(train))
+            if is_newer(train, fetched_trains.get(train_hash)):
+                fetched_trains[train_hash] = train
+        for train_hash, train in result.unfetched_trains.items():
+            if is_newer(train, merged_unfetched.get(train_hash)):
+                merged_unfetched[train_hash] = train
+        Station._merge_cache(result.station_cache)
+
+    unfetched_trains.clear()
+    for train_hash, train in merged_unfetched.items():
+        if train_hash not in fetched_trains:
+            unfetched_trains[train_hash] = train
+
+
+def _shard_worker(
+    stations: list[Station],
+    unfetched_trains: dict[int, Train],
+    known_trains: frozenset[int],
+    station_cache: dict[str, Station],
+    concurrency: int,
+    max_rate: float,
+    traffic: Counter[str],
+    deadline: float | None,
+    arrival_boards: bool,
+    station_stats: dict[str, StationStats] | None,
+    board_slices: t.Sequence[datetime | None],
+    archive_path: pathlib.Path | None,
+    trace_sample_rate: float,
+    trace_exporters: list[tracing.Exporter],
+) -> ShardResult:
+    """Scrape a shard in a worker process."""
+    Station._cache = station_cache
+    # Forked workers inherit the metrics of the parent
+    metrics.REGISTRY.reset()
+    tracing.TRACER.configure(trace_sample_rate, trace_exporters)
+    archive: ResponseArchive | None = (
+        ResponseArchive(archive_path) if archive_path is not None else None
+    )
+    for api in (ViaggiaTrenoAPI, TrenordAPI):
+        # Forked workers must not share the pooled connections of the parent
+        api.reset_session()
+        api._limiter.max_rate = max_rate
+        api._limiter.rate = min(api._limiter.rate, max_rate)
+        api._archive = archive
+
+    fetched_trains: dict[int, Train] = dict()
+    ScrapeLoop(
+        fetched_trains,
+        unfetched_trains,
+        concurrency=concurrency,
+        known_trains=known_trains,
+        traffic=traffic,
+        deadline=deadline,
+        arrival_boards=arrival_boards,
+        station_stats=station_stats,
+        board_slices=board_slices,
+    ).run(stations)
+    if archive is not None:
+        archive.close()
+    return ShardResult(
+        fetched_trains,
+        unfetched_trains,
+        Station._cache,
+        station_stats,
+        metrics.REGISTRY.snapshot(),
+    )
+
+
+def run_sharded(
+    shards: int,
+    stations: t.Iterable[Station],
+    fetched_trains: dict[int, Train],
+    unfetched_trains: dict[int, Train],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    traffic: Counter[str] | None = None,
+    deadline: float | None = None,
+    arrival_boards: bool = False,
+    station_stats: dict[str, StationStats] | None = None,
+    board_slices: t.Sequence[datetime | None] = (None,),
+    archive_path: pathlib.Path | None = None,
+) -> None:
+    """Scrape the given stations using multiple worker processes.
+
+    Each worker processes a group of regions: the departures of their stations
+    and the unfetched trains departing from them. Results are merged
+    in the given train dicts and in the station cache.
+
+    The total request rate is split between the workers, so the upstream
+    sees the same rate as a single process run.
+
+    Args:
+        shards (int): the number of worker processes
+        stations (t.Iterable[Station]): the stations to retrieve departures from
+        fetched_trains (dict[int, Train]): trains with no more data to fetch
+        unfetched_trains (dict[int, Train]): trains to fetch again in the next runs
+        concurrency (int, optional): the maximum number of concurrent requests per worker
+        traffic (Counter[str] | None, optional): the number of departures seen
+            at each station, updated with the new fetched trains
+        deadline (float | None, optional): no job is started after this time
+            (time.monotonic(), which is shared between processes)
+        arrival_boards (bool, optional): if True, check the arrival boards
+            of the destinations before fetching the unfetched trains
+        station_stats (dict[str, StationStats] | None, optional): if given,
+            retrieve the departure boards only when due, updating the statistics
+        board_slices (t.Sequence[datetime | None], optional): the times
+            the departure boards are retrieved at. Defaults to now only
+        archive_path (pathlib.Path | None, optional): if given, the directory
+            of the archive of raw responses (see ResponseArchive)
+    """
+    stations = list(stations)
+    groups: list[list[int]] = partition_regions(
+        shards, Counter(station.region_code for station in stations)
+    )
+    region_shard: dict[int, int] = {
+        region: i for i, group in enumerate(groups) for region in group
+    }
+    logging.info(f"Region shards: {groups}")
+
+    shard_stations: list[list[Station]] = [list() for _ in range(shards)]
+    for station in stations:
+        shard_stations[region_shard.get(station.region_code, 0)].append(station)
+
+    shard_unfetched: list[dict[int, Train]] = [dict() for _ in range(shards)]
+    for train_hash, train in unfetched_trains.items():
+        shard_unfetched[region_shard[train_region(train)]][train_hash] = train
+
+    # Trains unfetched in other shards are not new either
+    known_trains: frozenset[int] = frozenset(fetched_trains) | frozenset(
+        unfetched_trains
+    )
+    traffic = traffic if traffic is not None else Counter()
+    max_rate: float = ViaggiaTrenoAPI._limiter.max_rate / shards
+    with ProcessPoolExecutor(max_workers=shards) as executor:
+        results: list[ShardResult] = list(
+            executor.map(
+                _shard_worker,
+                shard_stations,
+                shard_unfetched,
+                [known_trains] * shards,
+                [Station._cache] * shards,
+                [concurrency] * shards,
+                [max_rate] * shards,
+                [traffic] * shards,
+                [deadline] * shards,
+                [arrival_boards] * shards,
+                [station_stats] * shards,
+                [board_slices] * shards,
+                [archive_path] * shards,
+                [tracing.TRACER.sample_rate] * shards,
+                [tracing.TRACER.exporters] * shards,
+            )
+        )
+
+    merge_results(results, fetched_trains, unfetched_trains, traffic)
+    for result in results:
+        if result.metrics is not None:
+            metrics.REGISTRY.merge(result.metrics)
+    if station_stats is not None:
+        for result in results:
+            merge_station_stats(station_stats, result.station_stats or dict())
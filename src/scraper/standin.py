@@ -0,0 +1,791 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import json
+import logging
+import pathlib
+import random
+import threading
+import time
+import typing as t
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+from src.const import TIMEZONE
+from src.scraper.archive import ARCHIVE_DIRNAME, ArchiveEntry, ResponseArchive
+from src.scraper.exceptions import BadRequestException
+from src.scraper.station import REGION_CODES
+
+# The stand-in server only listens on the loopback interface by default
+STANDIN_HOST: str = "127.0.0.1"
+DEFAULT_STANDIN_PORT: int = 8770
+
+# URL path prefixes of the imitated APIs
+VIAGGIATRENO_PREFIX: str = "viaggiatreno"
+TRENORD_PREFIX: str = "trenord"
+
+# API methods whose parameters include the request time
+BOARD_METHODS: frozenset[str] = frozenset({"partenze", "arrivi"})
+
+TRENORD_CLIENT_CODE: int = 63
+
+
+class NetworkDay:
+    """A day of the railway network, as served by ViaggiaTreno and Trenord.
+
+    Trains are registered with add_train() and shown on the departure board
+    of their origin station (or of the given stations) and on the arrival
+    board of their destination; requests about unknown trains or stations
+    are answered with HTTP 204, as the upstream does.
+
+    Attributes:
+        day (date): the day the trains depart in
+        stations (dict[str, dict]): the registered stations, by code
+        regions (dict[str, int]): the region codes of the stations
+        boards (dict[str, list[dict]]): the departure board entries, by station code
+        trains (dict[tuple[str, int], dict]): the train details, by origin and number
+        trenord (dict[int, list]): the Trenord 'train' responses, by number
+        hidden_arrivals (set[int]): trains not shown on the arrival boards
+        board_window (timedelta | None): if set, only the trains departing
+            in this window after the request time are shown on the departure boards
+        phantoms (set[str]): stations without details
+    """
+
+    def __init__(self, day: date | None = None) -> None:
+        """Initialize an empty network day.
+
+        Args:
+            day (date | None, optional): the day, defaults to today
+        """
+        self.day: date = day or datetime.now(tz=TIMEZONE).date()
+        self.stations: dict[str, dict] = dict()
+        self.regions: dict[str, int] = dict()
+        self.boards: dict[str, list[dict]] = dict()
+        self.trains: dict[tuple[str, int], dict] = dict()
+        self.trenord: dict[int, list] = dict()
+        self.hidden_arrivals: set[int] = set()
+        self.board_window: timedelta | None = None
+        self.phantoms: set[str] = set()
+
+    def _midnight(self) -> int:
+        return int(
+            datetime.combine(self.day, datetime.min.time(), tzinfo=TIMEZONE).timestamp()
+            * 1000
+        )
+
+    def add_station(
+        self,
+        code: str,
+        region: int,
+        name: str | None = None,
+        position: tuple[float, float] = (45.0, 9.0),
+    ) -> None:
+        """Register a station, listed in the stations of its region."""
+        self.regions[code] = region
+        self.stations[code] = {
+            "name": name or f"STATION {code}",
+            "position": position,
+        }
+
+    def add_train(
+        self,
+        number: int,
+        stations: t.Sequence[str],
+        arrived: bool = True,
+        client_code: int = 2,
+        boards: t.Sequence[str] | None = None,
+        hour: int = 6,
+        minute: int = 0,
+        stop_interval: int = 60,
+        delay: int = 0,
+        category: str = "REG",
+    ) -> None:
+        """Register a train departing at the given time, stopping at
+        the given stations every stop_interval minutes, with a constant
+        delay (in minutes). If not arrived, only the departure is detected."""
+        start: int = self._midnight() + (hour * 60 + minute) * 60 * 1000
+        late: int = delay * 60 * 1000
+        stops: list[dict] = list()
+        for i, code in enumerate(stations):
+            ts: int = start + i * stop_interval * 60 * 1000
+            last: bool = i == len(stations) - 1
+            reached: bool = arrived or i == 0
+            stops.append(
+                {
+                    "id": code,
+                    "stazione": code,
+                    "tipoFermata": "P" if i == 0 else ("A" if last else "F"),
+                    "binarioProgrammatoArrivoDescrizione": "1",
+                    "binarioProgrammatoPartenzaDescrizione": "1",
+                    "binarioEffettivoArrivoDescrizione": None,
+                    "binarioEffettivoPartenzaDescrizione": None,
+                    "arrivo_teorico": ts if i != 0 else None,
+                    "arrivoReale": ts + late if i != 0 and reached else None,
+                    "partenza_teorica": ts if not last else None,
+                    "partenzaReale": ts + late if not last and reached else None,
+                }
+            )
+
+        self.trains[(stations[0], number)] = {
+            "idDestinazione": stations[-1],
+            "categoria": category,
+            "codiceCliente": client_code,
+            "nonPartito": False,
+            "provvedimento": 0,
+            "ritardo": delay,
+            "stazioneUltimoRilevamento": stations[-1] if arrived else stations[0],
+            "oraUltimoRilevamento": stops[-1]["arrivoReale"] or start + late,
+            "fermate": stops,
+        }
+        for code in boards if boards is not None else stations[:1]:
+            self.boards.setdefault(code, []).append(
+                {
+                    "numeroTreno": number,
+                    "codOrigine": stations[0],
+                    "categoriaDescrizione": category,
+                    "dataPartenzaTreno": self._midnight(),
+                    "codiceCliente": client_code,
+                    "nonPartito": False,
+                    "provvedimento": 0,
+                    "compImgCambiNumerazione": "",
+                    "orarioPartenza": start,
+                }
+            )
+
+    def add_trenord(
+        self,
+        number: int,
+        stations: t.Sequence[str],
+        arrived: bool = True,
+        crowding: float = 50.0,
+        day: date | None = None,
+        hour: int = 6,
+        minute: int = 0,
+        stop_interval: int = 60,
+        delay: int = 0,
+    ) -> None:
+        """Register a Trenord journey departing at the given time,
+        stopping at the given stations every stop_interval minutes."""
+
+        def _time(minutes: int) -> str:
+            return f"{minutes // 60 % 24:02d}:{minutes % 60:02d}:00"
+
+        start: int = hour * 60 + minute
+        stops: list[dict] = list()
+        for i, code in enumerate(stations):
+            scheduled: int = start + i * stop_interval
+            last: bool = i == len(stations) - 1
+            stop_type: str = "O" if i == 0 else ("D" if last else "F")
+            reached: bool = arrived or i == 0
+            stops.append(
+                {
+                    "station": {"station_id": code},
+                    "type": stop_type,
+                    "cancelled": False,
+                    "arr_time": _time(scheduled) if i != 0 else None,
+                    "dep_time": _time(scheduled) if not last else None,
+                    "actual_data": {
+                        "actual_station_mir": code,
+                        "actual_type": stop_type,
+                        "arr_actual_time": (
+                            _time(scheduled + delay) if i != 0 and reached else None
+                        ),
+                        "dep_actual_time": (
+                            _time(scheduled + delay) if not last and reached else None
+                        ),
+                    },
+                }
+            )
+
+        journey: dict = {
+            "train": {
+                "date": (day or self.day).strftime("%Y%m%d"),
+                "actual_time": _time(start + delay),
+                "crowding": {"percentage": crowding, "source": "standin"},
+            },
+            "pass_list": stops,
+        }
+        self.trenord.setdefault(number, [{"journey_list": []}])[0][
+            "journey_list"
+        ].append(journey)
+
+    def set_arrived(self, origin: str, number: int) -> None:
+        """Mark a registered train as arrived."""
+        details: dict = self.trains[(origin, number)]
+        for stop in details["fermate"]:
+            stop["arrivoReale"] = stop["arrivo_teorico"]
+            stop["partenzaReale"] = stop["partenza_teorica"]
+        details["oraUltimoRilevamento"] = details["fermate"][-1]["arrivoReale"]
+
+    @classmethod
+    def synthetic(
+        cls,
+        trains: int,
+        stations: int | None = None,
+        seed: int = 0,
+        day: date | None = None,
+        trenord_share: float = 0.1,
+    ) -> "NetworkDay":
+        """Generate a network day: lines of 2-15 stations in each region,
+        each one served by trains departing every 30-120 minutes
+        between 5 and 22, with random delays.
+
+        Trains whose scheduled arrival is in the past are arrived.
+        Most trains of Trenord lines (in region 1) have Trenord data too.
+
+        Args:
+            trains (int): the approximate number of trains
+            stations (int | None, optional): the number of stations.
+                Defaults to one every four trains
+            seed (int, optional): the seed of the generator
+            day (date | None, optional): the day, defaults to today
+            trenord_share (float, optional): the fraction of Trenord lines
+
+        Returns:
+            NetworkDay: the generated day
+        """
+        rng = random.Random(seed)
+        network = cls(day)
+        now: int = int(datetime.now(tz=TIMEZONE).timestamp() * 1000)
+
+        codes_by_region: dict[int, list[str]] = dict()
+        for i in range(max(stations or trains // 4, 2 * len(REGION_CODES))):
+            code: str = f"S{i + 1:05d}"
+            region: int = REGION_CODES[i % len(REGION_CODES)]
+            network.add_station(
+                code,
+                region,
+                position=(rng.uniform(37.0, 46.5), rng.uniform(7.0, 18.5)),
+            )
+            codes_by_region.setdefault(region, []).append(code)
+
+        number: int = 100
+        while number - 100 < trains:
+            # Trenord operates in Lombardy (region 1)
+            trenord: bool = rng.random() < trenord_share
+            region = 1 if trenord else rng.choice(REGION_CODES)
+            codes: list[str] = codes_by_region[region]
+            line: list[str] = rng.sample(codes, min(len(codes), rng.randint(2, 15)))
+            interval: int = rng.choice((30, 60, 120))
+            stop_interval: int = rng.randint(3, 15)
+
+            for minutes in range(5 * 60 + rng.randrange(interval), 22 * 60, interval):
+                for stops in (line, line[::-1]):
+                    # Delays: mostly on time, with a long tail
+                    delay: int = (
+                        int(rng.expovariate(1 / 4)) if rng.random() < 0.6 else 0
+                    )
+                    arrival: int = (
+                        network._midnight()
+                        + (minutes + (len(stops) - 1) * stop_interval + delay)
+                        * 60
+                        * 1000
+                    )
+                    kwargs: dict[str, t.Any] = dict(
+                        hour=minutes // 60,
+                        minute=minutes % 60,
+                        stop_interval=stop_interval,
+                        delay=delay,
+                    )
+                    network.add_train(
+                        number,
+                        stops,
+                        arrived=arrival < now,
+                        client_code=TRENORD_CLIENT_CODE if trenord else 2,
+                        **kwargs,
+                    )
+                    # Some Trenord trains are not in the Trenord API
+                    if trenord and rng.random() < 0.95:
+                        network.add_trenord(
+                            number,
+                            stops,
+                            arrived=arrival < now,
+                            crowding=rng.uniform(5, 100),
+                            **kwargs,
+                        )
+                    number += 1
+        return network
+
+    def _station(self, code: str) -> dict:
+        station: dict = self.stations.get(code, {})
+        lat, lon = station.get("position", (45.0, 9.0))
+        return {
+            "codStazione": code,
+            "codReg": self.regions.get(code, 1),
+            "tipoStazione": 1,
+            "lat": lat,
+            "lon": lon,
+            "localita": {
+                "nomeLungo": station.get("name", f"STATION {code}"),
+                "nomeBreve": code,
+            },
+        }
+
+    def _departures(self, code: str, when: str) -> list[dict]:
+        board: list[dict] = self.boards.get(code, [])
+        if self.board_window is None:
+            return board
+
+        # Only show the trains departing in the board window
+        start: int = int(
+            datetime.strptime(when, "%a %b %d %Y %H:%M:%S GMT+0000")
+            .replace(tzinfo=timezone.utc)
+            .timestamp()
+            * 1000
+        )
+        end: int = start + int(self.board_window.total_seconds() * 1000)
+        return [entry for entry in board if start <= entry["orarioPartenza"] < end]
+
+    def _arrivals(self, code: str) -> list[dict]:
+        entries: list[dict] = list()
+        for (origin, number), details in self.trains.items():
+            last: dict = details["fermate"][-1]
+            if last["id"] != code or number in self.hidden_arrivals:
+                continue
+            entries.append(
+                {
+                    "numeroTreno": number,
+                    "codOrigine": origin,
+                    "categoriaDescrizione": details["categoria"],
+                    "dataPartenzaTreno": self._midnight(),
+                    "codiceCliente": details["codiceCliente"],
+                    "nonPartito": False,
+                    "provvedimento": 0,
+                    "compImgCambiNumerazione": "",
+                    "orarioArrivo": last["arrivo_teorico"],
+                    "ritardo": details["ritardo"],
+                    "inStazione": last["arrivoReale"] is not None,
+                }
+            )
+        return entries
+
+    def respond(self, method: str, *parameters: t.Any) -> str:
+        """Answer an API request.
+
+        Args:
+            method (str): the API method (e.g. 'partenze', or 'train' for Trenord)
+            parameters (tuple[t.Any]): the method parameters
+
+        Raises:
+            BadRequestException: if there is no data (HTTP 204)
+
+        Returns:
+            str: the raw response
+        """
+        if method == "partenze":
+            return json.dumps(self._departures(*parameters))
+        if method == "arrivi":
+            return json.dumps(self._arrivals(parameters[0]))
+        if method == "regione":
+            return str(self.regions.get(parameters[0], 1))
+        if method == "dettaglioStazione" and parameters[0] not in self.phantoms:
+            return json.dumps(self._station(parameters[0]))
+        if method == "elencoStazioni":
+            return json.dumps(
+                [
+                    self._station(code)
+                    for code, region in self.regions.items()
+                    if region == int(parameters[0]) and code not in self.phantoms
+                ]
+            )
+        if method == "andamentoTreno":
+            details: dict | None = self.trains.get((parameters[0], int(parameters[1])))
+            if details is not None:
+                return json.dumps(details)
+        if method == "train":
+            # Trenord answers with no journeys for unknown trains
+            return json.dumps(self.trenord.get(int(parameters[0]), []))
+
+        raise BadRequestException(
+            url=f"{method}/{'/'.join(map(str, parameters))}",
+            status_code=204,
+            response="",
+        )
+
+
+class RecordedDay:
+    """A day of the railway network recorded in an archive of raw
+    responses (see ResponseArchive): every request is answered with
+    the last archived response to it.
+
+    The departure and arrival boards are requested with the current time,
+    so they are answered with the last board archived for the station.
+    """
+
+    def __init__(self, archive: ResponseArchive) -> None:
+        """Initialize a recorded day.
+
+        Args:
+            archive (ResponseArchive): the archive
+        """
+        self.archive: ResponseArchive = archive
+        self._boards: dict[tuple[str, str], ArchiveEntry] = dict()
+        for entry in archive.entries:
+            if entry.method in BOARD_METHODS and entry.status == 200:
+                self._boards[(entry.method, entry.parameters[0])] = entry
+
+    def respond(self, method: str, *parameters: t.Any) -> str:
+        """Answer an API request. See NetworkDay.respond."""
+        if method in BOARD_METHODS:
+            entry: ArchiveEntry | None = self._boards.get((method, str(parameters[0])))
+            if entry is not None:
+                return self.archive.read(entry)
+
+        api: str = "TrenordAPI" if method == "train" else "ViaggiaTrenoAPI"
+        return self.archive.replay(api, method, parameters)
+
+
+Network = NetworkDay | RecordedDay
+
+
+class Faults(t.NamedTuple):
+    """The faults injected by a stand-in server.
+
+    Attributes:
+        latency (float): the minimum response time, in seconds
+        jitter (float): the maximum additional (random) response time, in seconds
+        error_rate (float): the fraction of requests answered with error_status
+        error_status (int): the status of the random errors
+        burst_every (float): the time between the starts of two error bursts,
+            in seconds (0 disables the bursts)
+        burst_length (float): the duration of an error burst, in seconds
+        burst_status (int): the status of the requests during a burst
+        max_rate (float): the requests per second above which requests are
+            throttled with HTTP 403 (0 disables the throttling)
+        retry_after (bool): if True, throttled responses have a Retry-After header
+    """
+
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 503
+    burst_every: float = 0.0
+    burst_length: float = 0.0
+    burst_status: int = 403
+    max_rate: float = 0.0
+    retry_after: bool = False
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Local HTTP server imitating the ViaggiaTreno and Trenord APIs,
+    with fault injection. Point the scraper at it with the
+    VIAGGIATRENO_BASE_URL and TRENORD_BASE_URL environment variables
+    (or by setting the BASE_URL of the API classes).
+
+    Endpoints:
+        /viaggiatreno/<method>/<parameters>: ViaggiaTreno API
+        /trenord/<method>/<parameters>: Trenord API
+
+    Attributes:
+        network (Network): the served network day
+        faults (Faults): the injected faults
+        requests (Counter[tuple[str, int]]): the answered requests,
+            by method and status
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        network: Network,
+        faults: Faults = Faults(),
+        port: int = 0,
+        host: str = STANDIN_HOST,
+        seed: int | None = None,
+    ) -> None:
+        """Initialize a new stand-in server.
+
+        Args:
+            network (Network): the network day to serve
+            faults (Faults, optional): the faults to inject. Defaults to none
+            port (int, optional): the port to listen on, 0 for any free port
+            host (str, optional): the address to listen on
+            seed (int | None, optional): the seed of the random faults
+        """
+        super().__init__((host, port), _StandInHandler)
+        self.network: Network = network
+        self.faults: Faults = faults
+        self.requests: Counter[tuple[str, int]] = Counter()
+
+        self._random: random.Random = random.Random(seed)
+        self._lock: threading.Lock = threading.Lock()
+        self._started: float = time.monotonic()
+        self._tokens: float = max(faults.max_rate, 1.0)
+        self._updated: float = self._started
+
+    @property
+    def viaggiatreno_url(self) -> str:
+        """The base URL of the imitated ViaggiaTreno API."""
+        return (
+            f"http://{self.server_address[0]}:{self.server_port}/{VIAGGIATRENO_PREFIX}/"
+        )
+
+    @property
+    def trenord_url(self) -> str:
+        """The base URL of the imitated Trenord API."""
+        return f"http://{self.server_address[0]}:{self.server_port}/{TRENORD_PREFIX}/"
+
+    def start(self) -> None:
+        """Serve the requests in a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        """Stop serving and close the socket."""
+        self.shutdown()
+        self.server_close()
+
+    def _delay(self) -> float:
+        """Return the response time of a request, in seconds."""
+        with self._lock:
+            return self.faults.latency + self._random.uniform(0, self.faults.jitter)
+
+    def _fault(self) -> tuple[int, float | None] | None:
+        """Decide whether a request fails.
+
+        Returns:
+            tuple[int, float | None] | None: the status and the Retry-After
+                header (in seconds) of the failure, None if the request succeeds
+        """
+        faults: Faults = self.faults
+        now: float = time.monotonic()
+        with self._lock:
+            if faults.max_rate > 0:
+                self._tokens = min(
+                    max(faults.max_rate, 1.0),
+                    self._tokens + (now - self._updated) * faults.max_rate,
+                )
+                self._updated = now
+                if self._tokens < 1:
+                    wait: float = (1 - self._tokens) / faults.max_rate
+                    return 403, wait if faults.retry_after else None
+                self._tokens -= 1
+
+            if (
+                faults.burst_every > 0
+                and (now - self._started) % faults.burst_every < faults.burst_length
+            ):
+                return faults.burst_status, None
+
+            if faults.error_rate > 0 and self._random.random() < faults.error_rate:
+                return faults.error_status, None
+        return None
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    server: StandInServer
+
+    # Keep the connections open, as the upstream does; headers and body
+    # are written at once, to avoid delayed ACKs on kept-alive connections
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
+    def do_GET(self) -> None:
+        parts: list[str] = [
+            unquote(part) for part in self.path.split("?")[0].strip("/").split("/")
+        ]
+        if len(parts) < 2 or parts[0] not in (VIAGGIATRENO_PREFIX, TRENORD_PREFIX):
+            self._send(404, "")
+            return
+        method: str = parts[1]
+        parameters: list[str] = parts[2:]
+
+        delay: float = self.server._delay()
+        if delay > 0:
+            time.sleep(delay)
+
+        fault: tuple[int, float | None] | None = self.server._fault()
+        if fault is not None:
+            status, retry_after = fault
+            self._send(status, "", method, retry_after)
+            return
+
+        try:
+            body: str = self.server.network.respond(method, *parameters)
+        except BadRequestException as e:
+            self._send(e.status_code, "", method)
+            return
+        self._send(200, body, method)
+
+    def _send(
+        self,
+        status: int,
+        body: str,
+        method: str = "",
+        retry_after: float | None = None,
+    ) -> None:
+        with self.server._lock:
+            self.server.requests[(method, status)] += 1
+
+        data: bytes = body.encode()
+        self.send_response(status)
+        if retry_after is not None:
+            self.send_header("Retry-After", f"{retry_after:.3f}")
+        if status != 204:
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if status != 204:
+            self.wfile.write(data)
+
+    def log_message(self, format: str, *args: t.Any) -> None:
+        logging.debug(f"Stand-in server: {format % args}")
+
+
+def register_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=DEFAULT_STANDIN_PORT,
+        help=f"port to listen on. Defaults to {DEFAULT_STANDIN_PORT}",
+    )
+    parser.add_argument(
+        "--host",
+        default=STANDIN_HOST,
+        help=f"address to listen on. Defaults to {STANDIN_HOST}",
+    )
+    parser.add_argument(
+        "--recorded",
+        type=pathlib.Path,
+        metavar="DAY_DIR",
+        help=(
+            "serve the raw responses archived in a day directory "
+            "(e.g. data/2023-05-01) instead of a synthetic day"
+        ),
+    )
+    parser.add_argument(
+        "--trains",
+        type=int,
+        default=5000,
+        metavar="N",
+        help="approximate number of trains of the synthetic day. Defaults to 5000",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed of the synthetic day and of the random faults. Defaults to 0",
+    )
+    parser.add_argument(
+        "--board-window",
+        type=float,
+        metavar="MINUTES",
+        help="only show the trains departing in this window on the departure boards",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="minimum response time. Defaults to 0",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="maximum random additional response time. Defaults to 0",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        metavar="RATE",
+        help="fraction of requests answered with --error-status. Defaults to 0",
+    )
+    parser.add_argument(
+        "--error-status",
+        type=int,
+        default=503,
+        metavar="STATUS",
+        help="status of the random errors. Defaults to 503",
+    )
+    parser.add_argument(
+        "--burst-every",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="time between two bursts of --burst-status errors (0 to disable)",
+    )
+    parser.add_argument(
+        "--burst-length",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="duration of each burst. Defaults to 0",
+    )
+    parser.add_argument(
+        "--burst-status",
+        type=int,
+        default=403,
+        metavar="STATUS",
+        help="status of the requests during a burst. Defaults to 403",
+    )
+    parser.add_argument(
+        "--max-rate",
+        type=float,
+        default=0.0,
+        metavar="REQ/S",
+        help="throttle the requests above this rate with HTTP 403 (0 to disable)",
+    )
+    parser.add_argument(
+        "--retry-after",
+        action="store_true",
+        help="send a Retry-After header with the throttled responses",
+    )
+
+
+def main(args: argparse.Namespace) -> None:
+    network: Network
+    if args.recorded is not None:
+        archive = ResponseArchive(args.recorded / ARCHIVE_DIRNAME)
+        network = RecordedDay(archive)
+        logging.info(f"Serving {len(archive)} responses archived in {args.recorded}")
+    else:
+        network = NetworkDay.synthetic(args.trains, seed=args.seed)
+        if args.board_window is not None:
+            network.board_window = timedelta(minutes=args.board_window)
+        logging.info(
+            f"Serving a synthetic day of {len(network.trains)} trains "
+            f"and {len(network.stations)} stations"
+        )
+
+    faults = Faults(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        burst_every=args.burst_every,
+        burst_length=args.burst_length,
+        burst_status=args.burst_status,
+        max_rate=args.max_rate,
+        retry_after=args.retry_after,
+    )
+    server = StandInServer(network, faults, args.port, args.host, seed=args.seed)
+    logging.info(
+        f"Listening on {server.viaggiatreno_url} and {server.trenord_url}. Run the scraper with "
+        f"VIAGGIATRENO_BASE_URL={server.viaggiatreno_url} TRENORD_BASE_URL={server.trenord_url}"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info(f"Answered requests: {dict(server.requests)}")
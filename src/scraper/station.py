@@ -15,14 +15,45 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import asyncio
 import logging
 import typing as t
+from datetime import datetime, timedelta
 
 import src.scraper.api as api
+import src.scraper.metrics as metrics
 import src.scraper.train as tr
 from src import types
+from src.const import TIMEZONE
 from src.scraper.exceptions import BadRequestException
 
+# Codes of the italian regions, as used in the API calls
+REGION_CODES: range = range(1, 23)
+
+# The station lists of the regions are downloaded again when older than this
+REGION_LIST_TTL: timedelta = timedelta(days=7)
+
+# Stations whose details can't be fetched are looked up again after this
+NEGATIVE_TTL: timedelta = timedelta(days=1)
+
+T = t.TypeVar("T")
+
+
+def _in_event_loop() -> bool:
+    """Return True if called from a running event loop (in this thread)."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class RegionList(t.NamedTuple):
+    """The station codes of a region, as returned by the 'elencoStazioni' API call."""
+
+    codes: t.Tuple[str, ...]
+    fetched: datetime
+
 
 class Station:
     """A ViaggiaTreno station.
@@ -36,10 +67,20 @@ class Station:
 
     Other attributes:
         _phantom (bool): if True, the details of the station can't be fetched
+        _expires (datetime | None): when a phantom station should be looked up again
     """
 
     _cache: dict[str, "Station"] = dict()
 
+    # Station lists of the regions (see by_region)
+    _regions: dict[int, RegionList] = dict()
+
+    # Lookups in progress (see by_code_async), shared by concurrent callers
+    _pending: dict[str, "asyncio.Future[Station]"] = dict()
+
+    # Placeholders of the stations not in the cache (see _resolve)
+    _stubs: dict[str, "Station"] = dict()
+
     def __init__(
         self,
         code: str,
@@ -68,6 +109,27 @@ class Station:
         self.position: t.Tuple[float, float] | None = position
 
         self._phantom: bool = self.name == None
+        self._expires: datetime | None = (
+            datetime.now(tz=TIMEZONE) + NEGATIVE_TTL if self._phantom else None
+        )
+
+    @classmethod
+    def _resolve(cls, code: str) -> "Station":
+        """Return a station from the cache, without requests.
+        Used to restore the stations of unpickled trains, which only keep their codes.
+
+        Args:
+            code (str): the station code
+
+        Returns:
+            Station: the cached station, or a phantom placeholder with the code only
+        """
+        station: Station | None = cls._cache.get(code)
+        if station is None:
+            station = cls._stubs.get(code)
+            if station is None:
+                station = cls._stubs[code] = cls(code, region_code=0, name=None)
+        return station
 
     @classmethod
     def _from_raw(cls, raw_data: dict) -> "Station":
@@ -78,7 +140,7 @@ class Station:
         """
         station_code = raw_data["codStazione"]
 
-        if station_code not in cls._cache:
+        if station_code not in cls._cache or cls._cache[station_code]._phantom:
             cls._cache[station_code] = cls(
                 code=station_code,
                 region_code=raw_data["codReg"],
@@ -102,6 +164,55 @@ class Station:
     def __repr__(self) -> str:
         return f"{self.name} [{self.code}@{self.region_code}]"
 
+    @classmethod
+    def _cached(cls, station_code: str) -> "Station | None":
+        """Return a station from the cache, unless missing or expired.
+
+        Args:
+            station_code (str): the station code
+
+        Returns:
+            Station | None: the cached station, None if it should be looked up
+        """
+        station: Station | None = cls._cache.get(station_code)
+        if station is not None and station._phantom:
+            # Negative entries expire (older ones have no expiration time)
+            expires: datetime | None = getattr(station, "_expires", None)
+            if expires is None or expires <= datetime.now(tz=TIMEZONE):
+                station = None
+        return station
+
+    @classmethod
+    def _lookup(cls, station_code: str) -> "Station | None":
+        """Return a station from the cache like _cached, counting the lookup
+        in the station cache metrics.
+
+        Args:
+            station_code (str): the station code
+
+        Returns:
+            Station | None: the cached station, None if it should be looked up
+        """
+        station: Station | None = cls._cached(station_code)
+        metrics.REGISTRY.inc(
+            "station_cache_total", result="miss" if station is None else "hit"
+        )
+        return station
+
+    @classmethod
+    def _merge_cache(cls, other: t.Mapping[str, "Station"]) -> None:
+        """Merge another station cache (e.g. of another process) in the cache.
+
+        Known stations are preferred to phantom ones.
+
+        Args:
+            other (t.Mapping[str, Station]): the station cache to merge
+        """
+        for code, station in other.items():
+            cached: Station | None = cls._cache.get(code)
+            if cached is None or (cached._phantom and not station._phantom):
+                cls._cache[code] = station
+
     @classmethod
     def by_code(cls, station_code: str) -> "Station":
         """Retrieve a station by its code, or use cache.
@@ -112,30 +223,125 @@ class Station:
         Returns:
             Station: a station corresponding to the passed station code
         """
-        if station_code not in cls._cache:
-            try:
-                region_code: int = cls._region_code(station_code)
-            except BadRequestException as e:
-                if e.status_code != 204:
-                    raise e
+        # On the event loop, stations are looked up (and counted) beforehand
+        # by by_code_async: the parsers only read them from the cache here.
+        station: Station | None = (
+            cls._cached(station_code) if _in_event_loop() else cls._lookup(station_code)
+        )
+        if station is not None:
+            return station
 
-                region_code: int = 0
+        try:
+            region_code: int = cls._region_code(station_code)
+        except BadRequestException as e:
+            region_code: int = cls._not_found(e, 0)
 
-            try:
-                response: str = api.ViaggiaTrenoAPI._raw_request(
-                    "dettaglioStazione", station_code, region_code
-                )
-                raw_data: types.JSONType = api.ViaggiaTrenoAPI._decode_json(response)
-                cls._cache[station_code] = cls._from_raw(raw_data)
-            except BadRequestException as e:
-                if e.status_code != 204:
-                    raise e
-
-                cls._cache[station_code] = cls(
-                    code=station_code,
-                    region_code=region_code,
-                    name=None,
-                )
+        try:
+            response: str | None = api.ViaggiaTrenoAPI._raw_request(
+                "dettaglioStazione", station_code, region_code
+            )
+        except BadRequestException as e:
+            response: str | None = cls._not_found(e, None)
+
+        return cls._save(station_code, region_code, response)
+
+    @classmethod
+    async def by_code_async(cls, station_code: str) -> "Station":
+        """Coroutine version of by_code.
+
+        Concurrent lookups of the same station code share the same requests,
+        so the station cache is populated exactly once per code.
+
+        Args:
+            station_code (str): the station code
+
+        Returns:
+            Station: a station corresponding to the passed station code
+        """
+        if (station := cls._lookup(station_code)) is not None:
+            return station
+
+        if station_code not in cls._pending:
+            lookup = asyncio.ensure_future(cls._fetch_async(station_code))
+            lookup.add_done_callback(lambda _: cls._pending.pop(station_code, None))
+            cls._pending[station_code] = lookup
+
+        return await cls._pending[station_code]
+
+    @classmethod
+    async def _fetch_async(cls, station_code: str) -> "Station":
+        """Retrieve a station by its code and save it in the cache.
+        Helper function to by_code_async.
+
+        Args:
+            station_code (str): the station code
+
+        Returns:
+            Station: a station corresponding to the passed station code
+        """
+        try:
+            region_code: int = await cls._region_code_async(station_code)
+        except BadRequestException as e:
+            region_code: int = cls._not_found(e, 0)
+
+        try:
+            response: str | None = await api.ViaggiaTrenoAPI._raw_request_async(
+                "dettaglioStazione", station_code, region_code
+            )
+        except BadRequestException as e:
+            response: str | None = cls._not_found(e, None)
+
+        return cls._save(station_code, region_code, response)
+
+    @staticmethod
+    def _not_found(e: BadRequestException, default: T) -> T:
+        """Return a default value if a station lookup failed because the API
+        has no data about the station (HTTP 204), raise the exception otherwise.
+        Helper function to by_code() and _fetch_async().
+
+        Args:
+            e (BadRequestException): the exception raised by the request
+            default (T): the value to use in place of the response
+
+        Raises:
+            BadRequestException: if the request failed for any other reason
+
+        Returns:
+            T: the default value
+        """
+        if e.status_code != 204:
+            raise e
+        return default
+
+    @classmethod
+    def _save(
+        cls, station_code: str, region_code: int, response: str | None
+    ) -> "Station":
+        """Save a looked up station in the cache.
+        Helper function to by_code() and _fetch_async().
+
+        Stations without details are saved as phantom stations,
+        which are looked up again after NEGATIVE_TTL.
+
+        Args:
+            station_code (str): the station code
+            region_code (int): the region code of the station
+            response (str | None): the 'dettaglioStazione' response, None if not found
+
+        Returns:
+            Station: the saved station
+        """
+        if response is None:
+            cls._cache[station_code] = cls(
+                code=station_code,
+                region_code=region_code,
+                name=None,
+            )
+        else:
+            raw_data: types.JSONType = api.ViaggiaTrenoAPI._decode_json(
+                response, "dettaglioStazione"
+            )
+            cls._cache[station_code] = cls._from_raw(raw_data)
 
         return cls._cache[station_code]
 
@@ -155,50 +361,148 @@ class Station:
         region_code = api.ViaggiaTrenoAPI._raw_request("regione", station_code)
         return int(region_code)
 
+    @staticmethod
+    async def _region_code_async(station_code: str) -> int:
+        """Coroutine version of _region_code.
+
+        Args:
+            station_code (str): the code of the station to check
+
+        Raises:
+            BadRequestException: if the response is not ok
+
+        Returns:
+            int: the region code of the given station
+        """
+        region_code = await api.ViaggiaTrenoAPI._raw_request_async(
+            "regione", station_code
+        )
+        return int(region_code)
+
     @classmethod
-    def by_region(cls, region_code: int) -> t.List["Station"]:
-        """Retrieve the list of train stations of a given region.
+    async def _prefetch_async(cls, station_codes: t.Iterable[str]) -> list[str]:
+        """Concurrently resolve the given station codes, filling the cache.
+
+        Failed lookups are logged and returned: the caller should look them up
+        again off the event loop (e.g. parsing the data in asyncio.to_thread),
+        so that the blocking by_code calls don't stall the other coroutines.
+
+        Args:
+            station_codes (t.Iterable[str]): the station codes to resolve
+
+        Returns:
+            list[str]: the codes of the stations that couldn't be resolved
+        """
+        codes: list[str] = [
+            code for code in set(station_codes) if code and cls._cached(code) is None
+        ]
+        results: list[Station | BaseException] = await asyncio.gather(
+            *[cls.by_code_async(code) for code in codes],
+            return_exceptions=True,
+        )
+
+        failed: list[str] = list()
+        for code, result in zip(codes, results):
+            if isinstance(result, BaseException):
+                logging.debug(f"Station {code} lookup failed: {result!r}")
+                failed.append(code)
+        return failed
+
+    @classmethod
+    def by_region(
+        cls, region_code: int, max_age: timedelta = REGION_LIST_TTL
+    ) -> t.List["Station"]:
+        """Retrieve the list of train stations of a given region, or use cache.
+
+        The stations are saved in the station cache too, so subsequent
+        lookups by code don't need any request.
 
         Args:
             region_code (int): the code of the region to query
+            max_age (timedelta, optional): the maximum age of a cached station list
 
         Returns:
             t.List[Station]: a list of train stations
         """
+        now: datetime = datetime.now(tz=TIMEZONE)
+        cached: RegionList | None = cls._regions.get(region_code)
+        if (
+            cached is not None
+            and now - cached.fetched < max_age
+            and all(code in cls._cache for code in cached.codes)
+        ):
+            return [cls._cache[code] for code in cached.codes]
+
         raw_stations: str = api.ViaggiaTrenoAPI._raw_request(
             "elencoStazioni", region_code
         )
-        stations: types.JSONType = api.ViaggiaTrenoAPI._decode_json(raw_stations)
-        return list(
+        stations: types.JSONType = api.ViaggiaTrenoAPI._decode_json(
+            raw_stations, "elencoStazioni"
+        )
+        region_stations: list[Station] = list(
             map(
                 lambda s: cls._from_raw(s),
                 filter(lambda s: s["tipoStazione"] != 4, stations),
             )
         )
+        cls._regions[region_code] = RegionList(
+            tuple(station.code for station in region_stations), now
+        )
+        return region_stations
 
-    def departures(self) -> t.List["tr.Train"]:
+    def departures(self, when: datetime | None = None) -> t.List["tr.Train"]:
         """Retrieve the departures of a train station.
 
         Args:
-            station_code (str): the code of the considered station
+            when (datetime | None, optional): the board time, defaults to now
 
         Returns:
             t.List[Train]: a list of trains departing from the station
         """
         return api.ViaggiaTrenoAPI._station_departures_or_arrivals(
-            "partenze", self.code
+            "partenze", self.code, when
         )
 
-    def arrivals(self) -> t.List["tr.Train"]:
+    def arrivals(self, when: datetime | None = None) -> t.List["tr.Train"]:
         """Retrieve the arrivals of a train station.
 
         Args:
-            station_code (str): the code of the considered station
+            when (datetime | None, optional): the board time, defaults to now
 
         Returns:
             t.List[Train]: a list of trains departing from the station
         """
-        return api.ViaggiaTrenoAPI._station_departures_or_arrivals("arrivi", self.code)
+        return api.ViaggiaTrenoAPI._station_departures_or_arrivals(
+            "arrivi", self.code, when
+        )
+
+    async def departures_async(
+        self, when: datetime | None = None
+    ) -> t.List["tr.Train"]:
+        """Coroutine version of departures.
+
+        Args:
+            when (datetime | None, optional): the board time, defaults to now
+
+        Returns:
+            t.List[Train]: a list of trains departing from the station
+        """
+        return await api.ViaggiaTrenoAPI._station_departures_or_arrivals_async(
+            "partenze", self.code, when
+        )
+
+    async def arrivals_async(self, when: datetime | None = None) -> t.List["tr.Train"]:
+        """Coroutine version of arrivals.
+
+        Args:
+            when (datetime | None, optional): the board time, defaults to now
+
+        Returns:
+            t.List[Train]: a list of trains arriving to the station
+        """
+        return await api.ViaggiaTrenoAPI._station_departures_or_arrivals_async(
+            "arrivi", self.code, when
+        )
 
     def __hash__(self) -> int:
         return hash(self.name)
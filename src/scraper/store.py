@@ -0,0 +1,564 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import pathlib
+import pickle
+import sqlite3
+import typing as t
+from collections import Counter
+from datetime import date, datetime
+
+import src.scraper.train_stop as tr_st
+from src.scraper.dataset import SpilledDataset, load_dataset, save_dataset
+from src.scraper.schedule import station_traffic
+from src.scraper.station import Station
+from src.scraper.train import Train
+
+# Available storage backends (see open_store)
+STORAGES: t.Tuple[str, ...] = ("pickle", "sqlite")
+
+# File name of the SQLite database, in the data directory
+SQLITE_FILENAME: str = "scraper.sqlite3"
+
+_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS stations (
+    code TEXT PRIMARY KEY,
+    region_code INTEGER NOT NULL,
+    name TEXT,
+    latitude REAL,
+    longitude REAL,
+    data BLOB NOT NULL,
+    digest BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS trains (
+    id INTEGER PRIMARY KEY,
+    key INTEGER NOT NULL UNIQUE,
+    origin_code TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    departing_date TEXT NOT NULL,
+    day TEXT NOT NULL,
+    unfetched INTEGER NOT NULL,
+    category TEXT,
+    client_code INTEGER,
+    destination_code TEXT,
+    departed INTEGER,
+    cancelled INTEGER,
+    delay INTEGER,
+    crowding REAL,
+    last_detection_place TEXT,
+    last_detection_time TEXT,
+    data BLOB NOT NULL,
+    digest BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trains_day ON trains (day, unfetched);
+CREATE INDEX IF NOT EXISTS trains_number ON trains (number);
+CREATE INDEX IF NOT EXISTS trains_client_code ON trains (client_code);
+CREATE TABLE IF NOT EXISTS stops (
+    train_id INTEGER NOT NULL REFERENCES trains (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    station_code TEXT NOT NULL,
+    stop_type TEXT NOT NULL,
+    platform_expected TEXT,
+    platform_actual TEXT,
+    arrival_expected TEXT,
+    arrival_actual TEXT,
+    departure_expected TEXT,
+    departure_actual TEXT,
+    PRIMARY KEY (train_id, position)
+);
+CREATE INDEX IF NOT EXISTS stops_station_code ON stops (station_code);
+CREATE TABLE IF NOT EXISTS traffic (
+    day TEXT NOT NULL,
+    station_code TEXT NOT NULL,
+    departures INTEGER NOT NULL,
+    PRIMARY KEY (day, station_code)
+);
+"""
+
+_UPSERT_TRAIN: str = """
+INSERT INTO trains (
+    key, origin_code, number, departing_date, day, unfetched, category,
+    client_code, destination_code, departed, cancelled, delay, crowding,
+    last_detection_place, last_detection_time, data, digest
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (key) DO UPDATE SET
+    day = excluded.day,
+    unfetched = excluded.unfetched,
+    category = excluded.category,
+    client_code = excluded.client_code,
+    destination_code = excluded.destination_code,
+    departed = excluded.departed,
+    cancelled = excluded.cancelled,
+    delay = excluded.delay,
+    crowding = excluded.crowding,
+    last_detection_place = excluded.last_detection_place,
+    last_detection_time = excluded.last_detection_time,
+    data = excluded.data,
+    digest = excluded.digest
+RETURNING id
+"""
+
+_UPSERT_STATION: str = """
+INSERT INTO stations (code, region_code, name, latitude, longitude, data, digest)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (code) DO UPDATE SET
+    region_code = excluded.region_code,
+    name = excluded.name,
+    latitude = excluded.latitude,
+    longitude = excluded.longitude,
+    data = excluded.data,
+    digest = excluded.digest
+"""
+
+
+# Attributes of a train digested to find the changed ones without pickling it:
+# the stops and the Trenord journey only change along with the fingerprint
+# of the last response and the Trenord detection time (see Train.fetch)
+_TRAIN_DIGESTED: t.Tuple[str, ...] = tuple(
+    name for name in Train._STATE if name not in ("stops", "_trenord_journey")
+)
+
+
+def _digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _train_digest(train: Train) -> bytes:
+    return _digest(
+        repr([getattr(train, name, None) for name in _TRAIN_DIGESTED]).encode()
+    )
+
+
+def _isoformat(value: date | datetime | None) -> str | None:
+    return value.isoformat() if value is not None else None
+
+
+def rekey_trains(trains: dict[int, Train]) -> dict[int, Train]:
+    """Index trains by their key, e.g. if saved before the seed-independent keys.
+
+    Args:
+        trains (dict[int, Train]): the trains
+
+    Returns:
+        dict[int, Train]: the same trains, by hash (see Train.key)
+    """
+    return {hash(train): train for train in trains.values()}
+
+
+class PickleStore:
+    """The scraper state, in pickles in the data directory:
+    'stations.pickle' and the 'trains.pickle' and 'unfetched.pickle'
+    files of each day directory.
+
+    The trains with no more data to fetch are appended to 'trains.pickle'
+    as soon as they are saved (see SpilledDataset): only their hashes and
+    the unfetched trains are kept in memory.
+
+    Attributes:
+        data_dir (pathlib.Path): the data directory
+    """
+
+    def __init__(self, data_dir: pathlib.Path) -> None:
+        """Initialize a new pickle store.
+
+        Args:
+            data_dir (pathlib.Path): the data directory
+        """
+        self.data_dir: pathlib.Path = data_dir
+
+    def _day_path(self, day: date) -> pathlib.Path:
+        return self.data_dir / day.strftime("%Y-%m-%d")
+
+    def load_stations(self) -> dict[str, Station]:
+        """Load the station cache."""
+        return load_dataset(self.data_dir / "stations.pickle")
+
+    def save_stations(self, stations: dict[str, Station]) -> None:
+        """Save the station cache."""
+        save_dataset(self.data_dir / "stations.pickle", stations)
+
+    def load_trains(
+        self, day: date
+    ) -> t.Tuple[SpilledDataset[int, Train], dict[int, Train]]:
+        """Load the unfetched trains of a day, and index the fetched ones."""
+        fetched_trains: SpilledDataset[int, Train] = SpilledDataset(
+            self._day_path(day) / "trains.pickle", key=hash
+        )
+        unfetched_trains: dict[int, Train] = rekey_trains(
+            load_dataset(self._day_path(day) / "unfetched.pickle")
+        )
+
+        # Trains appended by an interrupted run, before it saved the unfetched ones
+        for train_hash in [h for h in unfetched_trains if h in fetched_trains]:
+            del unfetched_trains[train_hash]
+        return fetched_trains, unfetched_trains
+
+    def save_trains(
+        self,
+        day: date,
+        fetched_trains: t.Mapping[int, Train],
+        unfetched_trains: dict[int, Train],
+    ) -> None:
+        """Save the fetched and unfetched trains of a day.
+
+        The fetched trains loaded by load_trains() are appended to their file,
+        other datasets are written as a whole.
+        """
+        fetched_path: pathlib.Path = self._day_path(day) / "trains.pickle"
+        if isinstance(fetched_trains, SpilledDataset) and (
+            fetched_trains.path == fetched_path
+        ):
+            fetched_trains.flush()
+        else:
+            save_dataset(fetched_path, dict(fetched_trains))
+        save_dataset(self._day_path(day) / "unfetched.pickle", unfetched_trains)
+
+    def load_traffic(self, day: date) -> Counter[str]:
+        """Load the departures of the fetched trains of a day from each station
+        (see station_traffic), counted again if not saved."""
+        traffic_path: pathlib.Path = self._day_path(day) / "traffic.pickle"
+        if traffic_path.exists():
+            return Counter(load_dataset(traffic_path))
+        return station_traffic(
+            SpilledDataset(self._day_path(day) / "trains.pickle").values()
+        )
+
+    def save_traffic(self, day: date, traffic: t.Mapping[str, int]) -> None:
+        """Save the departures of the fetched trains of a day from each station,
+        next to them."""
+        save_dataset(self._day_path(day) / "traffic.pickle", dict(traffic))
+
+    def close(self) -> None:
+        """Nothing to close."""
+
+
+class StoredTrains(t.Mapping[int, Train]):
+    """The fetched trains of a day in a SQLite database (see SQLiteStore),
+    which keeps only their keys in memory.
+
+    A train is read from the database when accessed. New trains are kept
+    in memory until saved by SQLiteStore.save_trains(): trains with no more
+    data to fetch do not change, so only the new ones are written.
+
+    Attributes:
+        day (date): the scraping day
+    """
+
+    def __init__(
+        self, connection: sqlite3.Connection, day: date, keys: t.Iterable[int]
+    ) -> None:
+        """Index the fetched trains of a day.
+
+        Args:
+            connection (sqlite3.Connection): the database
+            day (date): the scraping day
+            keys (t.Iterable[int]): the keys of the stored trains (see Train.key)
+        """
+        self.day: date = day
+        self._connection: sqlite3.Connection = connection
+        self._keys: set[int] = set(keys)
+        self._buffer: dict[int, Train] = dict()
+
+    def __setitem__(self, key: int, train: Train) -> None:
+        self._buffer[key] = train
+
+    def __getitem__(self, key: int) -> Train:
+        if key in self._buffer:
+            return self._buffer[key]
+        if key not in self._keys:
+            raise KeyError(key)
+        (data,) = self._connection.execute(
+            "SELECT data FROM trains WHERE key = ?", (key,)
+        ).fetchone()
+        return pickle.loads(data)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._buffer or key in self._keys
+
+    def __iter__(self) -> t.Iterator[int]:
+        yield from self._keys
+        yield from (key for key in self._buffer if key not in self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys) + sum(1 for key in self._buffer if key not in self._keys)
+
+    def items(self) -> t.Iterator[t.Tuple[int, Train]]:  # type: ignore[override]
+        """Iterate over the trains, reading the stored ones one at a time."""
+        for key, data in self._connection.execute(
+            "SELECT key, data FROM trains WHERE day = ? AND unfetched = 0",
+            (self.day.isoformat(),),
+        ):
+            if key in self._keys and key not in self._buffer:
+                yield key, pickle.loads(data)
+        yield from list(self._buffer.items())
+
+    def values(self) -> t.Iterator[Train]:  # type: ignore[override]
+        """Iterate over the trains, reading the stored ones one at a time."""
+        return (train for _, train in self.items())
+
+
+class SQLiteStore:
+    """The scraper state, in a SQLite database in WAL mode.
+
+    Every train and station is stored as a pickle, to be loaded back as it is,
+    along with its main attributes (and the stops of the trains) in plain columns,
+    to be queried by other tools while the scraper is running.
+    Only the trains and stations which changed since they were loaded
+    or last saved are written.
+
+    Attributes:
+        path (pathlib.Path): the database file
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        """Open (or create) a database.
+
+        Args:
+            path (pathlib.Path): the database file
+        """
+        self.path: pathlib.Path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute("PRAGMA synchronous = NORMAL")
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        self._connection.executescript(_SCHEMA)
+
+        # Digests of the stored objects, to write the changed ones only
+        self._trains: dict[int, t.Tuple[bytes, bool]] = dict()
+        self._stations: dict[str, bytes] = dict()
+
+    def load_stations(self) -> dict[str, Station]:
+        """Load the station cache.
+
+        Returns:
+            dict[str, Station]: the stations, by code
+        """
+        stations: dict[str, Station] = dict()
+        for code, data, digest in self._connection.execute(
+            "SELECT code, data, digest FROM stations"
+        ):
+            stations[code] = pickle.loads(data)
+            self._stations[code] = digest
+        return stations
+
+    def save_stations(self, stations: dict[str, Station]) -> None:
+        """Save the new and changed stations of the station cache.
+
+        Args:
+            stations (dict[str, Station]): the stations, by code
+        """
+        rows: list[t.Tuple[t.Any, ...]] = list()
+        for code, station in stations.items():
+            data: bytes = pickle.dumps(station)
+            digest: bytes = _digest(data)
+            if self._stations.get(code) == digest:
+                continue
+            self._stations[code] = digest
+            latitude, longitude = station.position or (None, None)
+            rows.append(
+                (code, station.region_code, station.name, latitude, longitude)
+                + (data, digest)
+            )
+
+        with self._connection:
+            self._connection.executemany(_UPSERT_STATION, rows)
+
+    def load_trains(self, day: date) -> t.Tuple[StoredTrains, dict[int, Train]]:
+        """Load the unfetched trains of a day, and index the fetched ones.
+
+        Args:
+            day (date): the scraping day
+
+        Returns:
+            t.Tuple[StoredTrains, dict[int, Train]]: the fetched and unfetched
+            trains, by hash
+        """
+        fetched_keys: list[int] = list()
+        for key, digest, unfetched in self._connection.execute(
+            "SELECT key, digest, unfetched FROM trains WHERE day = ?",
+            (day.isoformat(),),
+        ):
+            self._trains[key] = (digest, bool(unfetched))
+            if not unfetched:
+                fetched_keys.append(key)
+
+        unfetched_trains: dict[int, Train] = dict()
+        for key, data in self._connection.execute(
+            "SELECT key, data FROM trains WHERE day = ? AND unfetched = 1",
+            (day.isoformat(),),
+        ):
+            unfetched_trains[key] = pickle.loads(data)
+        return StoredTrains(self._connection, day, fetched_keys), unfetched_trains
+
+    def save_trains(
+        self,
+        day: date,
+        fetched_trains: t.Mapping[int, Train],
+        unfetched_trains: dict[int, Train],
+    ) -> None:
+        """Save the new and changed trains of a day, in a single transaction.
+
+        Of the fetched trains loaded by load_trains(), only the new ones are
+        considered; trains are pickled only if their digest changed.
+        Trains of the day which are not in the datasets anymore are deleted.
+
+        Args:
+            day (date): the scraping day
+            fetched_trains (t.Mapping[int, Train]): trains with no more data to fetch
+            unfetched_trains (dict[int, Train]): trains to fetch again
+        """
+        stored: StoredTrains | None = None
+        if isinstance(fetched_trains, StoredTrains) and fetched_trains.day == day:
+            stored = fetched_trains
+
+        saved: set[int] = set(fetched_trains) | set(unfetched_trains)
+        with self._connection:
+            for trains, unfetched in (
+                (stored._buffer if stored is not None else fetched_trains, False),
+                (unfetched_trains, True),
+            ):
+                for train in trains.values():
+                    key: int = train.key
+                    digest: bytes = _train_digest(train)
+                    if self._trains.get(key) == (digest, unfetched):
+                        continue
+                    self._trains[key] = (digest, unfetched)
+                    self._upsert_train(day, train, unfetched, digest)
+
+            for (key,) in self._connection.execute(
+                "SELECT key FROM trains WHERE day = ?", (day.isoformat(),)
+            ).fetchall():
+                if key in saved:
+                    continue
+                self._trains.pop(key, None)
+                self._connection.execute("DELETE FROM trains WHERE key = ?", (key,))
+
+        if stored is not None:
+            stored._keys.update(stored._buffer)
+            stored._buffer.clear()
+
+    def load_traffic(self, day: date) -> Counter[str]:
+        """Load the departures of the fetched trains of a day from each station
+        (see station_traffic), counted again if not saved.
+
+        Args:
+            day (date): the scraping day
+
+        Returns:
+            Counter[str]: the number of departures by station code
+        """
+        rows: list[t.Tuple[str, int]] = self._connection.execute(
+            "SELECT station_code, departures FROM traffic WHERE day = ?",
+            (day.isoformat(),),
+        ).fetchall()
+        if rows:
+            return Counter(dict(rows))
+        return station_traffic(
+            pickle.loads(data)
+            for (data,) in self._connection.execute(
+                "SELECT data FROM trains WHERE day = ? AND unfetched = 0",
+                (day.isoformat(),),
+            )
+        )
+
+    def save_traffic(self, day: date, traffic: t.Mapping[str, int]) -> None:
+        """Save the departures of the fetched trains of a day from each station.
+
+        Args:
+            day (date): the scraping day
+            traffic (t.Mapping[str, int]): the number of departures by station code
+        """
+        with self._connection:
+            self._connection.execute(
+                "DELETE FROM traffic WHERE day = ?", (day.isoformat(),)
+            )
+            self._connection.executemany(
+                "INSERT INTO traffic VALUES (?, ?, ?)",
+                [(day.isoformat(), code, n) for code, n in traffic.items()],
+            )
+
+    def _upsert_train(
+        self, day: date, train: Train, unfetched: bool, digest: bytes
+    ) -> None:
+        """Write a train and replace its stops. Helper function to save_trains()."""
+        (train_id,) = self._connection.execute(
+            _UPSERT_TRAIN,
+            (
+                train.key,
+                train.origin.code,
+                train.number,
+                train.departing_date.isoformat(),
+                day.isoformat(),
+                unfetched,
+                train.category,
+                train.client_code,
+                train.destination.code if train.destination else None,
+                train.departed,
+                train.cancelled,
+                train.delay,
+                train.crowding,
+                train.last_detection_place,
+                _isoformat(train.last_detection_time),
+                pickle.dumps(train),
+                digest,
+            ),
+        ).fetchone()
+
+        self._connection.execute("DELETE FROM stops WHERE train_id = ?", (train_id,))
+        stops: list[tr_st.TrainStop] = train.stops or list()
+        self._connection.executemany(
+            "INSERT INTO stops VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    train_id,
+                    position,
+                    stop.station.code,
+                    stop.stop_type.value,
+                    stop.platform_expected,
+                    stop.platform_actual,
+                    _isoformat(stop.arrival.expected if stop.arrival else None),
+                    _isoformat(stop.arrival.actual if stop.arrival else None),
+                    _isoformat(stop.departure.expected if stop.departure else None),
+                    _isoformat(stop.departure.actual if stop.departure else None),
+                )
+                for position, stop in enumerate(stops)
+            ],
+        )
+
+    def close(self) -> None:
+        """Close the database."""
+        self._connection.close()
+
+
+Store = PickleStore | SQLiteStore
+
+
+def open_store(storage: str, data_dir: pathlib.Path) -> Store:
+    """Open the scraper state of a data directory.
+
+    Args:
+        storage (str): the storage backend, one of STORAGES
+        data_dir (pathlib.Path): the data directory
+
+    Returns:
+        Store: the opened store
+    """
+    assert storage in STORAGES
+    if storage == "sqlite":
+        return SQLiteStore(data_dir / SQLITE_FILENAME)
+    return PickleStore(data_dir)
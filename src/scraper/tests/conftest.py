@@ -0,0 +1,75 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+import typing as t
+from collections import Counter
+
+import pytest
+
+from src.scraper.api import TrenordAPI, ViaggiaTrenoAPI
+from src.scraper.standin import NetworkDay
+from src.scraper.station import Station
+
+
+class FakeAPI(NetworkDay):
+    """In-memory stand-in for the ViaggiaTreno and Trenord APIs,
+    answering the requests with a NetworkDay without any HTTP request.
+
+    Trains are registered with add_train() and shown on the departure board
+    of their origin station and on the arrival board of their destination;
+    every other request returns HTTP 204.
+    """
+
+    def __init__(self, latency: float = 0.0) -> None:
+        super().__init__()
+        self.latency: float = latency
+        self.requests: Counter[str] = Counter()
+        self.in_flight: int = 0
+        self.max_in_flight: int = 0
+        self._lock = threading.Lock()
+
+    def request(self, method: str, *parameters: t.Any) -> str:
+        with self._lock:
+            self.requests[method] += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            return self.respond(method, *parameters)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+@pytest.fixture
+def fake_api(monkeypatch: pytest.MonkeyPatch) -> t.Iterator[FakeAPI]:
+    """Replace the API layer with a FakeAPI and isolate the station cache."""
+    fake: FakeAPI = FakeAPI()
+    monkeypatch.setattr(
+        ViaggiaTrenoAPI, "_raw_request", classmethod(lambda _, *a: fake.request(*a))
+    )
+    monkeypatch.setattr(
+        TrenordAPI, "_raw_request", classmethod(lambda _, *a: fake.request(*a))
+    )
+    monkeypatch.setattr(Station, "_cache", dict())
+    monkeypatch.setattr(Station, "_pending", dict())
+    monkeypatch.setattr(Station, "_regions", dict())
+    monkeypatch.setattr(Station, "_stubs", dict())
+    yield fake
@@ -0,0 +1,139 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import pathlib
+from datetime import datetime
+
+import pytest
+
+import src.scraper.api as api
+from src.scraper.archive import ARCHIVE_DIRNAME, ResponseArchive
+from src.scraper.dataset import load_dataset
+from src.scraper.exceptions import BadRequestException
+from src.scraper.loop import ScrapeLoop
+from src.scraper.reparse import REPARSED_DIRNAME, reparse_day
+from src.scraper.station import Station
+from src.scraper.train import Train
+
+# The request methods replaced by the fake_api fixture
+_RAW_REQUESTS = {
+    cls: cls.__dict__["_raw_request"] for cls in (api.ViaggiaTrenoAPI, api.TrenordAPI)
+}
+
+
+class _Response:
+    def __init__(self, url: str, status_code: int, text: str) -> None:
+        self.url: str = url
+        self.status_code: int = status_code
+        self.text: str = text
+
+
+def test_archive(tmp_path):
+    archive = ResponseArchive(tmp_path, writer="a")
+    archive.add("ViaggiaTrenoAPI", "regione", ["S00001"], "1")
+    archive.add("ViaggiaTrenoAPI", "regione", ["S00002"], "1")
+    archive.add("ViaggiaTrenoAPI", "regione", ["S00001"], "2")
+    archive.close()
+
+    # Identical responses are stored once
+    assert archive.entries[0].offset == archive.entries[1].offset
+    assert archive.replay("ViaggiaTrenoAPI", "regione", ["S00001"]) == "2"
+    with pytest.raises(BadRequestException):
+        archive.replay("ViaggiaTrenoAPI", "regione", ["S00003"])
+
+    # Unsuccessful responses are replayed as such
+    archive.add("ViaggiaTrenoAPI", "andamentoTreno", ["S00001", 1, 0], "", 204)
+    with pytest.raises(BadRequestException) as e:
+        archive.replay("ViaggiaTrenoAPI", "andamentoTreno", ["S00001", 1, 0])
+    assert e.value.status_code == 204
+    archive.close()
+
+    # Another writer shares the responses of the first one
+    other = ResponseArchive(tmp_path, writer="b")
+    assert len(other) == 4
+    other.add("ViaggiaTrenoAPI", "regione", ["S00003"], "1")
+    other.close()
+    assert other.entries[-1].pack == "a"
+    assert not (tmp_path / "b.pack").stat().st_size
+
+    # Lines truncated by a crash are ignored
+    with open(tmp_path / "b.idx", "a") as f:
+        f.write('{"time": ')
+    reopened = ResponseArchive(tmp_path)
+    assert len(reopened) == 5
+    assert reopened.replay("ViaggiaTrenoAPI", "regione", ["S00003"]) == "1"
+    assert reopened.replay("ViaggiaTrenoAPI", "regione", ["S00001"]) == "2"
+
+
+def test_reparse(fake_api, monkeypatch, tmp_path):
+    def _get(session, limiter, breaker, api_name, method, url: str) -> _Response:
+        parameters: list[str] = url.split(f"/{method}/", 1)[1].split("/")
+        try:
+            return _Response(url, 200, fake_api.request(method, *parameters))
+        except BadRequestException as e:
+            return _Response(url, e.status_code, e.response)
+
+    # Perform real (but faked) requests, archiving the responses
+    day_path: pathlib.Path = tmp_path / "2023-05-01"
+    archive = ResponseArchive(day_path / ARCHIVE_DIRNAME)
+    monkeypatch.setattr(api, "_throttled_get", _get)
+    for cls, raw_request in _RAW_REQUESTS.items():
+        monkeypatch.setattr(cls, "_raw_request", raw_request)
+        monkeypatch.setattr(cls, "_archive", archive)
+
+    fake_api.add_train(1, ["S00001", "S00002"], arrived=False)
+    fake_api.add_train(2, ["S00003", "S00004"], client_code=63)
+    fake_api.add_trenord(2, ["S00003", "S00005", "S00004"])
+    # A train without details (HTTP 204), and one not departed yet
+    fake_api.add_train(3, ["S00001", "S00004"])
+    del fake_api.trains[("S00001", 3)]
+    fake_api.add_train(4, ["S00003", "S00001"], arrived=False, hour=23, minute=59)
+    stations: list[Station] = [Station.by_code(c) for c in ("S00001", "S00003")]
+
+    fetched: dict[int, Train] = dict()
+    unfetched: dict[int, Train] = dict()
+    ScrapeLoop(fetched, unfetched).run(stations)
+    fake_api.set_arrived("S00001", 1)
+    due: datetime = next(t for t in unfetched.values() if t.number == 1)._next_fetch
+    ScrapeLoop(fetched, unfetched, now=lambda: due).run([])
+    archive.close()
+    assert sorted(t.number for t in fetched.values()) == [1, 2, 3]
+    assert [t.number for t in unfetched.values()] == [4]
+
+    # Rebuild the datasets with no requests, next to the scraped ones
+    requests: int = sum(fake_api.requests.values())
+    assert reparse_day(day_path, Station._cache) == (3, 1)
+    assert sum(fake_api.requests.values()) == requests
+    assert api.ViaggiaTrenoAPI._replay is None
+    assert not (day_path / "trains.pickle").exists()
+
+    reparsed: dict[int, Train] = load_dataset(
+        day_path / REPARSED_DIRNAME / "trains.pickle"
+    )
+    assert reparsed.keys() == fetched.keys()
+    for train_hash, train in reparsed.items():
+        assert train._phantom == fetched[train_hash]._phantom
+        if train._phantom:
+            continue
+        assert train.category == fetched[train_hash].category
+        assert train.crowding == fetched[train_hash].crowding
+        assert len(train.stops) == len(fetched[train_hash].stops)
+        assert train.arrived()
+    assert (
+        load_dataset(day_path / REPARSED_DIRNAME / "unfetched.pickle").keys()
+        == unfetched.keys()
+    )
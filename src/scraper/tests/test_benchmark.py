@@ -0,0 +1,75 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import src.analysis.benchmark as analysis_benchmark
+import src.benchmark as benchmark
+import src.scraper.benchmark as scraper_benchmark
+from src.scraper.station import Station
+
+
+def test_compare(tmp_path):
+    baseline = [
+        benchmark.Result("micro.a", 10.0, "us/train"),
+        benchmark.Result("scraper.b", 100.0, "trains/s", higher_is_better=True),
+    ]
+    benchmark.save_results(tmp_path / "baseline.json", baseline)
+    assert benchmark.load_results(tmp_path / "baseline.json") == baseline
+
+    results = [
+        benchmark.Result("micro.a", 10.5, "us/train"),
+        benchmark.Result("scraper.b", 80.0, "trains/s", higher_is_better=True),
+        benchmark.Result("micro.new", 1.0, "us/stop"),
+    ]
+    changes = benchmark.compare(results, baseline, tolerance=0.1)
+    assert [(c.result.name, c.regression) for c in changes] == [
+        ("micro.a", False),
+        ("scraper.b", True),
+    ]
+    assert round(changes[1].change, 2) == -0.2
+
+    table: str = benchmark.report(results, changes)
+    assert "REGRESSION" in table.splitlines()[1]
+    assert "micro.new" in table
+
+
+def test_micro():
+    cache = Station._cache
+    results = scraper_benchmark.micro(50, repeat=1)
+    assert {result.name for result in results} == {
+        "micro.train.from_board",
+        "micro.train_stop.from_raw",
+        "micro.train_stop.from_trenord",
+        "micro.train.fix_intraday",
+        "micro.pickle.dumps",
+        "micro.pickle.loads",
+        "micro.pickle.size",
+    }
+    assert all(result.value > 0 for result in results)
+    assert Station._cache is cache
+
+
+def test_end_to_end():
+    results = {r.name: r for r in scraper_benchmark.end_to_end(50)}
+    assert results["scraper.trains_per_second"].value > 0
+    assert results["scraper.requests_per_train"].value >= 1
+
+
+def test_pipeline():
+    results = {r.name: r for r in analysis_benchmark.pipeline(2, 100)}
+    for stage in ("extract", "load", "tag", "filter", "stat"):
+        assert results[f"pipeline.{stage}.time"].value > 0
+        assert results[f"pipeline.{stage}.memory"].value > 0
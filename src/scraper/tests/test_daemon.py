@@ -0,0 +1,158 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import json
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta
+
+import pytest
+
+import src.scraper.main as scraper
+from src.const import TIMEZONE
+from src.scraper.daemon import ScraperDaemon, StatusServer
+from src.scraper.dataset import load_dataset
+from src.scraper.station import Station
+from src.scraper.train import Train
+
+
+@pytest.fixture
+def data_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(scraper, "DATA_DIR", tmp_path)
+    monkeypatch.setattr(scraper, "STATS_PATH", tmp_path / "stats.pickle")
+    monkeypatch.setattr(scraper, "LAST_RUN_PATH", tmp_path / "last_run.pickle")
+    monkeypatch.setattr(scraper, "REGIONS_PATH", tmp_path / "regions.pickle")
+    monkeypatch.setattr(scraper, "METRICS_PATH", tmp_path / "metrics.prom")
+    monkeypatch.setattr(scraper, "RUNS_DIR", tmp_path / "runs")
+    return tmp_path
+
+
+def _args(*argv: str) -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    scraper.register_args(parser)
+    return parser.parse_args(["--daemon", *argv])
+
+
+def _get(server: StatusServer, path: str):
+    with urllib.request.urlopen(f"http://127.0.0.1:{server.server_port}{path}") as r:
+        return json.load(r)
+
+
+def test_daemon_rounds(fake_api, data_dir):
+    fake_api.add_train(1, ["S00001", "S00009"], arrived=False)
+    fake_api.add_train(2, ["S00002", "S00009"])
+    fake_api.regions.update({"S00001": 1, "S00002": 1})
+
+    now: datetime = datetime.now(tz=TIMEZONE)
+    daemon = ScraperDaemon(_args("--adaptive-polling"), now=lambda: now)
+    daemon.run_round()
+
+    # The datasets are saved after every round
+    day_path = data_dir / scraper.scraping_day(now).strftime("%Y-%m-%d")
+    assert [t.number for t in load_dataset(day_path / "trains.pickle").values()] == [2]
+    assert [t.number for t in load_dataset(day_path / "unfetched.pickle").values()] == [
+        1
+    ]
+    assert set(load_dataset(scraper.STATS_PATH)) == {"S00001", "S00002"}
+
+    # The running train is fetched again from memory when due
+    fake_api.set_arrived("S00001", 1)
+    running: Train = next(iter(daemon.unfetched_trains.values()))
+    running._next_fetch = None
+    daemon.run_round()
+    assert sorted(t.number for t in daemon.fetched_trains.values()) == [1, 2]
+    assert daemon.rounds == 2
+
+    # At the day change, the datasets of the new day are loaded
+    now += timedelta(days=1)
+    daemon.run_round()
+    assert daemon.day == scraper.scraping_day(now)
+    assert len(load_dataset(day_path / "trains.pickle")) == 2
+
+
+def test_daemon_status(fake_api, data_dir):
+    fake_api.add_train(1, ["S00001", "S00009"], arrived=False)
+    fake_api.regions["S00001"] = 1
+
+    daemon = ScraperDaemon(_args())
+    server = StatusServer(daemon, 0)
+    server.start()
+    try:
+        daemon.run_round()
+
+        status: dict = _get(server, "/status")
+        assert status["rounds"] == 1
+        assert status["trains"] == {"fetched": 0, "unfetched": 1, "running": 1}
+        assert status["loop"] is None
+        assert "rate" in status["throttling"]["ViaggiaTreno"]
+
+        trains: list[dict] = _get(server, "/trains")
+        assert [(t["number"], t["origin"]) for t in trains] == [(1, "S00001")]
+
+        with urllib.request.urlopen(
+            f"http://127.0.0.1:{server.server_port}/metrics"
+        ) as r:
+            assert "railway_scraper_trains_total" in r.read().decode()
+
+        with pytest.raises(urllib.error.HTTPError):
+            _get(server, "/")
+    finally:
+        server.stop()
+
+    assert Station._cache["S00001"].code == "S00001"
+
+    # The metrics are exported after every round
+    assert "railway_scraper_trains_total" in (data_dir / "metrics.prom").read_text()
+    with open(next((data_dir / "runs").iterdir())) as f:
+        summary: dict = json.load(f)
+    assert summary["round"] == 1 and summary["new_trains"] == 0
+    assert summary["metrics"]["trains"]["state=unfetched"] == 1
+
+
+class _Busy(dict):
+    """A dataset being changed by the loop thread."""
+
+    def __len__(self) -> int:
+        raise RuntimeError("dictionary changed size during iteration")
+
+    def values(self):
+        raise RuntimeError("dictionary changed size during iteration")
+
+
+def test_daemon_status_running(fake_api, data_dir):
+    fake_api.add_train(1, ["S00001", "S00009"], arrived=False)
+    fake_api.regions["S00001"] = 1
+
+    daemon = ScraperDaemon(_args())
+    statuses: list[dict] = list()
+    set_loop = daemon._set_loop
+
+    def _set_loop(loop) -> None:
+        set_loop(loop)
+        datasets = daemon.fetched_trains, daemon.unfetched_trains
+        daemon.fetched_trains, daemon.unfetched_trains = _Busy(), _Busy()
+        statuses.append(daemon.status())
+        daemon.fetched_trains, daemon.unfetched_trains = datasets
+
+    daemon._set_loop = _set_loop
+    daemon.run_round()
+
+    # While the round runs, the counts are read from the loop snapshot
+    assert statuses[0]["trains"] == {"fetched": 0, "unfetched": 0, "running": 0}
+    assert statuses[0]["loop"]["trains"] == {"fetched": 0, "unfetched": 0}
+    assert daemon.status()["trains"] == {"fetched": 0, "unfetched": 1, "running": 1}
@@ -0,0 +1,122 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from datetime import date, timedelta
+
+import src.scraper.discovery as discovery
+from src.scraper.dataset import SpilledDataset, save_dataset
+from src.scraper.discovery import (
+    build_plan,
+    discovery_stations,
+    greedy_cover,
+    load_plan,
+)
+from src.scraper.station import Station
+from src.scraper.train import Train
+
+
+def _trains(fake_api, routes: dict[int, list[str]]) -> list[Train]:
+    trains: list[Train] = list()
+    for number, stations in routes.items():
+        fake_api.add_train(number, stations)
+        train: Train = next(
+            t for t in Station.by_code(stations[0]).departures() if t.number == number
+        )
+        train.fetch()
+        trains.append(train)
+    return trains
+
+
+def test_greedy_cover():
+    candidates = {
+        1: {"X", "Y"},
+        2: {"Y", "Z"},
+        3: {"Z"},
+    }
+    assert greedy_cover(candidates) == ["Y", "Z"]
+    assert len(greedy_cover(candidates, target=0.5)) == 1
+    assert greedy_cover(dict()) == []
+
+
+def test_build_plan(fake_api):
+    trains: list[Train] = _trains(
+        fake_api,
+        {
+            1: ["S00001", "S00002", "S00003", "S00004"],
+            2: ["S00005", "S00002", "S00006"],
+            3: ["S00007", "S00003"],
+            4: ["S00008", "S00009"],
+        },
+    )
+    assert discovery_stations(trains[0], prefix_stops=1) == {"S00001", "S00002"}
+    # The last stop has no departures
+    assert discovery_stations(trains[0]) == {"S00001", "S00002", "S00003"}
+
+    # Trains 1 and 2 are covered by a single station, train 4 is new in the last day
+    plan = build_plan([trains[:3], trains], date.today())
+    assert plan.trains == 3
+    assert len(plan.stations) == 2 and "S00002" in plan.stations
+    assert plan.coverage == 0.75
+
+
+def test_load_plan(fake_api, tmp_path):
+    trains: list[Train] = _trains(fake_api, {1: ["S00001", "S00002"]})
+    today: date = date(2023, 5, 10)
+    for days in (1, 2):
+        day_path = tmp_path / (today - timedelta(days=days)).strftime("%Y-%m-%d")
+        day_path.mkdir()
+        save_dataset(day_path / "trains.pickle", {0: trains[0]})
+
+    assert load_plan(tmp_path, date(2023, 4, 1)) is None
+
+    plan = load_plan(tmp_path, today)
+    assert plan is not None and plan.stations == {"S00001"}
+    assert plan.coverage == 1.0
+
+    # The plan is cached, then computed again after a week
+    assert load_plan(tmp_path, today + timedelta(days=6)) == plan
+    assert load_plan(tmp_path, today + timedelta(days=7)) == plan
+
+    later: date = today + timedelta(days=8)
+    day_path = tmp_path / (later - timedelta(days=1)).strftime("%Y-%m-%d")
+    day_path.mkdir()
+    save_dataset(day_path / "trains.pickle", {0: trains[0]})
+    assert load_plan(tmp_path, later).created == later
+
+
+def test_load_plan_spilled(fake_api, tmp_path, monkeypatch):
+    trains: list[Train] = _trains(
+        fake_api, {1: ["S00001", "S00002"], 2: ["S00001", "S00003"]}
+    )
+    today: date = date(2023, 5, 10)
+    for days in (1, 2):
+        day_path = tmp_path / (today - timedelta(days=days)).strftime("%Y-%m-%d")
+        day_path.mkdir()
+        dataset = SpilledDataset(day_path / "trains.pickle")
+        for train in (trains[0], trains[1], trains[0]):
+            dataset[train.key] = train
+            dataset.flush()
+
+    # The datasets of the past days are streamed, not loaded
+    def _load_dataset(path):
+        assert path.name == "discovery_plan.pickle"
+        return dict()
+
+    monkeypatch.setattr(discovery, "load_dataset", _load_dataset)
+    plan = load_plan(tmp_path, today)
+    assert plan is not None and plan.stations == {"S00001"}
+    assert plan.trains == 2 and plan.coverage == 1.0
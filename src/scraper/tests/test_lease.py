@@ -0,0 +1,137 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import multiprocessing
+import pathlib
+
+from src.scraper.cluster import Cluster
+from src.scraper.dataset import load_dataset
+from src.scraper.lease import LeaseManager
+from src.scraper.station import Station
+from src.scraper.train import Train
+
+
+class FakeClock:
+    def __init__(self, now: float = 1000.0) -> None:
+        self.now: float = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _claim_all(directory: pathlib.Path, node: str) -> list[str]:
+    leases = LeaseManager(directory, node, ttl=600)
+    return [f"r{i}" for i in range(50) if leases.acquire(f"r{i}")]
+
+
+def test_lease_expiry(tmp_path):
+    clock = FakeClock()
+    a = LeaseManager(tmp_path, "a", ttl=60, clock=clock)
+    b = LeaseManager(tmp_path, "b", ttl=60, clock=clock)
+
+    assert a.acquire("unit")
+    assert not b.acquire("unit")
+    assert a.acquire("unit")
+
+    # a dies: its lease expires and b takes over
+    clock.now += 61
+    assert b.acquire("unit")
+    assert b.holder("unit").node == "b"
+    assert not a.renew("unit")
+
+    # b restarts after its lease expired: it takes it back
+    clock.now += 61
+    assert LeaseManager(tmp_path, "b", ttl=60, clock=clock).acquire("unit")
+    assert b.holder("unit").expires == clock.now + 60
+
+    b.release("unit")
+    assert a.acquire("unit")
+
+
+def test_lease_renew_race(tmp_path):
+    clock = FakeClock()
+    a = LeaseManager(tmp_path, "a", ttl=60, clock=clock)
+    b = LeaseManager(tmp_path, "b", ttl=60, clock=clock)
+    assert a.acquire("unit")
+
+    # The lease of a expires while a renews it: b can't take it over meanwhile
+    write = a._write
+    taken_over: list[bool] = list()
+
+    def _write(path: pathlib.Path, flags: int) -> None:
+        clock.now += 61
+        taken_over.append(b.acquire("unit"))
+        write(path, flags)
+
+    a._write = _write
+    assert a.renew("unit")
+    assert taken_over == [False]
+    assert b.holder("unit").node == "a"
+
+    # A lease being taken over is not renewed
+    a._write = write
+    with b._guard("unit"):
+        assert not a.renew("unit")
+    assert a.renew("unit")
+
+
+def test_lease_processes(tmp_path):
+    with multiprocessing.Pool(4) as pool:
+        claimed: list[list[str]] = pool.starmap(
+            _claim_all, [(tmp_path, f"node{i}") for i in range(4)]
+        )
+
+    # Every resource is claimed by exactly one process
+    all_claimed: list[str] = [r for node in claimed for r in node]
+    assert sorted(all_claimed) == sorted(f"r{i}" for i in range(50))
+
+
+def test_cluster_takeover(fake_api, tmp_path):
+    codes: list[str] = ["S00001", "S00002", "S00003"]
+    for i, code in enumerate(codes):
+        fake_api.regions[code] = i + 1
+        fake_api.add_train(i, [code, "S00009"])
+    stations: list[Station] = [Station.by_code(code) for code in codes]
+
+    clock = FakeClock()
+    today_path: pathlib.Path = tmp_path / "2023-05-01"
+    today_path.mkdir()
+    stations_path: pathlib.Path = tmp_path / "stations.pickle"
+
+    def _node(name: str) -> Cluster:
+        return Cluster(name, today_path, stations_path, lease_ttl=60, clock=clock)
+
+    # A node dies while processing region 2
+    dead: Cluster = _node("dead")
+    assert dead.leases.acquire(dead._unit(int(clock() // 3600), 2))
+
+    processed: list[int] = _node("a").run(stations, concurrency=2)
+    assert 2 not in processed and 1 in processed and 3 in processed
+    assert _node("b").run(stations, concurrency=2) == []
+
+    fetched: dict[int, Train] = load_dataset(today_path / "trains.pickle")
+    assert sorted(t.number for t in fetched.values()) == [0, 2]
+
+    # Its lease expires, another node takes over
+    clock.now += 61
+    assert _node("b").run(stations, concurrency=2) == [2]
+
+    fetched = load_dataset(today_path / "trains.pickle")
+    assert sorted(t.number for t in fetched.values()) == [0, 1, 2]
+    assert len(list((today_path / "nodes").iterdir())) == 0
+    assert "S00002" in load_dataset(stations_path)
+    assert fake_api.requests["andamentoTreno"] == 3
@@ -0,0 +1,81 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from datetime import datetime, timedelta
+
+import src.localtime as localtime
+from src.const import TIMEZONE
+
+
+def _around_transitions() -> list[int]:
+    timestamps: list[int] = list()
+    for transition in localtime.table().transitions[1:]:
+        timestamps += [transition + delta for delta in (-3601, -1, 0, 1, 3600)]
+    # Outside of the table
+    timestamps += [-2300000000, 4200000000]
+    return timestamps
+
+
+def test_conversions():
+    timestamps: list[int] = _around_transitions()
+    for timestamp in timestamps:
+        expected: datetime = datetime.fromtimestamp(timestamp, TIMEZONE)
+        converted = localtime.to_datetime(timestamp)
+        assert converted is not None
+        assert converted.isoformat() == expected.isoformat()
+        assert converted.timestamp() == timestamp
+        assert localtime.hour(timestamp) == expected.hour
+
+        # Local times, including the missing and ambiguous ones
+        wall: datetime = expected.replace(tzinfo=None) + timedelta(minutes=30)
+        assert localtime.to_timestamp(wall) == wall.replace(tzinfo=TIMEZONE).timestamp()
+        assert localtime.to_timestamp(wall.replace(tzinfo=TIMEZONE)) == int(
+            wall.replace(tzinfo=TIMEZONE).timestamp()
+        )
+
+    assert localtime.to_datetime(None) is None
+    assert localtime.to_timestamp(None) is None
+
+    # Across a DST change, the local time is kept
+    saturday = datetime(2023, 3, 25, 3, 30, tzinfo=TIMEZONE)
+    moved: int = localtime.add_days(int(saturday.timestamp()), 1)
+    assert moved == (saturday + timedelta(days=1)).timestamp()
+    assert moved - saturday.timestamp() == 86400 - 3600
+
+
+def test_batch_conversions():
+    timestamps: list[int | None] = [*_around_transitions(), None]
+    strings = localtime.isoformat(timestamps)
+    assert list(strings) == [
+        datetime.fromtimestamp(ts, TIMEZONE).isoformat() if ts is not None else None
+        for ts in timestamps
+    ]
+
+    parsed = localtime.parse_isoformat([*strings, float("nan"), "invalid"])
+    assert [dt.timestamp() if dt else None for dt in parsed] == [
+        *timestamps,
+        None,
+        None,
+    ]
+
+    datetimes = localtime.to_datetimes(timestamps)
+    assert list(datetimes) == list(parsed[:-2])
+    assert all(
+        dt.utcoffset() == localtime.to_datetime(ts).utcoffset()  # type: ignore
+        for dt, ts in zip(datetimes[:-1], timestamps)
+    )
+    assert len(localtime.isoformat([])) == len(localtime.to_datetimes([])) == 0
@@ -0,0 +1,346 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import src.scraper.dataset as dataset
+import src.scraper.station as st
+from src.const import TIMEZONE
+from src.scraper.api import ViaggiaTrenoAPI
+from src.scraper.dataset import SpilledDataset, load_dataset
+from src.scraper.exceptions import ThrottledException
+from src.scraper.loop import ScrapeLoop
+from src.scraper.schedule import board_slices, station_traffic
+from src.scraper.station import Station
+from src.scraper.train import Train
+
+
+def _stations(*codes: str) -> list[Station]:
+    return [Station.by_code(code) for code in codes]
+
+
+def test_by_code_async_single_flight(fake_api):
+    async def lookup() -> list[Station]:
+        return await asyncio.gather(*[Station.by_code_async("S00001")] * 10)
+
+    stations: list[Station] = asyncio.run(lookup())
+    assert all(station is stations[0] for station in stations)
+    assert Station._cache["S00001"] is stations[0]
+    assert fake_api.requests["regione"] == 1
+    assert fake_api.requests["dettaglioStazione"] == 1
+
+
+def test_fetch_async(fake_api):
+    fake_api.add_train(100, ["S00001", "S00002", "S00003"])
+    train: Train = asyncio.run(Station.by_code("S00001").departures_async())[0]
+    asyncio.run(train.fetch_async())
+
+    assert train.arrived()
+    assert train.destination is not None and train.destination.code == "S00003"
+    assert [stop.station.code for stop in train.stops] == ["S00001", "S00002", "S00003"]
+
+
+def test_fetch_unchanged(fake_api):
+    fake_api.add_train(100, ["S00001", "S00002"], arrived=False)
+    train: Train = Station.by_code("S00001").departures()[0]
+    assert asyncio.run(train.fetch_async())
+    stops = train.stops
+
+    # The same response is not decoded again
+    assert not asyncio.run(train.fetch_async())
+    assert train.stops is stops
+
+    fake_api.set_arrived("S00001", 100)
+    assert asyncio.run(train.fetch_async())
+    assert train.stops is not stops and train.arrived()
+
+
+def test_fetch_failed_update(fake_api, monkeypatch):
+    fake_api.add_train(100, ["S00001", "S00002"], arrived=False)
+    train: Train = Station.by_code("S00001").departures()[0]
+    assert asyncio.run(train.fetch_async())
+
+    # The arrival is not decoded: the station lookups are throttled
+    fake_api.set_arrived("S00001", 100)
+    by_code = Station.by_code
+
+    def _throttled(code: str) -> Station:
+        raise ThrottledException("regione", "", 503)
+
+    monkeypatch.setattr(Station, "by_code", _throttled)
+    with pytest.raises(ThrottledException):
+        asyncio.run(train.fetch_async())
+
+    # The same response is decoded in the next fetch
+    monkeypatch.setattr(Station, "by_code", by_code)
+    assert asyncio.run(train.fetch_async())
+    assert train.arrived()
+
+
+def test_fetch_failed_prefetch(fake_api, monkeypatch):
+    fake_api.add_train(100, ["S00001", "S00002"])
+    train: Train = Station.by_code("S00001").departures()[0]
+
+    # The prefetch of S00002 fails: it's looked up again off the event loop
+    async def _throttled(code: str) -> Station:
+        raise ThrottledException("regione", code, 503)
+
+    by_code = Station.by_code
+    on_loop: list[bool] = list()
+
+    def _by_code(code: str) -> Station:
+        on_loop.append(st._in_event_loop())
+        return by_code(code)
+
+    monkeypatch.setattr(Station, "_fetch_async", _throttled)
+    monkeypatch.setattr(Station, "by_code", _by_code)
+    assert asyncio.run(train.fetch_async())
+
+    assert train.arrived() and train.destination.code == "S00002"
+    assert on_loop and not any(on_loop)
+
+
+def test_board_keys(fake_api):
+    fake_api.add_train(1, ["S00001", "S00002"])
+    fake_api.add_train(2, ["S00003", "S00002"], boards=["S00001"])
+    board: list[dict] = fake_api.boards["S00001"]
+    midnight: int = board[0]["dataPartenzaTreno"]
+
+    keys = ViaggiaTrenoAPI._board_keys(json.dumps(board))
+    assert keys == [(1, "S00001", midnight), (2, "S00003", midnight)]
+    train: Train = Train._from_station_departures_arrivals(board[1])
+    assert Train._board_hash(keys[1]) == hash(train)
+
+    # Unexpected values
+    board[1]["dataPartenzaTreno"] = None
+    assert ViaggiaTrenoAPI._board_keys(json.dumps(board)) is None
+
+
+def test_loop(fake_api):
+    # The same train is shown on multiple boards
+    fake_api.add_train(1, ["S00001", "S00002"], boards=["S00001", "S00002"])
+    fake_api.add_train(2, ["S00002", "S00003"], arrived=False)
+    fake_api.add_train(3, ["S00003", "S00001"])
+    stations: list[Station] = _stations("S00001", "S00002", "S00003")
+
+    fetched: dict[int, Train] = dict()
+    unfetched: dict[int, Train] = dict()
+    loop = ScrapeLoop(fetched, unfetched, concurrency=4)
+    status: dict = loop.status()
+    loop.run(stations)
+
+    # The published status is a snapshot: it is replaced, never changed
+    assert status["completed"] == 0 and loop.status() is not status
+    assert loop.status()["queued"] == dict()
+    assert loop.status()["completed"] == loop._progress.n > 0
+
+    # The departures of the fetched trains are counted
+    assert loop.traffic == station_traffic(fetched.values())
+
+    assert sorted(t.number for t in fetched.values()) == [1, 3]
+    assert [t.number for t in unfetched.values()] == [2]
+    assert fake_api.requests["andamentoTreno"] == 3
+    assert fake_api.requests["partenze"] == 3
+
+    # In the next run, the unfetched train arrives
+    fake_api.set_arrived("S00002", 2)
+    due: datetime = next(iter(unfetched.values()))._next_fetch
+    ScrapeLoop(fetched, unfetched, concurrency=4, now=lambda: due).run(stations)
+
+    assert sorted(t.number for t in fetched.values()) == [1, 2, 3]
+    assert len(unfetched) == 0
+    assert fake_api.requests["andamentoTreno"] == 4
+
+
+def test_loop_throttled(fake_api, monkeypatch):
+    fake_api.add_train(1, ["S00001", "S00002"])
+    stations: list[Station] = _stations("S00001")
+    respond = fake_api.respond
+
+    def _throttled(method: str, *parameters) -> str:
+        if method == "andamentoTreno":
+            raise ThrottledException(method, method, 503)
+        return respond(method, *parameters)
+
+    # Trains which can't be fetched are not phantom: they are fetched in the next run
+    monkeypatch.setattr(fake_api, "respond", _throttled)
+    fetched: dict[int, Train] = dict()
+    unfetched: dict[int, Train] = dict()
+    ScrapeLoop(fetched, unfetched).run(stations)
+
+    assert len(fetched) == 0
+    assert [(t.number, t._phantom) for t in unfetched.values()] == [(1, False)]
+
+    monkeypatch.setattr(fake_api, "respond", respond)
+    ScrapeLoop(fetched, unfetched).run(stations)
+    assert [(t.number, t._phantom) for t in fetched.values()] == [(1, False)]
+    assert len(unfetched) == 0
+
+
+def test_loop_concurrency(fake_api):
+    for number in range(20):
+        fake_api.add_train(number, [f"S{number:05d}", "S99999"])
+    stations: list[Station] = _stations(*[f"S{n:05d}" for n in range(20)])
+    fake_api.latency = 0.02
+
+    fetched: dict[int, Train] = dict()
+    ScrapeLoop(fetched, dict(), concurrency=4).run(stations)
+
+    assert len(fetched) == 20
+    assert 1 < fake_api.max_in_flight <= 4
+
+
+def test_loop_arrival_boards(fake_api):
+    fake_api.add_train(1, ["S00001", "S00009"], arrived=False)
+    fake_api.add_train(2, ["S00002", "S00009"], arrived=False)
+    fake_api.add_train(3, ["S00003", "S00008"], arrived=False)
+    stations: list[Station] = _stations("S00001", "S00002", "S00003")
+    eta: datetime = fake_api.trains[("S00001", 1)]["fermate"][-1]["arrivo_teorico"]
+    eta = datetime.fromtimestamp(eta / 1000, tz=TIMEZONE)
+
+    fetched: dict[int, Train] = dict()
+    unfetched: dict[int, Train] = dict()
+    ScrapeLoop(fetched, unfetched, now=lambda: eta - timedelta(hours=1)).run(stations)
+    assert len(unfetched) == 3
+    assert fake_api.requests["andamentoTreno"] == 3
+
+    # 1 arrived, 2 is late: one board request for both. 3 is not on its board
+    fake_api.set_arrived("S00001", 1)
+    fake_api.trains[("S00002", 2)]["ritardo"] = 30
+    fake_api.hidden_arrivals.add(3)
+    loop = ScrapeLoop(
+        fetched, unfetched, arrival_boards=True, now=lambda: eta + timedelta(minutes=5)
+    )
+    loop.run([])
+
+    assert fake_api.requests["arrivi"] == 2
+    assert fake_api.requests["andamentoTreno"] == 5
+    assert loop.board_stats == {"boards": 2, "running": 1, "fetched": 2}
+    assert [t.number for t in fetched.values()] == [1]
+
+    late: Train = next(t for t in unfetched.values() if t.number == 2)
+    assert late._next_fetch == eta + timedelta(minutes=30)
+
+
+def test_loop_board_slices(fake_api):
+    for hour in (6, 7, 8):
+        fake_api.add_train(hour, ["S00001", "S00002"], hour=hour)
+    fake_api.board_window = timedelta(hours=1)
+
+    midnight: datetime = datetime.combine(
+        fake_api.day, datetime.min.time(), tzinfo=TIMEZONE
+    )
+    since: datetime = midnight + timedelta(hours=6)
+    now: datetime = midnight + timedelta(hours=8, minutes=30)
+    slices: list[datetime | None] = board_slices(since, now, fake_api.board_window)
+    assert slices[:-1] == [since + timedelta(hours=h) for h in range(3)]
+
+    fetched: dict[int, Train] = dict()
+    ScrapeLoop(fetched, dict(), board_slices=slices, now=lambda: now).run(
+        _stations("S00001")
+    )
+    assert sorted(t.number for t in fetched.values()) == [6, 7, 8]
+    assert fake_api.requests["partenze"] == 4
+
+
+def test_loop_trenord(fake_api):
+    # Two trains with the same number, one Trenord request
+    fake_api.add_train(1, ["S00001", "S00009"], arrived=False, client_code=63)
+    fake_api.add_train(1, ["S00002", "S00009"], arrived=False, client_code=63)
+    fake_api.add_trenord(
+        1,
+        ["S00001", "S00005", "S00009"],
+        crowding=10.0,
+        day=fake_api.day - timedelta(days=1),
+    )
+    fake_api.add_trenord(1, ["S00001", "S00005", "S00009"], arrived=False)
+    stations: list[Station] = _stations("S00001", "S00002")
+
+    fetched: dict[int, Train] = dict()
+    unfetched: dict[int, Train] = dict()
+    loop = ScrapeLoop(fetched, unfetched)
+    loop.run(stations)
+
+    assert fake_api.requests["train"] == 1
+    assert loop.trenord_stats == {"requests": 1, "enriched": 2}
+    assert all(t.crowding == 50.0 and len(t.stops) == 3 for t in unfetched.values())
+
+    # No progress: the previous Trenord data is kept, with no requests
+    fake_api.trains[("S00002", 1)]["ritardo"] = 5
+    due: datetime = max(t._next_fetch for t in unfetched.values())
+    loop = ScrapeLoop(fetched, unfetched, now=lambda: due)
+    loop.run([])
+    assert fake_api.requests["andamentoTreno"] == 4
+    assert fake_api.requests["train"] == 1
+    assert loop.trenord_stats == {"restored": 1}
+    assert loop.unparsed == {"trains": 1}
+    assert all(len(t.stops) == 3 for t in unfetched.values())
+
+    # Arrival
+    fake_api.set_arrived("S00001", 1)
+    fake_api.trenord.clear()
+    fake_api.add_trenord(1, ["S00001", "S00005", "S00009"])
+    due = max(t._next_fetch for t in unfetched.values())
+    loop = ScrapeLoop(fetched, unfetched, now=lambda: due)
+    loop.run([])
+    assert fake_api.requests["train"] == 2
+    assert loop.trenord_stats == {"requests": 1, "enriched": 1}
+    train: Train = next(iter(fetched.values()))
+    assert train.origin.code == "S00001" and train.crowding == 50.0
+    assert train._trenord_journey is None
+
+
+def test_loop_trenord_spilled(fake_api, monkeypatch, tmp_path):
+    # The arrived train is spilled before the Trenord stage
+    monkeypatch.setattr(dataset, "SPILL_CHUNK", 1)
+    fake_api.add_train(1, ["S00001", "S00009"], client_code=63)
+    fake_api.add_trenord(1, ["S00001", "S00005", "S00009"])
+
+    fetched: SpilledDataset[int, Train] = SpilledDataset(tmp_path / "trains.pickle")
+    loop = ScrapeLoop(fetched, dict())
+    loop.run(_stations("S00001"))
+    assert loop.trenord_stats == {"requests": 1, "enriched": 1}
+
+    # The saved train has the Trenord data
+    (train,) = load_dataset(tmp_path / "trains.pickle").values()
+    assert train.crowding == 50.0 and len(train.stops) == 3
+    assert train._trenord_journey is None
+
+
+def test_loop_known_boards(fake_api):
+    fake_api.add_train(1, ["S00001", "S00002"])
+    stations: list[Station] = _stations("S00001")
+    now: datetime = datetime.now(tz=TIMEZONE)
+
+    # Identical boards (e.g. of time slices) are decoded once
+    fetched: dict[int, Train] = dict()
+    slices: list[datetime | None] = [now - timedelta(hours=1), None]
+    loop = ScrapeLoop(fetched, dict(), board_slices=slices)
+    loop.run(stations)
+    assert len(fetched) == 1
+    assert loop.unparsed == {"boards": 1}
+
+    # Boards showing known trains only are not decoded
+    loop = ScrapeLoop(fetched, dict())
+    loop.run(stations)
+    assert loop.unparsed == {"boards": 1}
+    assert fake_api.requests["partenze"] == 3
+    assert fake_api.requests["andamentoTreno"] == 1
@@ -0,0 +1,100 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+
+import src.scraper.metrics as metrics
+from src.scraper.loop import ScrapeLoop
+from src.scraper.station import Station
+from src.scraper.train import Train
+
+
+def test_registry(tmp_path):
+    registry = metrics.Registry()
+    registry.inc("requests_total", api="ViaggiaTrenoAPI", method="partenze", status=200)
+    registry.inc("requests_total", api="ViaggiaTrenoAPI", method="partenze", status=200)
+    registry.set("trains", 3, state="fetched")
+    for value in (0.02, 0.2, 60):
+        registry.observe("request_seconds", value, api="TrenordAPI", method="train")
+
+    other = metrics.Registry()
+    other.inc("requests_total", api="ViaggiaTrenoAPI", method="partenze", status=200)
+    other.set("trains", 5, state="fetched")
+    other.observe("request_seconds", 0.02, api="TrenordAPI", method="train")
+    registry.merge(other.snapshot())
+
+    labels = dict(api="ViaggiaTrenoAPI", method="partenze", status=200)
+    assert registry.value("requests_total", **labels) == 3
+    assert registry.value("trains", state="fetched") == 5
+    histogram = registry.histogram("request_seconds", api="TrenordAPI", method="train")
+    assert histogram.count == 4
+    assert histogram.quantile(0.5) == 0.025
+    assert histogram.quantile(1) == float("inf")
+
+    text: str = registry.to_prometheus()
+    assert "# TYPE railway_scraper_requests_total counter" in text
+    assert (
+        'railway_scraper_requests_total{api="ViaggiaTrenoAPI",method="partenze",status="200"} 3'
+        in text
+    )
+    assert (
+        'railway_scraper_request_seconds_bucket{api="TrenordAPI",method="train",le="0.025"} 2'
+        in text
+    )
+    assert (
+        'railway_scraper_request_seconds_count{api="TrenordAPI",method="train"} 4'
+        in text
+    )
+
+    metrics.write_summary(tmp_path / "run.json", {"duration": 1.0}, registry)
+    with open(tmp_path / "run.json") as f:
+        summary: dict = json.load(f)
+    assert summary["duration"] == 1.0
+    assert summary["metrics"]["trains"] == {"state=fetched": 5}
+    assert (
+        summary["metrics"]["request_seconds"]["api=TrenordAPI,method=train"]["count"]
+        == 4
+    )
+
+
+def test_loop_metrics(fake_api):
+    fake_api.add_train(1, ["S00001", "S00002"])
+    fake_api.add_train(2, ["S00001", "S00003"], arrived=False)
+    registry: metrics.Registry = metrics.REGISTRY
+    before: dict = registry.snapshot()
+
+    fetched: dict[int, Train] = dict()
+    unfetched: dict[int, Train] = dict()
+    ScrapeLoop(fetched, unfetched).run([Station.by_code("S00001")])
+
+    def _delta(name: str, **labels) -> float:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        return registry.value(name, **labels) - before["values"].get(name, {}).get(
+            key, 0
+        )
+
+    assert _delta("jobs_total", phase="stations", outcome="done") == 1
+    assert _delta("jobs_total", phase="new_trains", outcome="done") == 2
+    assert _delta("trains_total", outcome="fetched") == 1
+    assert _delta("trains_total", outcome="unfetched") == 1
+    assert _delta("station_cache_total", result="hit") > 0
+    assert _delta("station_cache_total", result="miss") > 0
+
+    # JSON decoding is timed by endpoint
+    decoded: set = set(registry.snapshot()["histograms"]["decode_seconds"])
+    for method in ("partenze", "andamentoTreno", "dettaglioStazione"):
+        assert (("api", "ViaggiaTrenoAPI"), ("method", method)) in decoded
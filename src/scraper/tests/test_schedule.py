@@ -0,0 +1,250 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import itertools
+from collections import Counter
+from datetime import datetime, timedelta
+
+from src.const import TIMEZONE
+from src.scraper.loop import ScrapeLoop
+from src.scraper.schedule import (
+    BOARD_WINDOW,
+    MAX_LOOKBACK,
+    MAX_POLL_INTERVAL,
+    POLL_TOLERANCE,
+    TIER_ARRIVED,
+    TIER_RUNNING,
+    StationStats,
+    board_slices,
+    deadline,
+    expected_arrival,
+    merge_station_stats,
+    refetch_due,
+    refetch_expired,
+    schedule_refetch,
+    station_priority,
+    station_traffic,
+    train_priority,
+)
+from src.scraper.station import Station
+from src.scraper.train import Train
+
+
+def _fetched_train(fake_api, number: int, origin: str) -> Train:
+    fake_api.add_train(number, [origin, "S00009"], arrived=False)
+    train: Train = Station.by_code(origin).departures()[0]
+    train.fetch()
+    return train
+
+
+def test_deadline():
+    assert deadline(0, 600) == 540
+    assert deadline(100, 7200) == 100 + 7200 - 120
+
+
+def test_priorities(fake_api):
+    train: Train = _fetched_train(fake_api, 1, "S00001")
+    train.delay = 10
+    eta = expected_arrival(train)
+    assert eta == train.stops[-1].arrival.expected + timedelta(minutes=10)
+
+    assert train_priority(train, eta + timedelta(minutes=1))[0] == TIER_ARRIVED
+    assert train_priority(train, eta - timedelta(minutes=1))[0] == TIER_RUNNING
+    assert train_priority(train, eta + timedelta(hours=1)) < train_priority(
+        train, eta + timedelta(minutes=1)
+    )
+
+    traffic = station_traffic([train])
+    assert traffic == {"S00001": 1}
+    assert station_priority(Station.by_code("S00001"), traffic) < station_priority(
+        Station.by_code("S00002"), traffic
+    )
+
+
+def test_loop_deadline(fake_api):
+    for i in range(1, 4):
+        fake_api.add_train(i, [f"S0000{i}", "S00009"])
+    stations: list[Station] = [Station.by_code(f"S0000{i}") for i in range(1, 4)]
+
+    # Each job start is one tick: the busiest board and its train fit the deadline
+    fetched: dict[int, Train] = dict()
+    unfetched: dict[int, Train] = dict()
+    loop = ScrapeLoop(
+        fetched,
+        unfetched,
+        concurrency=1,
+        traffic=Counter({"S00003": 10}),
+        deadline=2,
+        clock=itertools.count().__next__,
+    )
+    loop.run(stations)
+
+    assert [t.number for t in fetched.values()] == [3]
+    assert len(unfetched) == 0
+    assert loop.skipped == {"stations": 2}
+
+
+def test_loop_deadline_new_trains(fake_api):
+    fake_api.add_train(1, ["S00001", "S00009"])
+    fake_api.add_train(2, ["S00001", "S00009"])
+
+    # Trains seen in a board are saved as unfetched, to be fetched in the next run
+    fetched: dict[int, Train] = dict()
+    unfetched: dict[int, Train] = dict()
+    loop = ScrapeLoop(
+        fetched, unfetched, concurrency=1, deadline=1, clock=itertools.count().__next__
+    )
+    loop.run([Station.by_code("S00001")])
+
+    assert len(fetched) == 0
+    assert sorted(t.number for t in unfetched.values()) == [1, 2]
+    assert loop.skipped == {"new trains": 2}
+    assert fake_api.requests["andamentoTreno"] == 0
+
+    ScrapeLoop(fetched, unfetched, concurrency=1).run([])
+    assert sorted(t.number for t in fetched.values()) == [1, 2]
+
+
+def test_schedule_refetch(fake_api):
+    train: Train = _fetched_train(fake_api, 1, "S00001")
+    eta: datetime = expected_arrival(train)
+
+    # A running train is fetched again when it is expected to arrive
+    schedule_refetch(train, eta - timedelta(hours=1))
+    assert train._next_fetch == eta
+    assert not refetch_due(train, eta - timedelta(minutes=1))
+    assert refetch_due(train, eta)
+
+    # Then with exponential backoff
+    now: datetime = eta
+    backoffs: list[timedelta] = list()
+    for _ in range(6):
+        schedule_refetch(train, now)
+        backoffs.append(train._next_fetch - now)
+        now = train._next_fetch
+    assert [b.total_seconds() // 60 for b in backoffs] == [15, 30, 60, 120, 240, 240]
+
+    assert not refetch_expired(train, eta + timedelta(hours=1))
+    assert refetch_expired(train, eta + timedelta(hours=13))
+
+
+def test_loop_deferred(fake_api):
+    fake_api.add_train(1, ["S00001", "S00009"], arrived=False)
+    board: dict = fake_api.boards["S00001"][0]
+    board["nonPartito"] = True
+    departure: datetime = Train._from_station_departures_arrivals(board)._next_fetch
+    assert departure is not None
+
+    # Not departed trains are not fetched until their departure
+    fetched: dict[int, Train] = dict()
+    unfetched: dict[int, Train] = dict()
+    loop = ScrapeLoop(fetched, unfetched, now=lambda: departure - timedelta(minutes=10))
+    loop.run([Station.by_code("S00001")])
+    assert [t.number for t in unfetched.values()] == [1]
+    assert loop.deferred == 1
+    assert fake_api.requests["andamentoTreno"] == 0
+
+    ScrapeLoop(fetched, unfetched, now=lambda: departure).run([])
+    assert fake_api.requests["andamentoTreno"] == 1
+
+    # Running trains are not fetched until their expected arrival
+    train: Train = next(iter(unfetched.values()))
+    eta: datetime = expected_arrival(train)
+    assert train._next_fetch == eta
+    ScrapeLoop(fetched, unfetched, now=lambda: eta - timedelta(minutes=1)).run([])
+    assert fake_api.requests["andamentoTreno"] == 1
+
+    fake_api.set_arrived("S00001", 1)
+    ScrapeLoop(fetched, unfetched, now=lambda: eta).run([])
+    assert fake_api.requests["andamentoTreno"] == 2
+    assert [t.number for t in fetched.values()] == [1]
+
+
+def test_station_stats():
+    now: datetime = datetime(2023, 5, 1, 12, tzinfo=TIMEZONE)
+
+    hub = StationStats()
+    hub.record(now, 40, None)
+    hub.record(now + timedelta(hours=1), 30, None)
+    assert hub.rate == 0.3 * 30 + 0.7 * 40
+    assert hub.due(now + timedelta(hours=2))
+
+    # Quiet stations are polled when a departure is due, or at least every hour
+    halt = StationStats()
+    halt.record(now, 0, None)
+    assert halt.next_poll == now + MAX_POLL_INTERVAL - POLL_TOLERANCE
+    now += MAX_POLL_INTERVAL
+    halt.record(now, 1, now + timedelta(hours=1, minutes=30))
+    assert halt.next_poll == now + timedelta(minutes=30)
+    assert not halt.due(now + timedelta(minutes=20))
+
+    # No train is missed, however quiet the station and late its last departure
+    for new_trains in (0, 1, 10):
+        quiet = StationStats()
+        quiet.record(now, new_trains, now + timedelta(hours=5))
+        assert quiet.next_poll is not None
+        assert quiet.next_poll - now <= BOARD_WINDOW
+
+    # Hourly runs: a quiet board retrieved late in a run is due in the next one
+    run: datetime = datetime(2023, 5, 1, 12, tzinfo=TIMEZONE)
+    quiet = StationStats()
+    quiet.record(run + POLL_TOLERANCE, 0, None)
+    assert quiet.due(run + timedelta(hours=1))
+    quiet.record(run + timedelta(hours=1, minutes=1), 0, None)
+    assert not quiet.due(run + timedelta(hours=1, minutes=30))
+    assert quiet.due(run + timedelta(hours=2))
+
+    # The most recent statistics win
+    stats: dict[str, StationStats] = {"S00001": halt}
+    merge_station_stats(stats, {"S00001": hub, "S00002": hub})
+    assert stats == {"S00001": halt, "S00002": hub}
+
+
+def test_loop_adaptive_polling(fake_api):
+    fake_api.add_train(1, ["S00001", "S00009"])
+    fake_api.add_train(2, ["S00001", "S00009"])
+    now: datetime = datetime.now(tz=TIMEZONE)
+
+    stats: dict[str, StationStats] = dict()
+    fetched: dict[int, Train] = dict()
+    ScrapeLoop(fetched, dict(), station_stats=stats, now=lambda: now).run(
+        [Station.by_code("S00001"), Station.by_code("S00002")]
+    )
+    assert stats["S00001"].rate == 2 and stats["S00002"].rate == 0
+    assert fake_api.requests["partenze"] == 2
+
+    # The empty board is not retrieved again until the maximum poll interval
+    later: datetime = now + timedelta(minutes=40)
+    loop = ScrapeLoop(fetched, dict(), station_stats=stats, now=lambda: later)
+    loop.run([Station.by_code("S00001"), Station.by_code("S00002")])
+    assert loop.idle_stations == 1
+    assert fake_api.requests["partenze"] == 3
+
+
+def test_board_slices():
+    now: datetime = datetime(2023, 5, 1, 12, tzinfo=TIMEZONE)
+    window: timedelta = timedelta(hours=1)
+
+    assert board_slices(None, now, window) == [None]
+    assert board_slices(now - timedelta(minutes=10), now, window) == [
+        now - timedelta(minutes=10),
+        None,
+    ]
+    assert len(board_slices(now - timedelta(hours=3), now, window)) == 4
+    assert len(board_slices(now - timedelta(days=3), now, window)) == (
+        MAX_LOOKBACK // window + 1
+    )
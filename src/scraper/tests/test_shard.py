@@ -0,0 +1,104 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import Counter
+from datetime import datetime, timedelta
+
+from src.scraper.schedule import station_traffic
+from src.scraper.shard import ShardResult, merge_results, partition_regions, run_sharded
+from src.scraper.station import REGION_CODES, Station
+from src.scraper.train import Train
+
+
+def test_partition_regions():
+    weights: dict[int, int] = {1: 400, 5: 200, 8: 200}
+    groups: list[list[int]] = partition_regions(3, weights)
+
+    assert sorted(r for group in groups for r in group) == list(REGION_CODES)
+    assert [1] in groups
+    assert all(len(group) > 0 for group in groups)
+
+
+def test_merge_results(fake_api):
+    origin: Station = Station.by_code("S00001")
+    now: datetime = datetime.now()
+
+    def _train(number: int, fetched: datetime) -> Train:
+        train = Train(number, origin, now.date())
+        train._fetched = fetched
+        return train
+
+    old, new = _train(1, now - timedelta(hours=1)), _train(1, now)
+    running, arrived = _train(2, now), _train(2, now)
+    fetched: dict[int, Train] = dict()
+    unfetched: dict[int, Train] = {hash(running): running}
+
+    merge_results(
+        [
+            ShardResult({hash(old): old}, {hash(running): running}, dict()),
+            ShardResult({hash(new): new, hash(arrived): arrived}, dict(), dict()),
+        ],
+        fetched,
+        unfetched,
+    )
+    assert fetched == {hash(new): new, hash(arrived): arrived}
+    assert fetched[hash(new)] is new
+    assert len(unfetched) == 0
+
+
+def test_run_sharded(fake_api):
+    codes: list[str] = [f"S0000{i}" for i in range(1, 7)]
+    for i, code in enumerate(codes):
+        fake_api.regions[code] = i % 3 + 1
+    # Train 1 is seen in stations of different shards
+    fake_api.add_train(1, [codes[0], codes[1]], boards=[codes[0], codes[1]])
+    fake_api.add_train(2, [codes[2], codes[3]], arrived=False)
+    fake_api.add_train(3, [codes[4], codes[5]])
+    stations: list[Station] = [Station.by_code(code) for code in codes]
+
+    fetched: dict[int, Train] = dict()
+    unfetched: dict[int, Train] = dict()
+    traffic: Counter[str] = Counter()
+    run_sharded(3, stations, fetched, unfetched, concurrency=2, traffic=traffic)
+
+    assert sorted(t.number for t in fetched.values()) == [1, 3]
+    assert [t.number for t in unfetched.values()] == [2]
+    assert traffic == station_traffic(fetched.values())
+
+    # The unfetched train is handled by the shard of its origin
+    fake_api.set_arrived(codes[2], 2)
+    for train in unfetched.values():
+        train._next_fetch = None
+    run_sharded(3, stations, fetched, unfetched, concurrency=2)
+    assert sorted(t.number for t in fetched.values()) == [1, 2, 3]
+    assert len(unfetched) == 0
+
+
+def test_run_sharded_known(fake_api):
+    fake_api.regions["S00001"] = 1
+    fake_api.regions["S00002"] = 2
+    fake_api.add_train(1, ["S00001", "S00009"], boards=["S00002"], arrived=False)
+    stations: list[Station] = [Station.by_code("S00001"), Station.by_code("S00002")]
+
+    fetched: dict[int, Train] = dict()
+    unfetched: dict[int, Train] = dict()
+    run_sharded(2, stations, fetched, unfetched, concurrency=2)
+    (train,) = unfetched.values()
+
+    # The unfetched train is not fetched again by the shard showing it
+    run_sharded(2, stations, fetched, unfetched, concurrency=2)
+    assert unfetched[hash(train)]._fetched == train._fetched
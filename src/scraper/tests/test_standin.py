@@ -0,0 +1,130 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import typing as t
+from datetime import datetime, timedelta
+
+import pytest
+
+from src.const import TIMEZONE
+from src.scraper.api import TrenordAPI, ViaggiaTrenoAPI
+from src.scraper.archive import ResponseArchive
+from src.scraper.exceptions import BadRequestException, ThrottledException
+from src.scraper.loop import ScrapeLoop
+from src.scraper.standin import Faults, NetworkDay, RecordedDay, StandInServer
+from src.scraper.station import Station
+from src.scraper.throttle import RateLimiter
+from src.scraper.train import Train
+
+
+@pytest.fixture
+def serve(monkeypatch: pytest.MonkeyPatch) -> t.Iterator[t.Callable]:
+    """Start stand-in servers and point the APIs at them."""
+    servers: list[StandInServer] = list()
+    monkeypatch.setattr(Station, "_cache", dict())
+    monkeypatch.setattr(Station, "_pending", dict())
+    monkeypatch.setattr(Station, "_regions", dict())
+    monkeypatch.setattr(Station, "_stubs", dict())
+    for api in (ViaggiaTrenoAPI, TrenordAPI):
+        monkeypatch.setattr(api, "_breakers", dict())
+        monkeypatch.setattr(
+            api, "_limiter", RateLimiter(rate=200, min_rate=100, max_rate=200)
+        )
+
+    def _serve(network, faults: Faults = Faults()) -> StandInServer:
+        server = StandInServer(network, faults, seed=0)
+        server.start()
+        servers.append(server)
+        monkeypatch.setattr(ViaggiaTrenoAPI, "BASE_URL", server.viaggiatreno_url)
+        monkeypatch.setattr(TrenordAPI, "BASE_URL", server.trenord_url)
+        return server
+
+    yield _serve
+    for server in servers:
+        server.stop()
+
+
+def test_scrape(serve):
+    network = NetworkDay()
+    network.add_train(1, ["S00001", "S00002", "S00003"])
+    network.add_train(2, ["S00001", "S00004"], arrived=False, delay=5)
+    network.add_train(3, ["S00001", "S00005"], client_code=63)
+    network.add_trenord(3, ["S00001", "S00005"], crowding=80.0)
+    server = serve(network)
+
+    fetched: dict[int, Train] = dict()
+    unfetched: dict[int, Train] = dict()
+    ScrapeLoop(fetched, unfetched).run([Station.by_code("S00001")])
+
+    assert sorted(train.number for train in fetched.values()) == [1, 3]
+    assert [train.number for train in unfetched.values()] == [2]
+    assert next(iter(unfetched.values())).delay == 5
+    trenord_train = next(train for train in fetched.values() if train.number == 3)
+    assert trenord_train.crowding == 80.0
+    assert server.requests[("partenze", 200)] == 1
+    assert server.requests[("train", 200)] == 1
+
+
+def test_synthetic():
+    network = NetworkDay.synthetic(200, seed=1)
+    assert len(network.trains) >= 200
+    assert network.trenord
+    assert NetworkDay.synthetic(200, seed=1).trains.keys() == network.trains.keys()
+    for (origin, _), details in network.trains.items():
+        assert details["fermate"][0]["id"] == origin
+        assert all(stop["id"] in network.regions for stop in details["fermate"])
+
+
+def test_throttling(serve):
+    network = NetworkDay()
+    network.add_station("S00001", 3)
+    server = serve(network, Faults(max_rate=20, retry_after=True))
+
+    for _ in range(40):
+        assert ViaggiaTrenoAPI._raw_request("regione", "S00001") == "3"
+    assert server.requests[("regione", 403)] > 0
+    assert server.requests[("regione", 200)] == 40
+
+
+def test_errors(serve):
+    server = serve(NetworkDay(), Faults(burst_every=60, burst_length=60))
+
+    with pytest.raises(ThrottledException) as e:
+        ViaggiaTrenoAPI._raw_request("regione", "S00001")
+    assert e.value.status_code == 403
+    assert server.requests[("regione", 403)] == 5
+
+    server.faults = Faults()
+    with pytest.raises(BadRequestException) as e:
+        ViaggiaTrenoAPI._raw_request("andamentoTreno", "S00001", 1, 0)
+    assert e.value.status_code == 204
+
+
+def test_recorded(serve, tmp_path):
+    archive = ResponseArchive(tmp_path / "raw")
+    archive.add("ViaggiaTrenoAPI", "partenze", ["S00001", "Mon May 01 2023"], "[]")
+    archive.add("ViaggiaTrenoAPI", "regione", ["S00001"], "5")
+    archive.add("TrenordAPI", "train", [1], '[{"journey_list": []}]')
+    serve(RecordedDay(archive))
+
+    when: datetime = datetime.now(tz=TIMEZONE) - timedelta(hours=1)
+    assert (
+        ViaggiaTrenoAPI._station_departures_or_arrivals("partenze", "S00001", when)
+        == []
+    )
+    assert ViaggiaTrenoAPI._raw_request("regione", "S00001") == "5"
+    assert TrenordAPI._raw_request("train", 1) == '[{"journey_list": []}]'
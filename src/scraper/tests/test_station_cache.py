@@ -0,0 +1,92 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+from datetime import datetime, timedelta
+
+import src.scraper.metrics as metrics
+from src.const import TIMEZONE
+from src.scraper.station import Station
+from src.scraper.train import Train
+
+
+def test_by_region_cache(fake_api):
+    fake_api.regions.update({"S00001": 1, "S00002": 1, "S00003": 2})
+
+    stations: list[Station] = Station.by_region(1)
+    assert sorted(s.code for s in stations) == ["S00001", "S00002"]
+    assert Station.by_region(1) == stations
+    assert fake_api.requests["elencoStazioni"] == 1
+
+    # Stations are prewarmed in the cache
+    assert Station.by_code("S00002") is stations[1]
+    assert fake_api.requests["dettaglioStazione"] == 0
+
+    # Station lists expire
+    Station.by_region(1, max_age=timedelta(0))
+    assert fake_api.requests["elencoStazioni"] == 2
+
+
+def test_negative_cache(fake_api):
+    fake_api.phantoms.add("S00001")
+
+    station: Station = Station.by_code("S00001")
+    assert station._phantom
+    assert Station.by_code("S00001") is station
+    assert asyncio.run(Station.by_code_async("S00001")) is station
+    assert fake_api.requests["dettaglioStazione"] == 1
+
+    # Once expired, phantom stations are looked up again
+    fake_api.phantoms.clear()
+    station._expires = datetime.now(tz=TIMEZONE) - timedelta(seconds=1)
+    station = asyncio.run(Station.by_code_async("S00001"))
+    assert not station._phantom and station.name == "Station S00001"
+    assert Station._cache["S00001"] is station
+    assert fake_api.requests["dettaglioStazione"] == 2
+
+
+def test_merge_cache(fake_api):
+    fake_api.regions["S00001"] = 1
+    fake_api.phantoms.add("S00001")
+    phantom: Station = Station.by_code("S00001")
+
+    fake_api.phantoms.clear()
+    known: Station = Station.by_region(1)[0]
+    assert known.code == "S00001" and not known._phantom
+    assert Station._cache["S00001"] is known
+
+    Station._merge_cache({"S00001": phantom})
+    assert Station._cache["S00001"] is known
+
+
+def test_cache_metrics(fake_api):
+    def lookups() -> dict[str, float]:
+        return {
+            result: metrics.REGISTRY.value("station_cache_total", result=result)
+            for result in ("hit", "miss")
+        }
+
+    fake_api.add_train(100, ["S00001", "S00002", "S00003"])
+    before: dict[str, float] = lookups()
+    train: Train = asyncio.run(Station.by_code("S00001").departures_async())[0]
+    asyncio.run(train.fetch_async())
+
+    # Each station is counted once, when it's looked up by by_code_async:
+    # the parsers then read it from the cache without counting it again
+    after: dict[str, float] = lookups()
+    assert after["miss"] - before["miss"] == 3
+    assert after["hit"] - before["hit"] == 1
@@ -0,0 +1,277 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import pickle
+import sqlite3
+import subprocess
+import sys
+from collections import Counter
+from datetime import date
+
+import pytest
+
+import src.scraper.dataset as dataset
+from src.scraper.dataset import SpilledDataset, load_dataset
+from src.scraper.loop import ScrapeLoop
+from src.scraper.schedule import station_traffic
+from src.scraper.station import Station
+from src.scraper.store import (
+    SQLITE_FILENAME,
+    STORAGES,
+    SQLiteStore,
+    StoredTrains,
+    open_store,
+)
+from src.scraper.train import Train
+from src.scraper.train_stop import TrainStop
+
+
+def _scrape(fake_api) -> tuple[dict[int, Train], dict[int, Train]]:
+    fake_api.add_train(1, ["S00001", "S00002", "S00009"])
+    fake_api.add_train(2, ["S00001", "S00009"], arrived=False)
+    fetched: dict[int, Train] = dict()
+    unfetched: dict[int, Train] = dict()
+    ScrapeLoop(fetched, unfetched).run([Station.by_code("S00001")])
+    return fetched, unfetched
+
+
+@pytest.mark.parametrize("storage", STORAGES)
+def test_store(fake_api, tmp_path, storage):
+    day = date(2023, 5, 1)
+    (tmp_path / "2023-05-01").mkdir()
+    fetched, unfetched = _scrape(fake_api)
+
+    store = open_store(storage, tmp_path)
+    store.save_stations(Station._cache)
+    store.save_trains(day, fetched, unfetched)
+
+    # The traffic counters are counted again from the trains, until saved
+    traffic: Counter[str] = store.load_traffic(day)
+    assert traffic == station_traffic(fetched.values()) and traffic["S00001"] == 1
+    traffic["S00001"] += 1
+    store.save_traffic(day, traffic)
+    store.close()
+
+    store = open_store(storage, tmp_path)
+    assert store.load_traffic(day) == traffic
+    assert set(store.load_stations()) == set(Station._cache)
+    loaded_fetched, loaded_unfetched = store.load_trains(day)
+    assert set(loaded_fetched) == set(fetched)
+    assert set(loaded_unfetched) == set(unfetched)
+    assert store.load_trains(date(2023, 5, 2)) == (dict(), dict())
+    store.close()
+
+
+def test_sqlite_store(fake_api, tmp_path):
+    day = date(2023, 5, 1)
+    fetched, unfetched = _scrape(fake_api)
+
+    store = SQLiteStore(tmp_path / SQLITE_FILENAME)
+    store.save_trains(day, fetched, unfetched)
+
+    # Other connections can read while the scraper is writing
+    reader = sqlite3.connect(tmp_path / SQLITE_FILENAME)
+    assert reader.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    assert reader.execute(
+        "SELECT number, unfetched FROM trains ORDER BY number"
+    ).fetchall() == [(1, 0), (2, 1)]
+    assert {key for (key,) in reader.execute("SELECT key FROM trains")} == {
+        *fetched,
+        *unfetched,
+    }
+    assert reader.execute(
+        "SELECT station_code FROM stops JOIN trains ON trains.id = train_id "
+        "WHERE number = 1 ORDER BY position"
+    ).fetchall() == [("S00001",), ("S00002",), ("S00009",)]
+
+    # Only the changed trains are written
+    changes: int = store._connection.total_changes
+    store.save_trains(day, fetched, unfetched)
+    assert store._connection.total_changes == changes
+
+    # The arrived train is moved, the removed one is deleted
+    train: Train = unfetched.pop(next(iter(unfetched)))
+    train.delay = 5
+    fetched[hash(train)] = train
+    removed: Train = fetched.pop(next(t for t in fetched if fetched[t].number == 1))
+    store.save_trains(day, fetched, unfetched)
+    assert reader.execute("SELECT number, unfetched, delay FROM trains").fetchall() == [
+        (2, 0, 5)
+    ]
+    assert reader.execute("SELECT COUNT(*) FROM stops").fetchone() == (2,)
+    store.close()
+
+    # The fetched trains are indexed and read when accessed
+    store = SQLiteStore(tmp_path / SQLITE_FILENAME)
+    loaded, loaded_unfetched = store.load_trains(day)
+    assert isinstance(loaded, StoredTrains) and not loaded._buffer
+    assert set(loaded) == {hash(train)} and loaded[hash(train)].delay == 5
+    assert [train.number for train in loaded.values()] == [2]
+    assert loaded_unfetched == dict()
+
+    # Only the new fetched trains are written
+    loaded[hash(removed)] = removed
+    changes = store._connection.total_changes
+    store.save_trains(day, loaded, loaded_unfetched)
+    assert store._connection.total_changes > changes
+    assert set(loaded) == {hash(train), hash(removed)} and not loaded._buffer
+    changes = store._connection.total_changes
+    store.save_trains(day, loaded, loaded_unfetched)
+    assert store._connection.total_changes == changes
+    assert sorted(train.number for train in loaded.values()) == [1, 2]
+
+    reader.close()
+    store.close()
+
+
+def test_spilled_dataset(monkeypatch, tmp_path):
+    monkeypatch.setattr(dataset, "SPILL_CHUNK", 2)
+    path = tmp_path / "trains.pickle"
+
+    spilled: SpilledDataset[int, str] = SpilledDataset(path)
+    for i in range(5):
+        spilled[i] = str(i)
+    assert len(spilled._buffer) == 1 and len(spilled._index) == 4
+    spilled[0] = "new"
+    spilled.flush()
+
+    # Items are read back from their chunk, the last version wins
+    assert len(spilled) == 5
+    assert spilled[0] == "new" and spilled[3] == "3"
+    assert dict(spilled.items()) == {0: "new", 1: "1", 2: "2", 3: "3", 4: "4"}
+    assert load_dataset(path) == dict(spilled.items())
+
+    # Only the keys are loaded again; a truncated chunk is ignored
+    with open(path, "ab") as f:
+        f.write(pickle.dumps({5: "5"})[:-3])
+    reopened: SpilledDataset[int, str] = SpilledDataset(path)
+    assert sorted(reopened) == [0, 1, 2, 3, 4] and not reopened._buffer
+    assert reopened[0] == "new"
+    assert load_dataset(path) == dict(spilled.items())
+
+
+def test_pickle_store_spill(fake_api, tmp_path):
+    day = date(2023, 5, 1)
+    (tmp_path / "2023-05-01").mkdir()
+    fetched, unfetched = _scrape(fake_api)
+    store = open_store("pickle", tmp_path)
+
+    # Fetched trains are appended to the day file, unfetched ones saved as a whole
+    spilled, _ = store.load_trains(day)
+    for train_hash, train in fetched.items():
+        spilled[train_hash] = train
+    store.save_trains(day, spilled, unfetched)
+    assert set(load_dataset(tmp_path / "2023-05-01" / "trains.pickle")) == set(fetched)
+
+    # An interrupted run appended the unfetched train before saving it as fetched
+    train_hash, train = next(iter(unfetched.items()))
+    spilled[train_hash] = train
+    spilled.flush()
+    spilled, loaded_unfetched = store.load_trains(day)
+    assert len(spilled) == 2 and loaded_unfetched == dict()
+
+
+def test_compact_pickle(fake_api):
+    fetched, _ = _scrape(fake_api)
+    train: Train = next(iter(fetched.values()))
+
+    loaded: Train = pickle.loads(pickle.dumps(train))
+    assert hash(loaded) == hash(train)
+    assert loaded.origin is Station._cache["S00001"]
+    assert loaded.category is train.category
+    assert [repr(stop) for stop in loaded.stops] == [repr(stop) for stop in train.stops]
+    assert loaded.stops[1].arrival.expected == train.stops[1].arrival.expected
+
+    # Stations missing from the cache are placeholders with their code only
+    del Station._cache["S00002"]
+    loaded = pickle.loads(pickle.dumps(train))
+    assert loaded.stops[1].station.code == "S00002"
+    assert loaded.stops[1].station._phantom
+
+
+def test_legacy_pickle(fake_api):
+    fetched, _ = _scrape(fake_api)
+    train: Train = next(iter(fetched.values()))
+
+    # Objects pickled before __slots__ carry their __dict__ as state
+    stops: list[TrainStop] = list()
+    for stop in train.stops:
+        legacy_stop: TrainStop = TrainStop.__new__(TrainStop)
+        legacy_stop.__setstate__(
+            {
+                "station": stop.station,
+                "stop_type": stop.stop_type,
+                "platform_expected": stop.platform_expected,
+                "platform_actual": stop.platform_actual,
+                "arrival": stop.arrival,
+                "departure": stop.departure,
+            }
+        )
+        stops.append(legacy_stop)
+    legacy: Train = Train.__new__(Train)
+    legacy.__setstate__(
+        {
+            "number": train.number,
+            "origin": train.origin,
+            "departing_date": train.departing_date,
+            "destination": train.destination,
+            "category": train.category,
+            "departed": train.departed,
+            "stops": stops,
+            "last_detection_time": train.last_detection_time,
+            "_fetched": train._fetched,
+            "removed_attribute": None,
+        }
+    )
+    assert hash(legacy) == hash(train)
+    assert legacy.arrived() and legacy._fingerprint is None
+    assert legacy.last_detection_time == train.last_detection_time
+    assert repr(legacy) == repr(train)
+
+
+def test_train_key(fake_api, tmp_path):
+    # The key does not depend on the hash seed
+    code: str = (
+        "from datetime import date; from src.scraper.train import Train; "
+        "print(Train._hash(1, 'S00001', date(2023, 5, 1)))"
+    )
+    keys: set[str] = {
+        subprocess.run(
+            [sys.executable, "-c", code],
+            env={**os.environ, "PYTHONHASHSEED": seed},
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        for seed in ("1", "2")
+    }
+    assert keys == {f"{Train._hash(1, 'S00001', date(2023, 5, 1))}\n"}
+
+    # Datasets saved with the old keys are indexed again
+    fetched, _ = _scrape(fake_api)
+    path = tmp_path / "trains.pickle"
+    with open(path, "wb") as f:
+        pickle.dump({i: train for i, train in enumerate(fetched.values())}, f)
+    spilled: SpilledDataset[int, Train] = SpilledDataset(path, key=hash)
+    assert set(spilled) == set(fetched)
+    assert set(load_dataset(path)) == set(fetched)
+
+    # The keys are checked once
+    checked: list[Train] = list()
+    SpilledDataset(path, key=lambda train: checked.append(train) or hash(train))
+    assert checked == [] and set(load_dataset(path)) == set(fetched)
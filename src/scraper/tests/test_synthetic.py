@@ -0,0 +1,77 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from datetime import date
+
+import pandas as pd
+
+from src import synthetic, train_extractor
+from src.analysis.load_data import read_train_csv
+from src.scraper.dataset import load_dataset
+from src.scraper.station import Station
+
+
+def test_scrape_day():
+    cache = Station._cache
+    quirks = synthetic.Quirks(cancelled=0.05, partially_cancelled=0.1, phantom=0.05)
+    network = synthetic.network_day(date(2023, 5, 1), 300, seed=1, quirks=quirks)
+    with synthetic.station_cache(network):
+        trains = synthetic.scrape_day(network)
+    assert Station._cache is cache
+
+    assert len(trains) == sum(len(board) for board in network.boards.values())
+    assert any(train._phantom for train in trains.values())
+    assert any(train.cancelled and not train._phantom for train in trains.values())
+    assert {train.client_code for train in trains.values()} > {2, 63}
+    assert any(train.crowding for train in trains.values())
+
+    # Same lines every day, with different delays
+    other = synthetic.network_day(date(2023, 5, 2), 300, seed=1, quirks=quirks)
+    assert {
+        (entry["codOrigine"], entry["numeroTreno"], entry["codiceCliente"])
+        for board in other.boards.values()
+        for entry in board
+    } == {
+        (entry["codOrigine"], entry["numeroTreno"], entry["codiceCliente"])
+        for board in network.boards.values()
+        for entry in board
+    }
+    assert [d["ritardo"] for d in other.trains.values()] != [
+        d["ritardo"] for d in network.trains.values()
+    ]
+
+
+def test_generate(tmp_path):
+    paths = synthetic.generate(tmp_path, date(2023, 5, 1), 2, 100, csv=True)
+    assert [path.parent.name for path in paths] == ["2023-05-01", "2023-05-02"]
+    assert load_dataset(tmp_path / "stations.pickle")
+    assert all(len(load_dataset(path)) >= 100 for path in paths)
+
+    df: pd.DataFrame = read_train_csv(paths[1].with_suffix(".csv"))
+    assert (df.day == pd.Timestamp(2023, 5, 2)).all()
+    assert df.arrival_delay.notna().any()
+
+
+def test_to_csv_chunks(tmp_path, monkeypatch):
+    (path,) = synthetic.generate(tmp_path, date(2023, 5, 1), 1, 50)
+    data = train_extractor.load_file(path)
+    train_extractor.to_csv(data, tmp_path / "whole.csv")
+
+    # Rows are written in chunks, with the same content
+    monkeypatch.setattr(train_extractor, "CSV_CHUNK", 7)
+    train_extractor.to_csv(data, tmp_path / "chunks.csv")
+    assert (tmp_path / "chunks.csv").read_text() == (tmp_path / "whole.csv").read_text()
@@ -0,0 +1,198 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import pytest
+import requests
+
+import src.scraper.metrics as metrics
+from src.scraper import BadRequestException, ViaggiaTrenoAPI
+from src.scraper.api import TrenordAPI
+from src.scraper.exceptions import CircuitOpenException, ThrottledException
+from src.scraper.throttle import BreakerState, CircuitBreaker, RateLimiter
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now: float = 0.0
+        self.slept: list[float] = list()
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class FakeSession:
+    def __init__(self, statuses: list[int], headers: dict | None = None) -> None:
+        self.statuses: list[int] = statuses
+        self.headers: dict = headers or dict()
+        self.calls: int = 0
+
+    def get(self, url: str) -> requests.Response:
+        response = requests.Response()
+        response.status_code = self.statuses[min(self.calls, len(self.statuses) - 1)]
+        response.headers.update(self.headers)
+        response._content = b"1"
+        response.url = url
+        self.calls += 1
+        return response
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    return FakeClock()
+
+
+@pytest.fixture
+def fake_session(monkeypatch: pytest.MonkeyPatch, clock: FakeClock):
+    def _install(statuses: list[int], headers: dict | None = None) -> FakeSession:
+        session = FakeSession(statuses, headers)
+        monkeypatch.setattr(ViaggiaTrenoAPI, "_session", session)
+        monkeypatch.setattr(
+            ViaggiaTrenoAPI,
+            "_limiter",
+            RateLimiter(rate=10, clock=clock, sleep=clock.sleep),
+        )
+        monkeypatch.setattr(ViaggiaTrenoAPI, "_breakers", dict())
+        return session
+
+    return _install
+
+
+def test_limiter_paces_requests(clock):
+    limiter = RateLimiter(rate=2, max_rate=2, clock=clock, sleep=clock.sleep)
+    for _ in range(5):
+        limiter.acquire()
+    assert clock.now == pytest.approx(2.0)
+
+
+def test_limiter_aimd(clock):
+    limiter = RateLimiter(rate=10, max_rate=20, clock=clock, sleep=clock.sleep)
+    limiter.on_throttle()
+    assert limiter.rate == pytest.approx(5)
+
+    # Concurrent throttled responses only decrease the rate once
+    limiter.on_throttle()
+    assert limiter.rate == pytest.approx(5)
+
+    for _ in range(100):
+        limiter.on_success()
+    assert 5 < limiter.rate <= 20
+
+
+def test_limiter_retry_after(clock):
+    limiter = RateLimiter(rate=10, clock=clock, sleep=clock.sleep)
+    limiter.on_throttle(retry_after=3)
+    assert limiter.acquire() == pytest.approx(3)
+
+
+def test_breaker(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10, clock=clock)
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.on_failure()
+    assert breaker.state == BreakerState.OPEN
+    assert not breaker.allow()
+
+    # After the timeout, only one probe is allowed
+    clock.now += 10
+    assert breaker.allow()
+    assert breaker.state == BreakerState.HALF_OPEN
+    assert not breaker.allow()
+
+    breaker.on_failure()
+    assert breaker.state == BreakerState.OPEN
+
+    clock.now += 10
+    assert breaker.allow()
+    breaker.on_success()
+    assert breaker.state == BreakerState.CLOSED
+    assert breaker.allow()
+
+
+def test_raw_request_retries_throttled(fake_session, clock):
+    labels: dict = dict(api="ViaggiaTrenoAPI", method="regione")
+    retries: float = metrics.REGISTRY.value("request_retries_total", **labels)
+    throttled: float = metrics.REGISTRY.value("requests_total", **labels, status=503)
+
+    session: FakeSession = fake_session([403, 503, 200], {"Retry-After": "2"})
+    assert ViaggiaTrenoAPI._raw_request("regione", "S01700") == "1"
+    assert session.calls == 3
+    assert metrics.REGISTRY.value("request_retries_total", **labels) == retries + 2
+    assert (
+        metrics.REGISTRY.value("requests_total", **labels, status=503) == throttled + 1
+    )
+    assert sum(clock.slept) >= 4
+    assert ViaggiaTrenoAPI.throttle_status()["breakers"] == {"regione": "closed"}
+    assert ViaggiaTrenoAPI.throttle_status()["rate"] < 10
+
+
+def test_raw_request_circuit_open(fake_session):
+    session: FakeSession = fake_session([503])
+    for _ in range(5):
+        with pytest.raises(ThrottledException) as e:
+            ViaggiaTrenoAPI._raw_request("andamentoTreno", "S01700", 1, 0)
+        assert e.value.status_code == 503
+
+    calls: int = session.calls
+    with pytest.raises(CircuitOpenException):
+        ViaggiaTrenoAPI._raw_request("andamentoTreno", "S01700", 1, 0)
+    assert session.calls == calls
+
+    # Other methods are not affected
+    assert ViaggiaTrenoAPI._breaker("partenze").allow()
+    assert ViaggiaTrenoAPI.throttle_status()["breakers"]["andamentoTreno"] == "open"
+
+
+def test_raw_request_probe_error(fake_session, clock):
+    session: FakeSession = fake_session([200])
+    breaker: CircuitBreaker = ViaggiaTrenoAPI._breaker("regione")
+    breaker._clock = clock
+    for _ in range(breaker.failure_threshold):
+        breaker.on_failure()
+
+    # An unexpected error of the probe request opens the breaker again...
+    clock.now += breaker.reset_timeout
+    get = session.get
+    session.get = lambda url: 1 / 0
+    with pytest.raises(ZeroDivisionError):
+        ViaggiaTrenoAPI._raw_request("regione", "S01700")
+    assert breaker.state == BreakerState.OPEN
+
+    # ...so that the next probe is let through
+    clock.now += breaker.reset_timeout
+    session.get = get
+    assert ViaggiaTrenoAPI._raw_request("regione", "S01700") == "1"
+    assert breaker.state == BreakerState.CLOSED
+
+
+def test_raw_request_not_found(fake_session):
+    fake_session([204])
+    with pytest.raises(BadRequestException) as e:
+        ViaggiaTrenoAPI._raw_request("andamentoTreno", "S01700", 1, 0)
+    assert e.value.status_code == 204
+    assert ViaggiaTrenoAPI.throttle_status()["breakers"]["andamentoTreno"] == "closed"
+
+
+def test_reset_session():
+    for api in (ViaggiaTrenoAPI, TrenordAPI):
+        session = api._session
+        api.reset_session()
+        assert api._session is not session
+        assert set(api._session.adapters) >= set(api._SESSION_PREFIXES)
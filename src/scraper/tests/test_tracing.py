@@ -0,0 +1,93 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import pickle
+
+import pytest
+
+import src.scraper.tracing as tracing
+from src.scraper.loop import ScrapeLoop
+from src.scraper.station import Station
+from src.scraper.train import Train
+
+
+@pytest.fixture
+def traces(tmp_path):
+    exporter = tracing.JSONLExporter(tmp_path / "traces.jsonl")
+    yield exporter
+    tracing.TRACER.configure(0.0)
+
+
+def _read_spans(exporter: tracing.JSONLExporter) -> list[dict]:
+    if not exporter.path.exists():
+        return list()
+    with open(exporter.path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_sampled_traces(fake_api, traces):
+    fake_api.add_train(1, ["S00001", "S00002", "S00003"])
+    fake_api.add_train(2, ["S00001", "S00004"], client_code=63)
+    fake_api.add_trenord(2, ["S00001", "S00004"])
+    tracing.TRACER.configure(1.0, [traces])
+
+    fetched: dict[int, Train] = dict()
+    ScrapeLoop(fetched, dict()).run([Station.by_code("S00001")])
+
+    spans: list[dict] = _read_spans(traces)
+    roots: dict[str, dict] = {s["trace_id"]: s for s in spans if not s["parent_id"]}
+    assert sorted(s["name"] for s in roots.values()).count("train.fetch") == 2
+
+    names: dict[str, set[str]] = dict()
+    for span in spans:
+        names.setdefault(span["trace_id"], set()).add(span["name"])
+        if span["parent_id"]:
+            assert span["trace_id"] in roots
+    train_trace = next(
+        trace_id
+        for trace_id, root in roots.items()
+        if root["name"] == "train.fetch" and root["attributes"]["number"] == 1
+    )
+    assert names[train_trace] == {"train.fetch", "json.decode", "train.stops"}
+    stops = next(
+        s for s in spans if s["trace_id"] == train_trace and s["name"] == "train.stops"
+    )
+    assert stops["attributes"]["stops"] == 3
+    assert any("trenord.merge" in trace_names for trace_names in names.values())
+
+
+def test_not_sampled(fake_api, traces):
+    fake_api.add_train(1, ["S00001", "S00002"])
+    tracing.TRACER.configure(0.0, [traces])
+
+    ScrapeLoop(dict(), dict()).run([Station.by_code("S00001")])
+    assert _read_spans(traces) == []
+    with tracing.span("json.decode") as span:
+        assert span is tracing._NOOP
+
+
+def test_exporter_pickle(tmp_path):
+    exporter = tracing.JSONLExporter(tmp_path / "traces.jsonl")
+    with tracing.Span("train.fetch", {"number": 1}) as root:
+        with tracing.Span("json.decode", {}, root):
+            pass
+    exporter = pickle.loads(pickle.dumps(exporter))
+    exporter.export(root._spans)
+    spans = _read_spans(exporter)
+    assert [s["name"] for s in spans] == ["train.fetch", "json.decode"]
+    assert spans[1]["parent_id"] == spans[0]["span_id"]
@@ -0,0 +1,194 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+import typing as t
+from enum import Enum
+
+
+class RateLimiter:
+    """Thread-safe token bucket rate limiter with AIMD adaptation.
+
+    The rate is additively increased on every successful request
+    and multiplicatively decreased when the upstream is throttling.
+
+    Attributes:
+        rate (float): the current rate, in requests per second
+        min_rate (float): the lower bound of the rate
+        max_rate (float): the upper bound of the rate
+    """
+
+    def __init__(
+        self,
+        rate: float = 10.0,
+        min_rate: float = 0.5,
+        max_rate: float = 50.0,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        clock: t.Callable[[], float] = time.monotonic,
+        sleep: t.Callable[[float], None] = time.sleep,
+    ) -> None:
+        """Initialize a new rate limiter.
+
+        Args:
+            rate (float, optional): the initial rate, in requests per second
+            min_rate (float, optional): the lower bound of the rate
+            max_rate (float, optional): the upper bound of the rate
+            increase (float, optional): the rate increase after ~one second of successful requests
+            decrease (float, optional): the factor the rate is multiplied by when throttled
+            clock (t.Callable[[], float], optional): monotonic clock, used in tests
+            sleep (t.Callable[[float], None], optional): sleep function, used in tests
+        """
+        assert 0 < min_rate <= max_rate
+        assert 0 < decrease < 1
+
+        self.min_rate: float = min_rate
+        self.max_rate: float = max_rate
+        self.rate: float = min(max(rate, min_rate), max_rate)
+        self.increase: float = increase
+        self.decrease: float = decrease
+
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens: float = 1.0
+        self._last_refill: float = clock()
+        self._blocked_until: float = 0.0
+        self._last_decrease: float = float("-inf")
+
+    def acquire(self) -> float:
+        """Wait until a request can be performed.
+
+        Returns:
+            float: the number of seconds waited
+        """
+        with self._lock:
+            now: float = self._clock()
+            self._tokens = min(
+                max(self.rate, 1.0),
+                self._tokens + (now - self._last_refill) * self.rate,
+            )
+            self._last_refill = now
+
+            # Tokens can go negative: the caller reserves a future slot
+            self._tokens -= 1
+            wait: float = max(
+                self._blocked_until - now,
+                -self._tokens / self.rate if self._tokens < 0 else 0.0,
+            )
+
+        if wait > 0:
+            self._sleep(wait)
+        return wait
+
+    def on_success(self) -> None:
+        """Additively increase the rate after a successful request."""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_throttle(self, retry_after: float | None = None) -> None:
+        """Multiplicatively decrease the rate after a throttled request.
+
+        Args:
+            retry_after (float | None, optional): seconds to wait before any
+                other request, as requested by the upstream
+        """
+        with self._lock:
+            now: float = self._clock()
+
+            # Concurrent requests are throttled together: decrease once per interval
+            if now - self._last_decrease >= 1 / self.rate:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self._last_decrease = now
+
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+
+
+class BreakerState(Enum):
+    """A circuit breaker state."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """Thread-safe circuit breaker.
+
+    After `failure_threshold` consecutive failures the breaker opens and every
+    request fails fast. After `reset_timeout` seconds a single probe request
+    is let through: its outcome closes or opens the breaker again.
+
+    Attributes:
+        state (BreakerState): the current state
+        failures (int): the number of consecutive failures
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        clock: t.Callable[[], float] = time.monotonic,
+    ) -> None:
+        """Initialize a new circuit breaker.
+
+        Args:
+            failure_threshold (int, optional): consecutive failures to open the breaker
+            reset_timeout (float, optional): seconds to wait before probing again
+            clock (t.Callable[[], float], optional): monotonic clock, used in tests
+        """
+        self.failure_threshold: int = failure_threshold
+        self.reset_timeout: float = reset_timeout
+        self.state: BreakerState = BreakerState.CLOSED
+        self.failures: int = 0
+
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._opened_at: float = 0.0
+
+    def allow(self) -> bool:
+        """Return True if a request can be performed, False if it should fail fast."""
+        with self._lock:
+            if self.state == BreakerState.CLOSED:
+                return True
+
+            if (
+                self.state == BreakerState.OPEN
+                and self._clock() - self._opened_at >= self.reset_timeout
+            ):
+                self.state = BreakerState.HALF_OPEN
+                return True
+
+            # Only one probe at a time
+            return False
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.state = BreakerState.CLOSED
+            self.failures = 0
+
+    def on_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if (
+                self.state == BreakerState.HALF_OPEN
+                or self.failures >= self.failure_threshold
+            ):
+                self.state = BreakerState.OPEN
+                self._opened_at = self._clock()
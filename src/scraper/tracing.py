@@ -0,0 +1,309 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import contextvars
+import json
+import logging
+import os
+import pathlib
+import random
+import threading
+import time
+import typing as t
+from datetime import datetime, timezone
+
+# The span currently open in this context (task or thread), if any.
+# asyncio tasks and asyncio.to_thread() copy the context of their caller,
+# so spans opened in worker threads are children of the caller span.
+_current: contextvars.ContextVar["Span | None"] = contextvars.ContextVar(
+    "span", default=None
+)
+
+
+class Span:
+    """A timed operation of a sampled trace.
+
+    Attributes:
+        trace_id (str): the identifier of the trace
+        span_id (str): the identifier of the span
+        parent_id (str | None): the identifier of the parent span, None for the root
+        name (str): the operation name (e.g. api.request)
+        start (float): the start time (UNIX timestamp)
+        duration (float | None): the duration in seconds, None if still open
+        attributes (dict[str, t.Any]): details of the operation
+        error (str | None): the exception raised in the span, if any
+    """
+
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "name",
+        "start",
+        "duration",
+        "attributes",
+        "error",
+        "_spans",
+        "_started",
+        "_token",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        attributes: dict[str, t.Any],
+        parent: "Span | None" = None,
+    ) -> None:
+        self.trace_id: str = parent.trace_id if parent else _random_id(16)
+        self.span_id: str = _random_id(8)
+        self.parent_id: str | None = parent.span_id if parent else None
+        self.name: str = name
+        self.start: float = time.time()
+        self.duration: float | None = None
+        self.attributes: dict[str, t.Any] = attributes
+        self.error: str | None = None
+
+        # The spans of the trace, shared with the root
+        self._spans: list[Span] = parent._spans if parent else list()
+        self._spans.append(self)
+        self._started: float = time.perf_counter()
+        self._token: contextvars.Token | None = None
+
+    def set(self, **attributes: t.Any) -> None:
+        """Add attributes to the span."""
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.duration = time.perf_counter() - self._started
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        if self._token is not None:
+            _current.reset(self._token)
+
+        if self.parent_id is None:
+            TRACER.export(self._spans)
+
+    def as_dict(self) -> dict[str, t.Any]:
+        """Return the span as a JSON serializable dict."""
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "duration_ms": round((self.duration or 0) * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _NoopSpan:
+    """The span of operations which are not sampled: it records nothing."""
+
+    __slots__ = ()
+
+    def set(self, **attributes: t.Any) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        pass
+
+
+_NOOP: _NoopSpan = _NoopSpan()
+
+
+def _random_id(size: int) -> str:
+    return os.urandom(size).hex()
+
+
+class JSONLExporter:
+    """Append the spans of the sampled traces to a JSON Lines file,
+    one span per line.
+
+    Writes are serialized between threads; each trace is written
+    with a single append, so processes can share the same file.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        """Initialize a new exporter.
+
+        Args:
+            path (pathlib.Path): the file to append to
+        """
+        self.path: pathlib.Path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock: threading.Lock = threading.Lock()
+
+    def export(self, spans: t.Sequence[Span]) -> None:
+        lines: str = "".join(json.dumps(span.as_dict()) + "\n" for span in spans)
+        with self._lock, open(self.path, "a") as f:
+            f.write(lines)
+
+    def __getstate__(self) -> dict[str, t.Any]:
+        # Exporters are sent to the shard worker processes
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict[str, t.Any]) -> None:
+        self.__init__(state["path"])
+
+
+class SentryExporter:
+    """Send the sampled traces to Sentry as transactions.
+
+    Sentry must be initialized (see sentry_sdk.init); traces are sent
+    regardless of its traces_sample_rate.
+    """
+
+    def export(self, spans: t.Sequence[Span]) -> None:
+        import sentry_sdk
+
+        root: Span = spans[0]
+        transaction = sentry_sdk.start_transaction(
+            op=root.name,
+            name=f"{root.name} {_describe(root)}".strip(),
+            sampled=True,
+            start_timestamp=_utc(root.start),
+        )
+        for key, value in root.attributes.items():
+            transaction.set_data(key, value)
+
+        parents: dict[str, t.Any] = {root.span_id: transaction}
+        for span in sorted(spans[1:], key=lambda s: s.start):
+            parent = parents.get(span.parent_id or "", transaction)
+            child = parent.start_child(
+                op=span.name,
+                description=_describe(span) or None,
+                start_timestamp=_utc(span.start),
+            )
+            for key, value in span.attributes.items():
+                child.set_data(key, value)
+            if span.error is not None:
+                child.set_status("internal_error")
+            child.finish(end_timestamp=_utc(span.start + (span.duration or 0)))
+            parents[span.span_id] = child
+
+        transaction.finish(end_timestamp=_utc(root.start + (root.duration or 0)))
+
+
+def _utc(timestamp: float) -> datetime:
+    """Convert a timestamp to a naive UTC datetime, as used by sentry_sdk."""
+    return datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None)
+
+
+def _describe(span: Span) -> str:
+    return " ".join(f"{key}={value}" for key, value in span.attributes.items())
+
+
+Exporter = JSONLExporter | SentryExporter
+
+
+class Tracer:
+    """Sampled tracer of the scraper hot paths.
+
+    A trace (e.g. the fetch of a train) is sampled with the given rate
+    when it starts; the operations performed in it are recorded as spans
+    and exported together when it ends. Operations outside a sampled trace
+    cost a context variable lookup.
+
+    Attributes:
+        sample_rate (float): the fraction of traces to record (0-1)
+        exporters (list[Exporter]): where the sampled traces are sent
+    """
+
+    def __init__(
+        self, sample_rate: float = 0.0, exporters: t.Sequence[Exporter] = ()
+    ) -> None:
+        """Initialize a new tracer.
+
+        Args:
+            sample_rate (float, optional): the fraction of traces to record.
+                Defaults to 0 (disabled)
+            exporters (t.Sequence[Exporter], optional): where the traces are sent
+        """
+        self.sample_rate: float = sample_rate
+        self.exporters: list[Exporter] = list(exporters)
+
+    def configure(
+        self, sample_rate: float, exporters: t.Sequence[Exporter] = ()
+    ) -> None:
+        """Change the sampling rate and the exporters.
+
+        Args:
+            sample_rate (float): the fraction of traces to record (0-1)
+            exporters (t.Sequence[Exporter], optional): where the traces are sent
+        """
+        self.sample_rate = sample_rate
+        self.exporters = list(exporters)
+
+    def trace(self, name: str, **attributes: t.Any) -> Span | _NoopSpan:
+        """Start a trace, if sampled, or a span if a trace is already running.
+
+        Args:
+            name (str): the operation name
+            attributes (t.Any): details of the operation
+
+        Returns:
+            Span | _NoopSpan: a context manager to enclose the operation in
+        """
+        parent: Span | None = _current.get()
+        if parent is not None:
+            return Span(name, attributes, parent)
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return Span(name, attributes)
+        return _NOOP
+
+    def span(self, name: str, **attributes: t.Any) -> Span | _NoopSpan:
+        """Start a span, if a sampled trace is running.
+
+        Args:
+            name (str): the operation name
+            attributes (t.Any): details of the operation
+
+        Returns:
+            Span | _NoopSpan: a context manager to enclose the operation in
+        """
+        parent: Span | None = _current.get()
+        if parent is None:
+            return _NOOP
+        return Span(name, attributes, parent)
+
+    def export(self, spans: t.Sequence[Span]) -> None:
+        """Send a finished trace to the exporters.
+        Exporter errors are logged, not raised.
+
+        Args:
+            spans (t.Sequence[Span]): the spans of the trace, the root first
+        """
+        for exporter in self.exporters:
+            try:
+                exporter.export(spans)
+            except Exception as e:
+                logging.warning(f"Can't export trace: {e}")
+
+
+# The tracer of this process
+TRACER: Tracer = Tracer()
+
+trace = TRACER.trace
+span = TRACER.span
@@ -15,18 +15,35 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import asyncio
+import hashlib
 import logging
+import sys
 import typing as t
-from datetime import date, datetime, timedelta
+from datetime import date, datetime
 
+import src.localtime as localtime
 import src.scraper.api as api
 import src.scraper.station as st
+import src.scraper.tracing as tracing
 import src.scraper.train_stop as tr_st
 from src import types
-from src.const import INTRADAY_SPLIT_HOUR, TIMEZONE
+from src.const import INTRADAY_SPLIT_HOUR
 from src.scraper.exceptions import *
 
 
+class TrenordJourney(t.NamedTuple):
+    """The Trenord data of a train in a given day.
+
+    Attributes:
+        train (types.JSONType): the train data (e.g. crowding)
+        stops (types.JSONType): the stops data
+    """
+
+    train: types.JSONType
+    stops: types.JSONType
+
+
 class Train:
     """A ViaggiaTreno train.
 
@@ -52,8 +69,46 @@ class Train:
         _phantom (bool): true if no more data can be fetched (e.g. train is cancelled)
         _trenord_phantom (bool): true if the train is Trenord's and no data can be fetched using its API
         _fetched (datetime | None): the last time the data has been fetched successfully
+        _next_fetch (datetime | None): fetching the train before this time is useless
+        _refetches (int): the number of fetches after the expected arrival time
+        _trenord_detection (datetime | None): the last detection time
+            when Trenord data has been fetched
+        _trenord_journey (TrenordJourney | None): the last Trenord data of the train
+        _fingerprint (bytes | None): digest of the last 'andamentoTreno' response
+
+    Notes:
+        Pickled trains keep the codes of their origin and destination only
+        (see TrainStop), and the last detection time as a UNIX timestamp.
     """
 
+    # Attributes saved by __getstate__, in order
+    _STATE: t.Tuple[str, ...] = (
+        "number",
+        "_origin_code",
+        "departing_date",
+        "_destination_code",
+        "_category",
+        "client_code",
+        "departed",
+        "cancelled",
+        "stops",
+        "delay",
+        "last_detection_place",
+        "_last_detection_time",
+        "crowding",
+        "crowding_source",
+        "_phantom",
+        "_trenord_phantom",
+        "_fetched",
+        "_next_fetch",
+        "_refetches",
+        "_trenord_detection",
+        "_trenord_journey",
+        "_fingerprint",
+    )
+
+    __slots__ = _STATE + ("_origin", "_destination")
+
     def __init__(self, number: int, origin: st.Station, departing_date: date) -> None:
         """Initialize a new train.
 
@@ -65,11 +120,18 @@ class Train:
         Notes:
             Other fields can be set manually or using the fetch() method.
         """
+        self._origin: st.Station | None
+        self._origin_code: str
+        self._destination: st.Station | None
+        self._destination_code: str | None
+        self._category: str | None
+        self._last_detection_time: int | None
+
         self.number: int = number
-        self.origin: st.Station = origin
+        self.origin = origin
         self.departing_date: date = departing_date
-        self.destination: st.Station | None = None
-        self.category: str | None = None
+        self.destination = None
+        self.category = None
         self.client_code: int | None = None
         self.departed: bool | None = None
         self.cancelled: bool | None = None
@@ -78,13 +140,76 @@ class Train:
         self.stops: t.List[tr_st.TrainStop] | None = None
         self.delay: int | None = None
         self.last_detection_place: str | None = None
-        self.last_detection_time: datetime | None = None
+        self.last_detection_time = None
         self.crowding: float | None = None
         self.crowding_source: float | None = None
 
         self._phantom: bool = False
         self._trenord_phantom: bool = False
         self._fetched: datetime | None = None
+        self._next_fetch: datetime | None = None
+        self._refetches: int = 0
+        self._trenord_detection: datetime | None = None
+        self._trenord_journey: TrenordJourney | None = None
+        self._fingerprint: bytes | None = None
+
+    @property
+    def origin(self) -> st.Station:
+        if self._origin is not None:
+            return self._origin
+        return st.Station._resolve(self._origin_code)
+
+    @origin.setter
+    def origin(self, station: st.Station) -> None:
+        self._origin = station
+        self._origin_code = station.code
+
+    @property
+    def destination(self) -> st.Station | None:
+        if self._destination is not None or self._destination_code is None:
+            return self._destination
+        return st.Station._resolve(self._destination_code)
+
+    @destination.setter
+    def destination(self, station: st.Station | None) -> None:
+        self._destination = station
+        self._destination_code = station.code if station is not None else None
+
+    @property
+    def category(self) -> str | None:
+        return self._category
+
+    @category.setter
+    def category(self, category: str | None) -> None:
+        # A few distinct values, shared by all the trains
+        self._category = sys.intern(category) if category is not None else None
+
+    @property
+    def last_detection_time(self) -> datetime | None:
+        return localtime.to_datetime(self._last_detection_time)
+
+    @last_detection_time.setter
+    def last_detection_time(self, value: datetime | None) -> None:
+        self._last_detection_time = localtime.to_timestamp(value)
+
+    def __getstate__(self) -> tuple:
+        return tuple(getattr(self, name) for name in self._STATE)
+
+    def __setstate__(self, state: tuple | dict) -> None:
+        if isinstance(state, dict):
+            # Pickled before the compact representation: attributes added
+            # later are missing, and have their default values
+            self.__init__(state["number"], state["origin"], state["departing_date"])
+            for name, value in state.items():
+                if hasattr(Train, name):
+                    setattr(self, name, value)
+            return
+
+        for name, value in zip(self._STATE, state):
+            setattr(self, name, value)
+        self._origin = self._destination = None
+        if self._category is not None:
+            self._category = sys.intern(self._category)
 
     @classmethod
     def _from_station_departures_arrivals(cls, train_data: dict) -> "Train":
@@ -97,15 +222,10 @@ class Train:
         Returns:
             Train: the initialized train
         """
-        departing_date_midnight = api.ViaggiaTrenoAPI._to_datetime(
-            train_data["dataPartenzaTreno"] + 18000 * 1000  # Ensure correct date
-        )
-        assert isinstance(departing_date_midnight, datetime)
-
         train: Train = cls(
             number=train_data["numeroTreno"],
             origin=st.Station.by_code(train_data["codOrigine"]),
-            departing_date=departing_date_midnight.date(),
+            departing_date=cls._board_departing_date(train_data),
         )
 
         train.category = train_data["categoriaDescrizione"].upper().strip()
@@ -115,34 +235,205 @@ class Train:
             train_data["provvedimento"] != 0
             or "cancellazione.png" in train_data["compImgCambiNumerazione"]
         )
+        train._next_fetch = cls._board_next_fetch(train_data)
         return train
 
-    def fetch(self):
+    @staticmethod
+    def _board_next_fetch(train_data: dict) -> datetime | None:
+        """Return the time a train shown in a departure board should be fetched at.
+
+        Args:
+            train_data (dict): the board entry
+
+        Returns:
+            datetime | None: the departure time if the train has not departed
+            (no data until then), None otherwise
+        """
+        if (
+            not train_data["nonPartito"]
+            or train_data["provvedimento"] != 0
+            or "cancellazione.png" in train_data["compImgCambiNumerazione"]
+        ):
+            return None
+        return api.ViaggiaTrenoAPI._to_datetime(train_data.get("orarioPartenza"))
+
+    @staticmethod
+    def _board_departing_date(train_data: dict) -> date:
+        """Return the departing date of a train shown in a departure or arrival board.
+
+        Args:
+            train_data (dict): the board entry
+
+        Returns:
+            date: the departing date
+        """
+        return Train._midnight_date(train_data["dataPartenzaTreno"])
+
+    @staticmethod
+    def _midnight_date(midnight: int) -> date:
+        """Convert a departing midnight timestamp (as in boards) to a date.
+
+        Args:
+            midnight (int): the UNIX timestamp with milliseconds
+
+        Returns:
+            date: the departing date
+        """
+        departing_date_midnight = api.ViaggiaTrenoAPI._to_datetime(
+            midnight + 18000 * 1000  # Ensure correct date
+        )
+        assert isinstance(departing_date_midnight, datetime)
+        return departing_date_midnight.date()
+
+    @staticmethod
+    def _board_hash(key: "api.BoardKey") -> int:
+        """Return the hash code of a train shown in a board, without initializing it.
+
+        Args:
+            key (api.BoardKey): the train number, origin code and departing midnight
+
+        Returns:
+            int: the same value as hash() of the train
+        """
+        number, origin_code, midnight = key
+        return Train._hash(number, origin_code, Train._midnight_date(midnight))
+
+    @classmethod
+    async def _from_station_departures_arrivals_async(cls, train_data: dict) -> "Train":
+        """Coroutine version of _from_station_departures_arrivals.
+
+        Args:
+            train_data (dict): the data to initialize the train with
+
+        Returns:
+            Train: the initialized train
+        """
+        await st.Station.by_code_async(train_data["codOrigine"])
+        return cls._from_station_departures_arrivals(train_data)
+
+    def _andamento_parameters(self) -> t.Tuple[str, int, int]:
+        """Return the parameters of the 'andamentoTreno' API call for this train.
+
+        Returns:
+            t.Tuple[str, int, int]: origin code, number and departing midnight timestamp
+        """
+        return (
+            self.origin.code,
+            self.number,
+            localtime.to_timestamp(  # type: ignore
+                datetime.combine(self.departing_date, datetime.min.time())
+            )
+            * 1000,
+        )
+
+    def fetch(self, trenord: bool = True) -> bool:
         """Try fetch more details about the train.
 
+        Args:
+            trenord (bool, optional): if True, also fetch Trenord data
+                (see fetch_trenord). The scraping loop fetches it in a separate stage
+
+        Returns:
+            bool: False if nothing changed since the last fetch
+
         Notes:
             Some trains (especially cancelled or partially cancelled ones)
             can't be fetched with this API. If so, self._phantom is set to True.
+            If the response did not change, it is not decoded again.
         """
-        try:
-            raw_details: str = api.ViaggiaTrenoAPI._raw_request(
-                "andamentoTreno",
-                self.origin.code,
-                self.number,
-                int(
-                    datetime.combine(
-                        self.departing_date,
-                        datetime.min.time(),
-                        tzinfo=TIMEZONE,
-                    ).timestamp()
-                    * 1000
-                ),
-            )
-            train_data: types.JSONType = api.ViaggiaTrenoAPI._decode_json(raw_details)
-        except BadRequestException:
-            self._phantom = True
-            return
+        with tracing.trace("train.fetch", number=self.number, origin=self._origin_code):
+            try:
+                raw_details: str = api.ViaggiaTrenoAPI._raw_request(
+                    "andamentoTreno", *self._andamento_parameters()
+                )
+                fingerprint: bytes | None = self._changed_fingerprint(raw_details)
+                if fingerprint is None:
+                    return False
+                train_data: types.JSONType = api.ViaggiaTrenoAPI._decode_json(
+                    raw_details, "andamentoTreno"
+                )
+            except BadRequestException:
+                self._phantom = True
+                return True
+
+            self._update_details(train_data)
+            self._fingerprint = fingerprint
+
+            if trenord and self.client_code == api.TrenordAPI.TRENORD_CLIENT_CODE:
+                self.fetch_trenord()
+
+            self._check_stops()
+            return True
+
+    async def fetch_async(self, trenord: bool = True) -> bool:
+        """Coroutine version of fetch.
+
+        Args:
+            trenord (bool, optional): if True, also fetch Trenord data
+
+        Returns:
+            bool: False if nothing changed since the last fetch
+
+        Notes:
+            Unknown stations referenced by the train are resolved concurrently
+            before the train stops are built.
+        """
+        with tracing.trace("train.fetch", number=self.number, origin=self._origin_code):
+            try:
+                raw_details: str = await api.ViaggiaTrenoAPI._raw_request_async(
+                    "andamentoTreno", *self._andamento_parameters()
+                )
+                fingerprint: bytes | None = self._changed_fingerprint(raw_details)
+                if fingerprint is None:
+                    return False
+                train_data: types.JSONType = api.ViaggiaTrenoAPI._decode_json(
+                    raw_details, "andamentoTreno"
+                )
+            except BadRequestException:
+                self._phantom = True
+                return True
+
+            if await st.Station._prefetch_async(
+                [train_data["idDestinazione"]]
+                + [raw_stop["id"] for raw_stop in train_data["fermate"]]
+            ):
+                # The missing stations are looked up again with blocking requests
+                await asyncio.to_thread(self._update_details, train_data)
+            else:
+                self._update_details(train_data)
+            self._fingerprint = fingerprint
+
+            if trenord and self.client_code == api.TrenordAPI.TRENORD_CLIENT_CODE:
+                await self.fetch_trenord_async()
 
+            self._check_stops()
+            return True
+
+    def _changed_fingerprint(self, raw_details: str) -> bytes | None:
+        """Return the fingerprint of the 'andamentoTreno' response, if it changed
+        since the last fetch. The caller remembers it once the response is decoded.
+        Helper function to fetch() and fetch_async().
+
+        Args:
+            raw_details (str): the raw API response
+
+        Returns:
+            bytes | None: the new fingerprint, None if the train data
+                is already up to date
+        """
+        fingerprint: bytes = api.ViaggiaTrenoAPI._fingerprint(raw_details)
+        if self._fetched and fingerprint == getattr(self, "_fingerprint", None):
+            self._fetched = datetime.now()
+            return None
+        return fingerprint
+
+    def _update_details(self, train_data: types.JSONType) -> None:
+        """Update the train with the data returned by the 'andamentoTreno' API call.
+        Helper function to fetch() and fetch_async().
+
+        Args:
+            train_data (types.JSONType): the decoded API response
+        """
         try:
             self.destination = st.Station.by_code(train_data["idDestinazione"])
         except BadRequestException:
@@ -170,15 +461,20 @@ class Train:
             train_data["oraUltimoRilevamento"]
         )
 
-        self.stops = list()
-        for raw_stop in train_data["fermate"]:
-            stop: tr_st.TrainStop = tr_st.TrainStop._from_raw_data(raw_stop)
-            self.stops.append(stop)
+        with tracing.span("train.stops", stops=len(train_data["fermate"])):
+            self.stops = [
+                tr_st.TrainStop._from_raw_data(raw_stop)
+                for raw_stop in train_data["fermate"]
+            ]
 
         self._fetched = datetime.now()
 
-        if self.client_code == api.TrenordAPI.TRENORD_CLIENT_CODE:
-            self.fetch_trenord()
+    def _check_stops(self) -> None:
+        """Check the consistency of the fetched stops, marking the train
+        as phantom or fixing the last stop if needed.
+        Helper function to fetch() and fetch_async().
+        """
+        assert isinstance(self.stops, list)
 
         if len(self.stops) == 0 and self.cancelled:
             self._phantom = True
@@ -209,6 +505,42 @@ class Train:
 
     def fetch_trenord(self) -> None:
         """Try fetch more details about the train, using Trenord API."""
+        with tracing.trace("trenord.fetch", number=self.number):
+            if (
+                self.client_code != api.TrenordAPI.TRENORD_CLIENT_CODE
+                or self._trenord_phantom
+            ):
+                return
+
+            assert self._fetched
+
+            # Sometimes, ViaggiaTreno returns "trains" operated by Trenord
+            # that don't really operate any passenger services.
+            # On the other hand, such trains are not returned by Trenord API
+            # which is more precise.
+            try:
+                trenord_details_raw = api.TrenordAPI._raw_request("train", self.number)
+                trenord_details = api.ViaggiaTrenoAPI._decode_json(
+                    trenord_details_raw, "train", api="TrenordAPI"
+                )
+                assert len(trenord_details) > 0
+            except AssertionError:
+                self._trenord_phantom = True
+                logging.debug(
+                    f"Trenord train {self.number} is not present in Trenord API. Marked as phantom."
+                )
+                return
+            except BadRequestException as e:
+                logging.warning(e, exc_info=True)
+                return
+            except CircuitOpenException as e:
+                logging.debug(e)
+                return
+
+            self._update_trenord_details(trenord_details)
+
+    async def fetch_trenord_async(self) -> None:
+        """Coroutine version of fetch_trenord."""
 
         if (
             self.client_code != api.TrenordAPI.TRENORD_CLIENT_CODE
@@ -217,53 +549,152 @@ class Train:
             return
 
         assert self._fetched
+        await Train.fetch_trenord_batch_async([self])
 
-        # Sometimes, ViaggiaTreno returns "trains" operated by Trenord
-        # that don't really operate any passenger services.
-        # On the other hand, such trains are not returned by Trenord API
-        # which is more precise.
-        try:
-            trenord_details_raw = api.TrenordAPI._raw_request("train", self.number)
-            trenord_details = api.ViaggiaTrenoAPI._decode_json(trenord_details_raw)
-            assert len(trenord_details) > 0
-        except AssertionError:
-            self._trenord_phantom = True
-            logging.debug(
-                f"Trenord train {self.number} is not present in Trenord API. Marked as phantom."
+    @classmethod
+    async def fetch_trenord_batch_async(cls, trains: t.Sequence["Train"]) -> None:
+        """Fetch Trenord data of trains with the same number, with a single request.
+
+        Args:
+            trains (t.Sequence[Train]): the fetched Trenord trains
+
+        Notes:
+            Trenord returns the journeys of every train with the requested number
+            (e.g. departing in different days): each train selects its own.
+        """
+        with tracing.trace(
+            "trenord.fetch", number=trains[0].number, trains=len(trains)
+        ):
+            number: int = trains[0].number
+            assert all(train.number == number for train in trains)
+
+            try:
+                trenord_details_raw = await api.TrenordAPI._raw_request_async(
+                    "train", number
+                )
+                trenord_details = api.ViaggiaTrenoAPI._decode_json(
+                    trenord_details_raw, "train", api="TrenordAPI"
+                )
+                assert len(trenord_details) > 0
+            except AssertionError:
+                for train in trains:
+                    train._trenord_phantom = True
+                logging.debug(
+                    f"Trenord train {number} is not present in Trenord API. Marked as phantom."
+                )
+                return
+            except BadRequestException as e:
+                logging.warning(e, exc_info=True)
+                return
+            except CircuitOpenException as e:
+                logging.debug(e)
+                return
+
+            failed: list[str] = await st.Station._prefetch_async(
+                stop.get("station", {}).get("station_id")
+                or (stop.get("actual_data") or {}).get("actual_station_mir")
+                for data in trenord_details
+                for journey in data.get("journey_list", [])
+                for stop in journey["pass_list"]
+                if stop.get("actual_data")
             )
-            return
-        except BadRequestException as e:
-            logging.warning(e, exc_info=True)
-            return
+            for train in trains:
+                if failed:
+                    await asyncio.to_thread(
+                        train._update_trenord_details, trenord_details
+                    )
+                else:
+                    train._update_trenord_details(trenord_details)
 
-        # Trenord returns multiple trains and possible journeys.
-        # This algorithm selects the correct train actual data.
-        actual_train_info: types.JSONType | None = None
-        actual_stop_info: types.JSONType | None = None
-        for data in trenord_details:
-            for journey in data.get("journey_list", []):
-                train_info: types.JSONType = journey["train"]
-                stop_info: types.JSONType = journey["pass_list"]
+    def trenord_due(self) -> bool:
+        """Return True if fetching Trenord data could give new data:
+        the train is operated by Trenord and ViaggiaTreno shows progress
+        (a new detection) since the last Trenord fetch, or its arrival.
 
-                if train_info["date"] != datetime.now().strftime("%Y%m%d"):
-                    continue
+        Returns:
+            bool: True if Trenord data should be fetched
+        """
+        if (
+            self.client_code != api.TrenordAPI.TRENORD_CLIENT_CODE
+            or self._phantom
+            or self._trenord_phantom
+            or not self._fetched
+        ):
+            return False
 
-                if len(stop_info) == 0:
-                    continue
+        fetched_at: datetime | None = getattr(self, "_trenord_detection", None)
+        if self.last_detection_time is not None:
+            return self.last_detection_time != fetched_at
+        return fetched_at is None and bool(self.arrived())
+
+    @staticmethod
+    def _select_trenord_journey(
+        trenord_details: types.JSONType, day: date
+    ) -> TrenordJourney | None:
+        """Select the journey with actual data of a train departing in a given day.
 
-                if not any([stop.get("actual_data") for stop in stop_info]):
+        Args:
+            trenord_details (types.JSONType): the Trenord 'train' API response
+            day (date): the departing date of the train
+
+        Returns:
+            TrenordJourney | None: the train and stop data, None if not found
+        """
+        # Trenord returns multiple trains and possible journeys
+        day_str: str = day.strftime("%Y%m%d")
+        for data in trenord_details:
+            for journey in data.get("journey_list", []):
+                if journey["train"]["date"] != day_str:
                     continue
 
-                actual_train_info = train_info
-                actual_stop_info = stop_info
-                break
+                stop_info: types.JSONType = journey["pass_list"]
+                if any(stop.get("actual_data") for stop in stop_info):
+                    return TrenordJourney(journey["train"], stop_info)
+        return None
+
+    def _update_trenord_details(self, trenord_details: types.JSONType) -> None:
+        """Update the train with the data returned by the Trenord 'train' API call.
+        Helper function to fetch_trenord() and fetch_trenord_batch_async().
 
-        if not actual_train_info or not actual_stop_info:
+        Args:
+            trenord_details (types.JSONType): the decoded API response
+        """
+        journey: TrenordJourney | None = self._select_trenord_journey(
+            trenord_details, self.departing_date
+        )
+        if journey is None:
             logging.warning(
                 f"Can't update info about {self.category} {self.number} using Trenord API: no actual data found."
             )
             return
 
+        self._trenord_detection = self.last_detection_time
+        self._trenord_journey = journey
+        with tracing.span("trenord.merge", stops=len(journey.stops)):
+            self._apply_trenord_journey(journey)
+
+    def _restore_trenord(self) -> bool:
+        """Apply again the last Trenord data of the train (e.g. after ViaggiaTreno
+        data has been fetched again, with no progress), without requests.
+
+        Returns:
+            bool: True if there was Trenord data to apply
+        """
+        journey: TrenordJourney | None = getattr(self, "_trenord_journey", None)
+        if journey is None or self._phantom:
+            return False
+
+        self._apply_trenord_journey(journey)
+        return True
+
+    def _apply_trenord_journey(self, journey: TrenordJourney) -> None:
+        """Update the train with a Trenord journey.
+
+        Args:
+            journey (TrenordJourney): the selected Trenord train and stop data
+        """
+        actual_train_info, actual_stop_info = journey
+
         self.departed = bool(actual_train_info.get("actual_time", False))
         self.crowding = actual_train_info.get("crowding", {}).get("percentage", None)
         self.crowding_source = actual_train_info.get("crowding", {}).get("source", None)
@@ -330,25 +761,24 @@ class Train:
 
         # 'after-midnight' check: the train departs AFTER midnight
         # and the 'day' field is already correct.
-        if self.stops[first_stop_idx].departure.expected.hour < INTRADAY_SPLIT_HOUR:  # type: ignore
+        if localtime.hour(self.stops[first_stop_idx].departure._expected) < INTRADAY_SPLIT_HOUR:  # type: ignore
             return
 
+        def _next_day(timestamp: int | None) -> int | None:
+            if (
+                timestamp is not None
+                and localtime.hour(timestamp) < INTRADAY_SPLIT_HOUR
+            ):
+                return localtime.add_days(timestamp, 1)
+            return timestamp
+
         # 'intra-day' check: the train departs BEFORE midnight
         # but there are stops that have times AFTER midnight
         for stop in self.stops[first_stop_idx:]:
-            # fmt: off
-            if isinstance(stop.arrival, tr_st.TrainStopTime):
-                if stop.arrival.expected and stop.arrival.expected.hour < INTRADAY_SPLIT_HOUR:
-                    stop.arrival.expected += timedelta(days=1)
-                if stop.arrival.actual and stop.arrival.actual.hour < INTRADAY_SPLIT_HOUR:
-                    stop.arrival.actual += timedelta(days=1)
-
-            if isinstance(stop.departure, tr_st.TrainStopTime):
-                if stop.departure.expected and stop.departure.expected.hour < INTRADAY_SPLIT_HOUR:
-                    stop.departure.expected += timedelta(days=1)
-                if stop.departure.actual and stop.departure.actual.hour < INTRADAY_SPLIT_HOUR:
-                    stop.departure.actual += timedelta(days=1)
-            # fmt: on
+            for time in (stop.arrival, stop.departure):
+                if isinstance(time, tr_st.TrainStopTime):
+                    time._expected = _next_day(time._expected)  # type: ignore
+                    time._actual = _next_day(time._actual)
 
     def arrived(self) -> bool | None:
         """Return True if the train has arrived (no more information to fetch),
@@ -389,15 +819,38 @@ class Train:
             f"\n{chr(10).join([str(stop) for stop in self.stops])}"
         )
 
-    def __hash__(self) -> int:
-        """Return the hash code.
+    @property
+    def key(self) -> int:
+        """The train identity: a 64-bit integer which does not depend
+        on the hash seed, equal to hash() of the train.
 
         Notes:
             Trains with the same number and origin but departing in different days
-            will have a different hash code.
+            will have a different key.
         """
-        return (
-            hash(self.number)
-            + hash(self.origin.code)
-            + hash(self.departing_date if self.departing_date else date.today())
+        return self._hash(
+            self.number,
+            self._origin_code,
+            self.departing_date if self.departing_date else date.today(),
         )
+
+    def __hash__(self) -> int:
+        """Return the hash code (see key)."""
+        return self.key
+
+    @staticmethod
+    def _hash(number: int, origin_code: str, departing_date: date) -> int:
+        """Helper function to key and _board_hash().
+
+        Returns:
+            int: the first 8 bytes of the blake2b digest of the train identity,
+            as a signed integer
+        """
+        digest: bytes = hashlib.blake2b(
+            f"{number}/{origin_code}/{departing_date.isoformat()}".encode(),
+            digest_size=8,
+        ).digest()
+        value: int = int.from_bytes(digest, "big", signed=True)
+
+        # hash() never returns -1
+        return -2 if value == -1 else value
@@ -19,6 +19,7 @@ import typing as t
 from datetime import date, datetime
 from enum import Enum
 
+import src.localtime as localtime
 import src.scraper.api as api
 import src.scraper.station as st
 from src.scraper.exceptions import IncompleteTrenordStopDataException
@@ -35,12 +36,15 @@ class TrainStopType(Enum):
 
 class TrainStopTime:
     """Helper class to handle arrival and departures times.
+    Times are kept as UNIX timestamps in seconds.
 
     Attributes:
         expected (datetime): expected departing or arrival time
         actual (datetime | None): actual departing or arrival time
     """
 
+    __slots__ = ("_expected", "_actual")
+
     def __init__(self, expected: datetime, actual: datetime | None) -> None:
         """Initialize a new TrainStopTime object.
 
@@ -50,8 +54,34 @@ class TrainStopTime:
         """
         assert expected is not None
 
-        self.expected: datetime = expected
-        self.actual: datetime | None = actual
+        self._expected: int = localtime.to_timestamp(expected)  # type: ignore
+        self._actual: int | None = localtime.to_timestamp(actual)
+
+    @property
+    def expected(self) -> datetime:
+        return localtime.to_datetime(self._expected)  # type: ignore
+
+    @expected.setter
+    def expected(self, value: datetime) -> None:
+        self._expected = localtime.to_timestamp(value)  # type: ignore
+
+    @property
+    def actual(self) -> datetime | None:
+        return localtime.to_datetime(self._actual)
+
+    @actual.setter
+    def actual(self, value: datetime | None) -> None:
+        self._actual = localtime.to_timestamp(value)
+
+    def __getstate__(self) -> t.Tuple[int, int | None]:
+        return (self._expected, self._actual)
+
+    def __setstate__(self, state: t.Tuple[int, int | None] | dict) -> None:
+        if isinstance(state, dict):
+            # Pickled before the compact representation
+            self.expected, self.actual = state["expected"], state.get("actual")
+            return
+        self._expected, self._actual = state
 
     def passed(self) -> bool:
         """Return if the train actually arrived or departed from the station.
@@ -59,7 +89,7 @@ class TrainStopTime:
         Returns:
             bool: True if the actual time is not None
         """
-        return self.actual is not None
+        return self._actual is not None
 
     def delay(self) -> float | None:
         """Return the delay in minutes.
@@ -67,16 +97,14 @@ class TrainStopTime:
         Returns:
             int | None: delay in minutes, None if not .passed().
         """
-        if not self.passed():
+        if self._actual is None:
             return None
 
-        assert isinstance(self.actual, datetime)
-        assert isinstance(self.expected, datetime)
-
-        if self.actual >= self.expected:
-            return (self.actual - self.expected).seconds / 60
+        # Like timedelta.seconds, the difference in days is ignored
+        if self._actual >= self._expected:
+            return (self._actual - self._expected) % 86400 / 60
         else:
-            return -(self.expected - self.actual).seconds / 60
+            return -((self._expected - self._actual) % 86400) / 60
 
     def __repr__(self) -> str:
         hm = lambda d: d.strftime("%H:%M")
@@ -108,8 +136,22 @@ class TrainStop:
         platform_actual (str | None): actual platform
         arrival (TrainStopTime | None): arrival time, can be None if it's the first stop
         departure (TrainStopTime | None): departure time, can be None if it's the last stop
+
+    Notes:
+        Pickled stops keep the station code only: the station is looked up
+        in the station cache when accessed (see Station._resolve).
     """
 
+    __slots__ = (
+        "_station",
+        "_station_code",
+        "stop_type",
+        "platform_expected",
+        "platform_actual",
+        "arrival",
+        "departure",
+    )
+
     def __init__(
         self,
         station: st.Station,
@@ -133,7 +175,9 @@ class TrainStop:
             departure_expected (datetime | None): expected departure time
             departure_actual (datetime | None): actual departure time
         """
-        self.station: st.Station = station
+        self._station: st.Station | None
+        self._station_code: str
+        self.station = station
         self.stop_type: TrainStopType = stop_type
 
         self.platform_expected: str | None = platform_expected
@@ -153,6 +197,49 @@ class TrainStop:
             assert isinstance(departure_expected, datetime)
             self.departure = TrainStopTime(departure_expected, departure_actual)
 
+    @property
+    def station(self) -> st.Station:
+        if self._station is not None:
+            return self._station
+        return st.Station._resolve(self._station_code)
+
+    @station.setter
+    def station(self, station: st.Station) -> None:
+        self._station = station
+        self._station_code = station.code
+
+    def __getstate__(self) -> tuple:
+        return (
+            self._station_code,
+            self.stop_type.value,
+            self.platform_expected,
+            self.platform_actual,
+            self.arrival,
+            self.departure,
+        )
+
+    def __setstate__(self, state: tuple | dict) -> None:
+        if isinstance(state, dict):
+            # Pickled before the compact representation
+            self.station = state["station"]
+            self.stop_type = state["stop_type"]
+            self.platform_expected = state.get("platform_expected")
+            self.platform_actual = state.get("platform_actual")
+            self.arrival = state.get("arrival")
+            self.departure = state.get("departure")
+            return
+
+        (
+            self._station_code,
+            stop_type,
+            self.platform_expected,
+            self.platform_actual,
+            self.arrival,
+            self.departure,
+        ) = state
+        self._station = None
+        self.stop_type = TrainStopType(stop_type)
+
     @classmethod
     def _from_raw_data(cls, stop_data: dict) -> "TrainStop":
         """Initialize a new train stop from the data processed by Train.fetch()
@@ -223,11 +310,9 @@ class TrainStop:
             if not hhmmss:
                 return None
 
-            return datetime.strptime(hhmmss, "%H:%M:%S").replace(
-                year=day.year,
-                month=day.month,
-                day=day.day,
-                tzinfo=api.TIMEZONE,
+            hours, minutes, seconds = (int(part) for part in hhmmss.split(":"))
+            return localtime.localize(
+                datetime(day.year, day.month, day.day, hours, minutes, seconds)
             )
 
         if not stop_data["actual_data"]:
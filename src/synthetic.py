@@ -0,0 +1,352 @@
+# railway-opendata: scrape and analyze italian railway data
+# Copyright (C) 2023 Marco Aceti
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import contextlib
+import json
+import logging
+import pathlib
+import random
+import typing as t
+from datetime import date, datetime, timedelta
+
+from src import station_extractor, train_extractor
+from src.const import TIMEZONE
+from src.scraper.dataset import save_dataset
+from src.scraper.standin import TRENORD_CLIENT_CODE, NetworkDay
+from src.scraper.station import Station
+from src.scraper.train import Train
+
+DEFAULT_DATA_DIR = pathlib.Path("data/synthetic/")
+DEFAULT_START_DATE: date = date(2023, 5, 1)
+
+# Railway companies of the lines not operated by Trenord,
+# with their category and their share of the lines
+COMPANIES: tuple[tuple[int, str, float], ...] = (
+    (2, "REG", 0.75),  # Trenitalia regional
+    (1, "FR", 0.08),  # Trenitalia high speed
+    (4, "IC", 0.07),  # Trenitalia intercity
+    (18, "REG", 0.06),  # TPER
+    (64, "EC", 0.04),  # ÖBB
+)
+
+# Adding this to a timestamp moves it some years ahead
+_CRAZY_SHIFT: int = 883 * 24 * 60 * 60 * 1000
+
+
+class Quirks(t.NamedTuple):
+    """Shares of the trains affected by the quirks of the real data.
+
+    Attributes:
+        cancelled (float): trains cancelled before departing (no stops)
+        partially_cancelled (float): trains whose last stops are cancelled
+        phantom (float): trains whose details can't be fetched
+        crazy_times (float): trains with a stop expected years after
+            its actual time (see train_extractor.load_file)
+    """
+
+    cancelled: float = 0.01
+    partially_cancelled: float = 0.03
+    phantom: float = 0.005
+    crazy_times: float = 0.001
+
+
+@contextlib.contextmanager
+def station_cache(
+    network: NetworkDay, codes: t.Iterable[str] = ()
+) -> t.Iterator[dict[str, Station]]:
+    """Fill the station cache with the stations of a network day and
+    the given stations, so no request is performed. The cache is restored
+    at the end.
+
+    Args:
+        network (NetworkDay): the network day
+        codes (t.Iterable[str], optional): other station codes to cache
+
+    Returns:
+        t.Iterator[dict[str, Station]]: the filled station cache
+    """
+    cache: dict[str, Station] = Station._cache
+    Station._cache = dict()
+    try:
+        for region in set(network.regions.values()):
+            for raw_station in json.loads(network.respond("elencoStazioni", region)):
+                Station._from_raw(raw_station)
+        for code in codes:
+            Station._cache.setdefault(
+                code, Station(code, region_code=1, name=f"Station {code}")
+            )
+        yield Station._cache
+    finally:
+        Station._cache = cache
+
+
+def _clock(timestamp: int) -> str:
+    """Format a timestamp (in milliseconds) as a Trenord time."""
+    return datetime.fromtimestamp(timestamp / 1000, tz=TIMEZONE).strftime("%H:%M:%S")
+
+
+def _delays(details: dict, rng: random.Random) -> None:
+    """Replace the constant delay of a train with a random walk: trains
+    mostly leave on time, then gain (or sometimes recover) delay at each stop."""
+    delay: float = rng.expovariate(1 / 4) if rng.random() < 0.6 else 0.0
+    for i, stop in enumerate(details["fermate"]):
+        if i > 0:
+            delay = max(-3.0, delay + rng.gauss(0.3, 1.5))
+        late: int = int(round(delay * 2) * 30 * 1000)
+        if stop["arrivoReale"] is not None:
+            stop["arrivoReale"] = stop["arrivo_teorico"] + late
+        if stop["partenzaReale"] is not None:
+            stop["partenzaReale"] = stop["partenza_teorica"] + max(late, 0)
+    details["ritardo"] = round(delay)
+
+
+def _trenord_delays(journey: dict, details: dict) -> None:
+    """Copy the actual times of the ViaggiaTreno stops to a Trenord journey."""
+    for stop, trenord_stop in zip(details["fermate"], journey["pass_list"]):
+        actual: dict = trenord_stop["actual_data"]
+        if actual["arr_actual_time"] is not None:
+            actual["arr_actual_time"] = _clock(stop["arrivoReale"])
+        if actual["dep_actual_time"] is not None:
+            actual["dep_actual_time"] = _clock(stop["partenzaReale"])
+
+
+def _cancel(details: dict, journey: dict | None, count: int) -> None:
+    """Cancel the last stops of a train (all of them if count is 0)."""
+    details["provvedimento"] = 1 if count == 0 else 2
+    if count == 0:
+        details["fermate"] = list()
+    for stop in details["fermate"][-count:]:
+        stop["tipoFermata"] = ""
+        stop["arrivoReale"] = stop["partenzaReale"] = None
+    for trenord_stop in journey["pass_list"][-count:] if journey else []:
+        trenord_stop["cancelled"] = True
+        trenord_stop["actual_data"]["arr_actual_time"] = None
+        trenord_stop["actual_data"]["dep_actual_time"] = None
+
+
+def network_day(
+    day: date, trains: int, seed: int = 0, quirks: Quirks = Quirks()
+) -> NetworkDay:
+    """Generate a day of the network (see NetworkDay.synthetic).
+
+    The lines and the timetable only depend on the seed, so they are the same
+    in every day; the operating companies depend on the line. Delays,
+    cancellations and other quirks are drawn for each day.
+
+    Args:
+        day (date): the day
+        trains (int): the approximate number of trains
+        seed (int, optional): the seed of the generator
+        quirks (Quirks, optional): the shares of the quirks of the real data
+
+    Returns:
+        NetworkDay: the generated day
+    """
+    network: NetworkDay = NetworkDay.synthetic(trains, seed=seed, day=day)
+    rng = random.Random(f"{seed}-{day.isoformat()}")
+
+    boards: dict[tuple[str, int], dict] = {
+        (entry["codOrigine"], entry["numeroTreno"]): entry
+        for entries in network.boards.values()
+        for entry in entries
+    }
+    for (origin, number), details in list(network.trains.items()):
+        entry: dict = boards[(origin, number)]
+        if details["codiceCliente"] != TRENORD_CLIENT_CODE:
+            # Both directions of a line are operated by the same company
+            track: str = "-".join(sorted((origin, details["idDestinazione"])))
+            client_code, category, _ = random.Random(f"{seed}-{track}").choices(
+                COMPANIES, weights=[share for _, _, share in COMPANIES]
+            )[0]
+            details["codiceCliente"] = entry["codiceCliente"] = client_code
+            details["categoria"] = entry["categoriaDescrizione"] = category
+
+        journeys: list[dict] = (
+            network.trenord[number][0]["journey_list"]
+            if number in network.trenord
+            else []
+        )
+        journey: dict | None = journeys[0] if journeys else None
+        _delays(details, rng)
+        if journey is not None:
+            _trenord_delays(journey, details)
+
+        stops: list[dict] = details["fermate"]
+        roll: float = rng.random()
+        if (roll := roll - quirks.cancelled) < 0:
+            _cancel(details, journey, 0)
+            entry["provvedimento"] = 1
+        elif (roll := roll - quirks.partially_cancelled) < 0:
+            if len(stops) > 2:
+                _cancel(details, journey, rng.randint(1, len(stops) - 2))
+        elif (roll := roll - quirks.phantom) < 0:
+            del network.trains[(origin, number)]
+        elif roll - quirks.crazy_times < 0:
+            stop: dict = stops[rng.randrange(1, len(stops))]
+            stop["arrivo_teorico"] += _CRAZY_SHIFT
+    return network
+
+
+def scrape_day(network: NetworkDay) -> dict[int, Train]:
+    """Build the trains of a network day, as the scraper would fetch them
+    (see Train.fetch and Train.fetch_trenord), without performing requests.
+    The stations must be cached (see station_cache).
+
+    Args:
+        network (NetworkDay): the network day
+
+    Returns:
+        dict[int, Train]: the trains, by hash (as saved by the scraper)
+    """
+    trains: dict[int, Train] = dict()
+    for entries in network.boards.values():
+        for entry in entries:
+            train: Train = Train._from_station_departures_arrivals(entry)
+            trains[hash(train)] = train
+
+            details: dict | None = network.trains.get(
+                (entry["codOrigine"], train.number)
+            )
+            if details is None:
+                train._phantom = True
+                continue
+
+            train._update_details(details)
+            if train.client_code == TRENORD_CLIENT_CODE:
+                if network.trenord.get(train.number):
+                    train._update_trenord_details(network.trenord[train.number])
+                else:
+                    train._trenord_phantom = True
+            train._check_stops()
+    return trains
+
+
+def generate(
+    data_dir: pathlib.Path,
+    start_date: date,
+    days: int,
+    trains: int,
+    seed: int = 0,
+    quirks: Quirks = Quirks(),
+    csv: bool = False,
+) -> list[pathlib.Path]:
+    """Generate the datasets of some consecutive days, as saved by the scraper:
+    'stations.pickle' and the 'trains.pickle' file of each day directory.
+    Days are generated one at a time, so months of data can be generated.
+
+    Args:
+        data_dir (pathlib.Path): the data directory
+        start_date (date): the first day
+        days (int): the number of days
+        trains (int): the approximate number of trains of each day
+        seed (int, optional): the seed of the generator
+        quirks (Quirks, optional): the shares of the quirks of the real data
+        csv (bool, optional): if True, also convert the datasets to CSV
+            (see train_extractor and station_extractor)
+
+    Returns:
+        list[pathlib.Path]: the 'trains.pickle' files
+    """
+    paths: list[pathlib.Path] = list()
+    for i in range(days):
+        day: date = start_date + timedelta(days=i)
+        network: NetworkDay = network_day(day, trains, seed=seed, quirks=quirks)
+        with station_cache(network) as stations:
+            day_trains: dict[int, Train] = scrape_day(network)
+            if i == 0:
+                data_dir.mkdir(parents=True, exist_ok=True)
+                save_dataset(data_dir / "stations.pickle", dict(stations))
+                if csv:
+                    station_extractor.to_csv(stations, data_dir / "stations.csv")
+
+        day_path: pathlib.Path = data_dir / day.strftime("%Y-%m-%d")
+        day_path.mkdir(exist_ok=True)
+        save_dataset(day_path / "trains.pickle", day_trains)
+        if csv:
+            train_extractor.to_csv(
+                train_extractor.load_file(day_path / "trains.pickle"),
+                day_path / "trains.csv",
+            )
+        paths.append(day_path / "trains.pickle")
+        logging.debug(f"Generated {len(day_trains)} trains @ {day_path}")
+    return paths
+
+
+def register_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "-o",
+        "--data-dir",
+        type=pathlib.Path,
+        default=DEFAULT_DATA_DIR,
+        help=f"data directory to write the datasets in. Defaults to {DEFAULT_DATA_DIR}",
+    )
+    parser.add_argument(
+        "--start-date",
+        type=date.fromisoformat,
+        default=DEFAULT_START_DATE,
+        metavar="YYYY-MM-DD",
+        help=f"the first day. Defaults to {DEFAULT_START_DATE}",
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=1,
+        metavar="N",
+        help="number of days to generate. Defaults to 1",
+    )
+    parser.add_argument(
+        "--trains",
+        type=int,
+        default=5000,
+        metavar="N",
+        help="approximate number of trains of each day. Defaults to 5000",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed of the generator. Defaults to 0",
+    )
+    parser.add_argument(
+        "--csv",
+        action="store_true",
+        help="also convert the datasets to CSV, as train-extractor and station-extractor do",
+    )
+    defaults: Quirks = Quirks()
+    for field in Quirks._fields:
+        parser.add_argument(
+            f"--{field.replace('_', '-')}",
+            type=float,
+            default=getattr(defaults, field),
+            metavar="SHARE",
+            help=f"share of {field.replace('_', ' ')} trains. Defaults to {getattr(defaults, field)}",
+        )
+
+
+def main(args: argparse.Namespace) -> None:
+    quirks = Quirks(*(getattr(args, field) for field in Quirks._fields))
+    paths: list[pathlib.Path] = generate(
+        args.data_dir,
+        args.start_date,
+        args.days,
+        args.trains,
+        seed=args.seed,
+        quirks=quirks,
+        csv=args.csv,
+    )
+    logging.info(f"Generated {len(paths)} days of trains in {args.data_dir}")
@@ -17,12 +17,14 @@
 
 import argparse
 import csv
-import hashlib
-import pickle
+import typing as t
 from datetime import date, datetime
 from pathlib import Path
 
-from src.const import TIMEZONE
+import numpy as np
+
+import src.localtime as localtime
+from src.scraper.dataset import load_dataset
 from src.scraper.train import Train
 from src.scraper.train_stop import TrainStopTime
 from src.utils import parse_input_format_output_args
@@ -43,18 +45,20 @@ def load_file(file: Path) -> dict[int, Train]:
         were all 1900-01-01.
         This function fixes such incorrect dates.
     """
-    with open(file, "rb") as f:
-        data: dict[int, Train] = pickle.load(f)
+    # Trains are appended to the file in chunks by the scraper
+    data: dict[int, Train] = load_dataset(file)
 
     def _fix_datetime(train: Train, dt: datetime | None) -> datetime | None:
         """Fix departure and arrival timestamps"""
         if isinstance(dt, datetime) and dt.year < 2000:
             dep_date: date = train.departing_date
-            dt = dt.replace(
-                year=dep_date.year,
-                month=dep_date.month,
-                day=dep_date.day,
-                tzinfo=TIMEZONE,
+            dt = localtime.localize(
+                dt.replace(
+                    year=dep_date.year,
+                    month=dep_date.month,
+                    day=dep_date.day,
+                    tzinfo=None,
+                )
             )
         return dt
 
@@ -93,8 +97,22 @@ def load_file(file: Path) -> dict[int, Train]:
     return data
 
 
+# Stops converted at once: their times are formatted in a batch
+CSV_CHUNK: int = 10000
+
+
+def _write_rows(writer: t.Any, rows: list[list], times: list[int | None]) -> None:
+    """Format the stop times of some rows (see localtime.isoformat) and write them.
+    Helper function to to_csv()."""
+    formatted: np.ndarray = localtime.isoformat(times).reshape(-1, 4)
+    for row, (arr_exp, arr_act, dep_exp, dep_act) in zip(rows, formatted.tolist()):
+        row[14], row[15], row[17], row[18] = arr_exp, arr_act, dep_exp, dep_act
+        writer.writerow(row)
+
+
 def to_csv(data: dict[int, Train], output_file: Path) -> None:
     """Convert to CSV train data, one row per stop.
+    Rows are written in chunks of CSV_CHUNK stops.
 
     Args:
         data (dict[int, Train]): the data to convert
@@ -133,13 +151,18 @@ def to_csv(data: dict[int, Train], output_file: Path) -> None:
     )
     writer.writerow(FIELDS)
 
+    # Stop times are formatted a chunk at a time (see localtime.isoformat)
+    rows: list[list] = list()
+    times: list[int | None] = list()
     for train_h in data:
         train: Train = data[train_h]
 
         for i, stop in enumerate(train.stops) if isinstance(train.stops, list) else []:
-            writer.writerow(
-                (
-                    hashlib.md5(str(train_h).encode("ascii")).hexdigest(),
+            arrival: TrainStopTime | None = stop.arrival
+            departure: TrainStopTime | None = stop.departure
+            rows.append(
+                [
+                    train.key,
                     train.number,
                     train.departing_date.isoformat(),
                     train.origin.code,
@@ -155,24 +178,30 @@ def to_csv(data: dict[int, Train], output_file: Path) -> None:
                     stop.station.code,
                     stop.stop_type.value,
                     stop.platform_actual or stop.platform_expected,
-                    stop.arrival.expected.isoformat()
-                    if stop.arrival and stop.arrival.expected
-                    else None,
-                    stop.arrival.actual.isoformat()
-                    if stop.arrival and stop.arrival.actual
-                    else None,
-                    stop.arrival.delay() if stop.arrival else None,
-                    stop.departure.expected.isoformat()
-                    if stop.departure and stop.departure.expected
-                    else None,
-                    stop.departure.actual.isoformat()
-                    if stop.departure and stop.departure.actual
-                    else None,
-                    stop.departure.delay() if stop.departure else None,
+                    None,
+                    None,
+                    arrival.delay() if arrival else None,
+                    None,
+                    None,
+                    departure.delay() if departure else None,
                     train.crowding if hasattr(train, "crowding") else None,
+                ]
+            )
+            times.extend(
+                (
+                    arrival._expected if arrival else None,
+                    arrival._actual if arrival else None,
+                    departure._expected if departure else None,
+                    departure._actual if departure else None,
                 )
             )
 
+        if len(rows) >= CSV_CHUNK:
+            _write_rows(writer, rows, times)
+            rows.clear()
+            times.clear()
+
+    _write_rows(writer, rows, times)
     csvfile.close()
 
 